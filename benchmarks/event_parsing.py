@@ -0,0 +1,58 @@
+"""
+Feeds a stream of asynchronous CIRC events (mostly single-line, with
+some multi-line ones mixed in) through a TorControlProtocol and prints
+how many lines per second it parses.
+
+Run from the top of the source tree::
+
+    python benchmarks/event_parsing.py
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+
+EVENT = '650 CIRC %d EXTENDED $AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA~foo PURPOSE=GENERAL\r\n'
+MULTI = '650-CIRC %d BUILT $AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA~foo\r\n650 PURPOSE=GENERAL\r\n'
+
+
+def build_events(count):
+    data = []
+    for x in range(count):
+        if x % 10:
+            data.append(EVENT % x)
+        else:
+            data.append(MULTI % x)
+    return ''.join(data)
+
+
+def time_events(data, chunk_size=65536):
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto._set_valid_events('CIRC')
+    proto.add_event_listener('CIRC', lambda _: None)
+    proto.dataReceived('250 OK\r\n')
+
+    start = time.time()
+    for i in range(0, len(data), chunk_size):
+        proto.dataReceived(data[i:i + chunk_size])
+    return time.time() - start
+
+
+def main():
+    count = 100000
+    data = build_events(count)
+    lines = data.count('\n')
+    elapsed = min(time_events(data) for _ in range(3))
+    print "%d events (%d lines) in %.3f seconds: %d lines/second" % (count, lines, elapsed, lines / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+The benchmarks run by ``suite.py``; see there. Each builds its
+fixtures from a fixed seed (routers come from
+:func:`txtorcon.fakecontrol.synthetic_consensus`) so results from
+different commits can be compared.
+"""
+
+import random
+
+from zope.interface import implements
+from twisted.internet import defer, task
+
+from txtorcon import TorState, TorConfig, Circuit, Stream, AddrMap
+from txtorcon.interface import ITorControlProtocol
+from txtorcon.torcontrolprotocol import parse_keywords
+from txtorcon.util import find_keywords
+from txtorcon.fakecontrol import synthetic_consensus, _network_status, _long_name
+from txtorcon.fakecontrol import _microdescriptor, _microdesc_status
+from txtorcon.microdesc import MicrodescriptorParser
+from txtorcon.util import NetLocation
+from txtorcon import columns
+
+from suite import benchmark, memory
+
+ROUTERS = 7000                          # about the size of the real consensus
+
+
+class FakeProtocol(object):
+    """
+    Just enough of a TorControlProtocol for TorState and TorConfig
+    to be created without talking to anything.
+    """
+
+    implements(ITorControlProtocol)
+
+    def __init__(self, conf={}, names=''):
+        self.conf = conf
+        self.names = names
+        self.post_bootstrap = None
+        self.on_disconnect = None
+
+    def add_event_listener(self, name, callback):
+        pass
+
+    def get_info_raw(self, key):
+        return defer.succeed('config/names=\n' + self.names)
+
+    def get_conf(self, name):
+        return defer.succeed({name: self.conf[name]})
+
+    def get_conf_raw(self, name):
+        return defer.succeed('')
+
+
+def ns_lines(count=ROUTERS):
+    lines = []
+    for router in synthetic_consensus(count):
+        lines.extend(_network_status(router))
+    return lines
+
+
+def state_with_routers(count=ROUTERS):
+    state = TorState(FakeProtocol(), bootstrap=False)
+    state._update_network_status('\n'.join(ns_lines(count)))
+    return state
+
+
+@benchmark('parse_keywords', 'line')
+def bench_parse_keywords():
+    rand = random.Random(0)
+    lines = ['key%d=%s' % (x, 'x' * rand.randint(1, 80)) for x in range(10000)]
+    lines.append('ns/all=')
+    lines.extend(ns_lines(500))
+    reply = '\n'.join(lines)
+    return (lambda: parse_keywords(reply)), len(lines)
+
+
+@benchmark('find_keywords', 'event')
+def bench_find_keywords():
+    events = []
+    for x in range(20000):
+        events.append(('%d BUILT $AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA~foo,$BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB~bar '
+                       'BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED=2014-12-18T00:00:00.000000' % x).split())
+
+    def run():
+        for args in events:
+            find_keywords(args)
+    return run, len(events)
+
+
+@benchmark('ns_all_parse', 'router')
+def bench_ns_all_parse():
+    lines = ns_lines()
+
+    def run():
+        state = TorState(FakeProtocol(), bootstrap=False)
+        process = state._network_status_parser.process
+        for line in lines:
+            process(line)
+    return run, ROUTERS
+
+
+@benchmark('microdesc_load', 'router')
+def bench_microdesc_load():
+    ## bootstrapping with microdescriptors=True: the microdesc
+    ## consensus and then md/all
+    consensus = []
+    md_lines = []
+    for router in synthetic_consensus(ROUTERS):
+        md = _microdescriptor(router)
+        consensus.extend(_microdesc_status(router, md))
+        md_lines.extend(md.rstrip('\n').split('\n'))
+
+    def run():
+        state = TorState(FakeProtocol(), bootstrap=False, microdescriptors=True)
+        process = state._microdesc_consensus_parser.process
+        for line in consensus:
+            process(line)
+        state._update_network_status('', parser=state._microdesc_consensus_parser)
+        parser = MicrodescriptorParser()
+        for line in md_lines:
+            parser.process(line)
+        state._add_microdescriptors(parser.finish())
+    return run, ROUTERS
+
+
+@benchmark('consensus_update', 'router')
+def bench_consensus_update():
+    ## a NEWCONSENSUS for routers we already have, with a few
+    ## bandwidths changed
+    lines = ns_lines()
+    changed = list(lines)
+    for x in range(0, len(changed), 97):
+        if changed[x].startswith('w '):
+            changed[x] = 'w Bandwidth=1'
+    updates = ['\n'.join(lines), '\n'.join(changed)]
+    state = state_with_routers()
+
+    def run():
+        for data in updates:
+            state._update_network_status(data)
+    return run, ROUTERS * len(updates)
+
+
+@benchmark('routers_where', 'query')
+def bench_routers_where():
+    ## what an attacher might ask for on each new stream
+    state = state_with_routers()
+    queries = [dict(flags=('exit', 'fast', 'stable'), port=443),
+               dict(flags=('guard',), min_bandwidth=100),
+               dict(flags=('exit',), port=22)] * 50
+
+    def run():
+        for query in queries:
+            state.routers_where(**query)
+    return run, len(queries)
+
+
+@benchmark('random_path', 'path')
+def bench_random_path():
+    state = state_with_routers()
+    state.path_selector.random = random.Random(0)
+    ports = [None, 443, 80] * 100
+
+    def run():
+        for port in ports:
+            state.random_path(exit_port=port)
+    return run, len(ports)
+
+
+if columns.numpy is not None:
+    @benchmark('consensus_columns', 'query')
+    def bench_consensus_columns():
+        ## a monitoring job's per-country exit capacity and flag
+        ## histogram (only if NumPy is installed)
+        state = state_with_routers()
+        rand = random.Random(0)
+        for router in state.routers_by_hash.values():
+            router._location = NetLocation(None)
+            router._location.countrycode = rand.choice(['DE', 'US', 'FR', 'NL', 'SE', 'CA'])
+        consensus = columns.ConsensusColumns(state)
+
+        def run():
+            consensus.bandwidth_by_country('exit')
+            consensus.flag_counts()
+        return run, 1
+
+
+@benchmark('circuit_update', 'event')
+def bench_circuit_update():
+    state = state_with_routers(1000)
+    rand = random.Random(0)
+    routers = state.routers_by_hash.values()
+    events = []
+    for circid in range(1, 2001):
+        path = [_long_name(dict(id=r.id_hex[1:].decode('hex'), name=r.name)) for r in rand.sample(routers, 3)]
+        events.append((circid, '%d LAUNCHED PURPOSE=GENERAL' % circid))
+        for hop in range(1, 4):
+            events.append((circid, '%d EXTENDED %s PURPOSE=GENERAL' % (circid, ','.join(path[:hop]))))
+        events.append((circid, '%d BUILT %s PURPOSE=GENERAL' % (circid, ','.join(path))))
+        events.append((circid, '%d CLOSED %s PURPOSE=GENERAL REASON=FINISHED' % (circid, ','.join(path))))
+    events = [(circid, text.split()) for (circid, text) in events]
+
+    def run():
+        circuits = {}
+        for (circid, args) in events:
+            try:
+                circuit = circuits[circid]
+            except KeyError:
+                circuit = circuits[circid] = Circuit(state)
+            circuit.update(args)
+    return run, len(events)
+
+
+@benchmark('stream_update', 'event')
+def bench_stream_update():
+    state = state_with_routers(10)
+    circuit = Circuit(state)
+    circuit.update('1 BUILT PURPOSE=GENERAL'.split())
+    state.circuits[1] = circuit
+    events = []
+    for streamid in range(1, 5001):
+        target = 'www%d.example.com:80' % streamid
+        events.append((streamid, '%d NEW 0 %s SOURCE_ADDR=127.0.0.1:%d PURPOSE=USER' % (streamid, target, 1024 + streamid)))
+        events.append((streamid, '%d SENTCONNECT 1 %s' % (streamid, target)))
+        events.append((streamid, '%d SUCCEEDED 1 %s' % (streamid, target)))
+        events.append((streamid, '%d CLOSED 1 %s REASON=DONE' % (streamid, target)))
+    events = [(streamid, text.split()) for (streamid, text) in events]
+
+    def run():
+        streams = {}
+        for (streamid, args) in events:
+            try:
+                stream = streams[streamid]
+            except KeyError:
+                stream = streams[streamid] = Stream(state)
+            stream.update(args)
+    return run, len(events)
+
+
+@benchmark('addrmap_update', 'update')
+def bench_addrmap_update():
+    updates = []
+    for x in range(5000):
+        updates.append('www%d.example.com 10.0.%d.%d "2014-12-18 00:%02d:00" EXPIRES="2014-12-18 00:%02d:00"'
+                       % (x % 2500, (x // 250) % 256, x % 250, x % 60, x % 60))
+
+    def run():
+        addrmap = AddrMap()
+        addrmap.scheduler = task.Clock()
+        for update in updates:
+            addrmap.update(update)
+    return run, len(updates)
+
+
+@benchmark('torconfig_setup', 'option')
+def bench_torconfig_setup():
+    kinds = [('Boolean', '1'), ('Integer', '42'), ('Port', '9050'), ('TimeInterval', '3600'),
+             ('DataSize', '1048576'), ('Float', '0.5'), ('String', 'foo'), ('Filename', '/tmp/foo'),
+             ('CommaList', 'a,b,c'), ('LineList', 'a b'), ('Boolean+Auto', 'auto'), ('RouterList', '$AA,$BB')]
+    names = []
+    conf = {}
+    for x in range(300):
+        (kind, value) = kinds[x % len(kinds)]
+        names.append('Option%d %s' % (x, kind))
+        conf['Option%d' % x] = value
+    proto = FakeProtocol(conf, '\n'.join(names))
+
+    def run():
+        config = TorConfig(proto)
+        assert config.post_bootstrap.called
+    return run, len(names)
+
+
+@memory('router_memory', 'router')
+def measure_router_memory():
+    from suite import deep_size
+    state = state_with_routers()
+    routers = state.routers_by_hash.values()
+    return deep_size(routers, exclude=[state.protocol]), len(routers)
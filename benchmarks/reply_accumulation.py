@@ -0,0 +1,60 @@
+"""
+Feeds multi-line GETINFO replies of increasing size through a
+TorControlProtocol (with no incremental callback, so the whole reply
+is accumulated) and prints the time taken per line.
+
+If accumulation is linear, the time per line stays roughly the same
+as the reply grows. Run from the top of the source tree::
+
+    python benchmarks/reply_accumulation.py
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+
+LINE = 'r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80'
+
+
+def build_reply(lines):
+    data = ['250+ns/all=']
+    data.extend([LINE] * lines)
+    data.append('.')
+    data.append('250 OK')
+    return '\r\n'.join(data) + '\r\n'
+
+
+def time_reply(lines, chunk_size=65536):
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+
+    got = []
+    proto.get_info_raw('ns/all').addCallback(got.append)
+    reply = build_reply(lines)
+
+    start = time.time()
+    for i in range(0, len(reply), chunk_size):
+        proto.dataReceived(reply[i:i + chunk_size])
+    elapsed = time.time() - start
+
+    assert len(got) == 1
+    assert got[0].count('\n') == lines
+    return elapsed
+
+
+def main():
+    print "%10s %12s %16s" % ('lines', 'seconds', 'usec per line')
+    for lines in (5000, 10000, 25000, 50000):
+        elapsed = min(time_reply(lines) for _ in range(3))
+        print "%10d %12.4f %16.2f" % (lines, elapsed, (elapsed / lines) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
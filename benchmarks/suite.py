@@ -0,0 +1,186 @@
+"""
+Runs the benchmarks in ``hotpaths.py`` (every function decorated
+with ``@benchmark`` or ``@memory``, in the order they're defined)
+and prints one line per benchmark. The fixtures are all generated
+from fixed seeds, so two runs on different commits are measuring the
+same thing.
+
+Run from the top of the source tree::
+
+    python benchmarks/suite.py                     # everything
+    python benchmarks/suite.py parse_keywords      # just these
+    python benchmarks/suite.py --json after.json   # save the results
+    python benchmarks/suite.py --compare before.json
+
+With ``--compare``, each result is shown next to the saved one and
+anything slower (or bigger) by more than ``--threshold`` is marked;
+the exit status is 1 if anything was.
+"""
+
+import sys
+import os
+import gc
+from timeit import default_timer
+import json
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.python import usage
+
+
+def benchmark(name, unit):
+    """
+    Decorator for a function which sets up a benchmark and returns a
+    tuple ``(run, count)``: ``run`` is called (with no arguments) once
+    per repeat and does ``count`` of ``unit``.
+    """
+
+    def decorator(setup):
+        setup.benchmark = (name, 'time', unit)
+        return setup
+    return decorator
+
+
+def memory(name, unit):
+    """
+    Decorator for a function which returns a tuple ``(size, count)``:
+    ``size`` bytes for ``count`` of ``unit``.
+    """
+
+    def decorator(measure):
+        measure.benchmark = (name, 'memory', unit)
+        return measure
+    return decorator
+
+
+def find_benchmarks(module):
+    """
+    :return: a list of ``(name, kind, unit, function)`` for every
+        benchmark in ``module``, in the order they're defined
+    """
+
+    found = [f for f in vars(module).values() if hasattr(f, 'benchmark')]
+    found.sort(key=lambda f: f.func_code.co_firstlineno)
+    return [f.benchmark + (f,) for f in found]
+
+
+def deep_size(obj, exclude=()):
+    """
+    :return: the size in bytes of ``obj`` and everything it refers to
+        (via containers, ``__dict__`` and ``__slots__``), counting
+        each object once and not following anything in ``exclude``
+        (e.g. the protocol every Router refers to) or any class,
+        function or module.
+    """
+
+    seen = set(id(x) for x in exclude)
+    skip = (type, type(deep_size), type(sys))
+    todo = [obj]
+    size = 0
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, skip):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            todo.extend(obj)
+        if hasattr(obj, '__dict__'):
+            todo.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                if hasattr(obj, slot):
+                    todo.append(getattr(obj, slot))
+    return size
+
+
+def run_time(setup, repeat):
+    (run, count) = setup()
+    run()                               # warm-up
+    times = []
+    for x in range(repeat):
+        gc.collect()
+        start = default_timer()
+        run()
+        times.append(default_timer() - start)
+    times.sort()
+    return dict(best=times[0] / count, median=times[len(times) // 2] / count, count=count)
+
+
+def run_memory(measure):
+    (size, count) = measure()
+    return dict(best=float(size) / count, median=float(size) / count, count=count)
+
+
+def format_value(kind, value):
+    if kind == 'memory':
+        return '%10.1f bytes' % value
+    return '%10.3f usec ' % (value * 1e6)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['repeat', 'r', 5, 'How many times to run each benchmark.', int],
+        ['json', 'j', None, 'Write the results to this file.'],
+        ['compare', 'c', None, 'Compare against results saved with --json.'],
+        ['threshold', 't', 1.1, 'Ratio (to --compare results) counted as a regression.', float],
+    ]
+
+    def parseArgs(self, *names):
+        self['names'] = names
+
+
+def main(argv=sys.argv[1:]):
+    options = Options()
+    options.parseOptions(argv)
+
+    import hotpaths
+
+    previous = {}
+    if options['compare']:
+        with open(options['compare']) as f:
+            previous = json.load(f)['results']
+
+    results = {}
+    regressions = 0
+    for (name, kind, unit, setup) in find_benchmarks(hotpaths):
+        if options['names'] and name not in options['names']:
+            continue
+        if kind == 'time':
+            result = run_time(setup, options['repeat'])
+        else:
+            result = run_memory(setup)
+        result['kind'] = kind
+        result['unit'] = unit
+        results[name] = result
+
+        line = '%-28s %s per %-8s' % (name, format_value(kind, result['best']), unit)
+        if name in previous:
+            ratio = result['best'] / previous[name]['best']
+            line += '  was %s (%.2fx)' % (format_value(kind, previous[name]['best']).strip(), ratio)
+            if ratio > options['threshold']:
+                line += '  REGRESSION'
+                regressions += 1
+        print line
+
+    if options['json']:
+        with open(options['json'], 'w') as f:
+            json.dump(dict(revision=git_revision(), python=sys.version.split()[0],
+                           results=results), f, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
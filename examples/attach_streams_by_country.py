@@ -157,8 +157,7 @@ class MyAttacher(txtorcon.CircuitListenerMixin):
     def request_circuit_build(self, stream_cc, deferred_to_callback):
         # for exits, we can select from any router that's in the
         # correct country.
-        last = filter(lambda x: x.location.countrycode == stream_cc,
-                      self.state.routers.values())
+        last = list(self.state.routers_where(country=stream_cc))
 
         # start with an entry guard, put anything in the middle and
         # put one of our exits at the end.
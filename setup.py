@@ -40,6 +40,8 @@ setup(name = 'txtorcon',
       ## FIXME is requires even doing anything? why is format
       ## apparently different for install_requires?
       install_requires = ['Twisted>=11.1.0', 'zope.interface>=3.6.1'],
+      ## only for txtorcon.columns.ConsensusColumns
+      extras_require = {'analytics': ['numpy']},
       classifiers = ['Framework :: Twisted',
                      'Development Status :: 4 - Beta',
                      'Intended Audience :: Developers',
@@ -0,0 +1,109 @@
+from twisted.trial import unittest
+from zope.interface.verify import verifyObject
+
+from txtorcon import TorState
+from txtorcon import columns
+from txtorcon.interface import IRouterListener
+from txtorcon.columns import ConsensusColumns, ipv4_to_int
+
+from test_routerindex import FakeControlProtocol, FakeLocation, CONSENSUS
+
+
+class IPv4Tests(unittest.TestCase):
+
+    def test_convert(self):
+        self.assertEqual(ipv4_to_int('1.2.3.4'), 0x01020304)
+        self.assertEqual(ipv4_to_int('255.255.255.255'), 0xffffffff)
+        self.assertEqual(ipv4_to_int('unknown'), 0)
+
+
+class NoNumPyTests(unittest.TestCase):
+
+    def test_import_error(self):
+        self.patch(columns, 'numpy', None)
+        state = TorState(FakeControlProtocol(), bootstrap=False)
+        self.assertRaises(ImportError, ConsensusColumns, state)
+        self.assertEqual(state.router_listeners, [])
+
+
+class ConsensusColumnsTests(unittest.TestCase):
+
+    if columns.numpy is None:
+        skip = "NumPy isn't installed"
+
+    def setUp(self):
+        self.state = TorState(FakeControlProtocol(), bootstrap=False)
+        self.state._update_network_status(CONSENSUS)
+        self.locations = {'exit1': FakeLocation('DE'),
+                          'exit2': FakeLocation('US'),
+                          'guard1': FakeLocation('DE')}
+        for router in self.state.all_routers:
+            router._location = self.locations[router.name]
+        self.columns = ConsensusColumns(self.state)
+
+    def column(self, name):
+        return dict((self.columns.routers[row].name, value)
+                    for (row, value) in enumerate(getattr(self.columns, name).tolist()))
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(IRouterListener, self.columns))
+        self.assertTrue(self.columns in self.state.router_listeners)
+
+    def test_columns(self):
+        self.assertEqual(len(self.columns), 3)
+        self.assertEqual(self.column('bandwidth'), {'exit1': 5000, 'exit2': 70, 'guard1': 9000})
+        self.assertEqual(self.column('ipv4'), {'exit1': 0x0a000001, 'exit2': 0x0a000002, 'guard1': 0x0a000003})
+        for (row, router) in enumerate(self.columns.routers):
+            self.assertEqual(self.columns.fingerprint[row], router.id_digest)
+            self.assertEqual(self.columns.flags[row], router.flag_mask)
+            self.assertEqual(self.columns.rows[router], row)
+
+    def test_flags(self):
+        exits = self.columns.has_flag('exit')
+        self.assertEqual(sorted(r.name for (r, e) in zip(self.columns.routers, exits) if e), ['exit1', 'exit2'])
+        counts = self.columns.flag_counts()
+        self.assertEqual(counts['running'], 3)
+        self.assertEqual(counts['stable'], 2)
+        self.assertEqual(counts['guard'], 1)
+        self.assertTrue('authority' not in counts)
+
+    def test_country(self):
+        codes = dict((name, self.columns.countries[index]) for (name, index) in self.column('country').items())
+        self.assertEqual(codes, {'exit1': 'DE', 'exit2': 'US', 'guard1': 'DE'})
+        self.assertEqual(self.columns.bandwidth_by_country(), {'DE': 14000, 'US': 70})
+        self.assertEqual(self.columns.bandwidth_by_country('exit'), {'DE': 5000, 'US': 70})
+
+    def test_country_learned_later(self):
+        self.locations['exit2'].countrycode = None
+        self.assertEqual(self.columns.bandwidth_by_country(), {'DE': 14000, None: 70})
+        self.locations['exit2'].countrycode = 'US'
+        self.assertEqual(self.columns.bandwidth_by_country(), {'DE': 14000, 'US': 70})
+
+    def test_updates(self):
+        self.state._update_network_status(CONSENSUS.replace('Bandwidth=70', 'Bandwidth=7000')
+                                                   .replace('10.0.0.1', '10.0.1.1')
+                                                   .replace('Exit Fast Running Valid', 'Fast Running Valid'))
+        self.assertEqual(self.column('bandwidth'), {'exit1': 5000, 'exit2': 7000, 'guard1': 9000})
+        self.assertEqual(self.column('ipv4')['exit1'], 0x0a000101)
+        self.assertEqual(self.columns.flag_counts()['exit'], 1)
+
+    def test_removed(self):
+        self.columns.country
+        self.state._update_network_status(CONSENSUS.split('\n', 4)[4])
+        self.assertEqual(len(self.columns), 2)
+        self.assertEqual(self.column('bandwidth'), {'exit2': 70, 'guard1': 9000})
+        self.assertEqual(self.columns.bandwidth_by_country(), {'DE': 9000, 'US': 70})
+        for (row, router) in enumerate(self.columns.routers):
+            self.assertEqual(self.columns.fingerprint[row], router.id_digest)
+            self.assertEqual(self.columns.rows[router], row)
+
+    def test_grows(self):
+        lines = []
+        for x in range(100):
+            lines.append('r r%d %s QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 10.1.0.%d 9001 0'
+                         % (x, ('%020d' % x).encode('base64')[:27], x))
+            lines.append('s Fast Running Valid')
+            lines.append('w Bandwidth=%d' % x)
+        self.state._update_network_status('\n'.join(lines), complete=False)
+        self.assertEqual(len(self.columns), 103)
+        self.assertEqual(int(self.columns.bandwidth.sum()), 14070 + sum(range(100)))
@@ -0,0 +1,137 @@
+import datetime
+
+from twisted.trial import unittest
+
+from txtorcon.consensus import ConsensusParser, parse_published
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def _router_begin(self, line):
+        self.calls.append(('r', line))
+
+    def _router_address(self, line):
+        self.calls.append(('a', line))
+
+    def _router_flags(self, line):
+        self.calls.append(('s', line))
+
+    def _router_bandwidth(self, line):
+        self.calls.append(('w', line))
+
+    def _router_policy(self, line):
+        self.calls.append(('p', line))
+
+    def _router_microdesc(self, line):
+        self.calls.append(('m', line))
+
+
+class ParsePublishedTests(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_published('2014-12-17', '23:57:03'),
+                         datetime.datetime(2014, 12, 17, 23, 57, 3))
+
+    def test_cached(self):
+        self.assertTrue(parse_published('2014-12-17', '01:02:03') is parse_published('2014-12-17', '01:02:03'))
+
+    def test_bad(self):
+        self.assertRaises(ValueError, parse_published, '2014-13-17', '01:02:03')
+        self.assertRaises(ValueError, parse_published, 'yesterday', 'noon')
+
+
+class ConsensusParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.target = Recorder()
+        self.parser = ConsensusParser(self.target)
+
+    def feed(self, text):
+        for line in text.split('\n'):
+            self.parser.process(line)
+
+    def test_routers(self):
+        self.feed('''ns/all=
+r foo AHhuQ8zFQJdT8l42Axxc6m6kNwI MAANkj30tnFvmoh7FsjVFr+cmcs 2014-12-17 23:57:03 1.2.3.4 9001 9030
+a [2001:db8::1]:9001
+s Fast Guard Running Stable Valid
+w Bandwidth=123
+p reject 1-65535
+r bar AHhuQ8zFQJdT8l42Axxc6m6kNwJ MAANkj30tnFvmoh7FsjVFr+cmcs 2014-12-17 23:57:03 1.2.3.5 9001 0
+s Fast
+r baz AHhuQ8zFQJdT8l42Axxc6m6kNwK MAANkj30tnFvmoh7FsjVFr+cmcs 2014-12-17 23:57:03 1.2.3.6 9001 0
+s Fast
+w Bandwidth=1
+.
+OK''')
+        self.assertEqual([kind for (kind, line) in self.target.calls],
+                         ['r', 'a', 's', 'w', 'p', 'r', 's', 'r', 's', 'w'])
+        self.assertEqual(self.parser.state, 'waiting_r')
+
+    def test_missing_flags(self):
+        self.feed('r foo AHhuQ8zFQJdT8l42Axxc6m6kNwI MAANkj30tnFvmoh7FsjVFr+cmcs 2014-12-17 23:57:03 1.2.3.4 9001 9030')
+        try:
+            self.parser.process('w Bandwidth=123')
+            self.fail()
+        except RuntimeError, e:
+            self.assertEqual(str(e), 'Expected "s " while parsing routers not "w Bandwidth=123"')
+
+    def test_garbage(self):
+        self.assertRaises(RuntimeError, self.parser.process, 's Fast')
+        self.assertRaises(RuntimeError, self.parser.process, 'x')
+        self.assertEqual(self.target.calls, [])
+
+    def test_dotty(self):
+        dot = self.parser.dotty()
+        self.assertTrue(dot.startswith('digraph'))
+        self.assertTrue('waiting_s -> waiting_w [label="s"]' in dot)
+
+
+class MicrodescConsensusParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.target = Recorder()
+        self.parser = ConsensusParser(self.target, flavor='microdesc')
+
+    def feed(self, text):
+        for line in text.split('\n'):
+            self.parser.process(line)
+
+    def test_routers(self):
+        self.feed('''dir/status-vote/current/consensus-microdesc=
+network-status-version 3 microdesc
+valid-after 2014-12-18 00:00:00
+known-flags Exit Fast Guard Running Stable Valid
+r foo AHhuQ8zFQJdT8l42Axxc6m6kNwI 2014-12-17 23:57:03 1.2.3.4 9001 9030
+a [2001:db8::1]:9001
+s Fast Guard Running Stable Valid
+v Tor 0.2.5.10
+pr Cons=1-2 Link=1-4
+w Bandwidth=123
+m Yf7lC6rUr8EIXN7jJ5X+fmhFCyvCjXZ4ieKl6fgOSgM
+r bar AHhuQ8zFQJdT8l42Axxc6m6kNwJ 2014-12-17 23:57:03 1.2.3.5 9001 0
+s Fast
+m Yf7lC6rUr8EIXN7jJ5X+fmhFCyvCjXZ4ieKl6fgOSgN
+directory-footer
+bandwidth-weights Wgg=10000
+directory-signature 0000000000000000000000000000000000000000 0000000000000000000000000000000000000000
+-----BEGIN SIGNATURE-----
+AAAA
+-----END SIGNATURE-----
+.
+OK''')
+        self.assertEqual([kind for (kind, line) in self.target.calls],
+                         ['r', 'a', 's', 'w', 'm', 'r', 's', 'm'])
+        self.assertEqual(self.parser.state, 'waiting_r')
+
+    def test_missing_microdesc(self):
+        self.feed('''r foo AHhuQ8zFQJdT8l42Axxc6m6kNwI 2014-12-17 23:57:03 1.2.3.4 9001 9030
+s Fast
+w Bandwidth=123''')
+        self.assertRaises(RuntimeError, self.parser.process, 'directory-footer')
+
+    def test_unknown_flavor(self):
+        self.assertRaises(ValueError, ConsensusParser, self.target, flavor='unflavored')
@@ -0,0 +1,105 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txtorcon import events
+from txtorcon.events import decoder_for, BandwidthAggregator
+
+
+class DecoderTests(unittest.TestCase):
+
+    def test_circ(self):
+        e = decoder_for('CIRC')('365 BUILT $E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris,$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus PURPOSE=GENERAL')
+        self.assertTrue(isinstance(e, events.CircuitEvent))
+        self.assertEqual(e.id, 365)
+        self.assertEqual(e.status, 'BUILT')
+        self.assertEqual(len(e.path), 2)
+        self.assertEqual(e.path[1], '$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus')
+        self.assertEqual(e.flags, {'PURPOSE': 'GENERAL'})
+        self.assertEqual(e.args[0], '365')
+
+    def test_circ_no_path(self):
+        e = decoder_for('CIRC')('365 LAUNCHED PURPOSE=GENERAL')
+        self.assertEqual(e.path, [])
+
+    def test_stream(self):
+        e = decoder_for('STREAM')('1610 SUCCEEDED 12 74.125.224.243:80 SOURCE_ADDR=127.0.0.1:54327')
+        self.assertEqual(e.id, 1610)
+        self.assertEqual(e.status, 'SUCCEEDED')
+        self.assertEqual(e.circuit_id, 12)
+        self.assertEqual(e.target, '74.125.224.243:80')
+        self.assertEqual(e.flags['SOURCE_ADDR'], '127.0.0.1:54327')
+
+    def test_bw(self):
+        e = decoder_for('BW')('1024 2048')
+        self.assertEqual((e.read, e.written), (1024, 2048))
+
+    def test_circ_bw(self):
+        e = decoder_for('CIRC_BW')('ID=12 READ=100 WRITTEN=200')
+        self.assertEqual((e.id, e.read, e.written), (12, 100, 200))
+
+    def test_stream_bw(self):
+        e = decoder_for('STREAM_BW')('1610 200 100')
+        self.assertEqual((e.id, e.read, e.written), (1610, 100, 200))
+
+    def test_conn_bw(self):
+        e = decoder_for('CONN_BW')('ID=7 TYPE=OR READ=10 WRITTEN=20')
+        self.assertEqual((e.id, e.type, e.read, e.written), (7, 'OR', 10, 20))
+
+    def test_orconn(self):
+        e = decoder_for('ORCONN')('$AAAA~foo CONNECTED NCIRCS=2')
+        self.assertEqual(e.target, '$AAAA~foo')
+        self.assertEqual(e.status, 'CONNECTED')
+        self.assertEqual(e.flags, {'NCIRCS': '2'})
+
+    def test_unknown(self):
+        e = decoder_for('NOTICE')('hello there')
+        self.assertEqual(e, events.UnknownEvent('NOTICE', 'hello there'))
+
+
+class AggregatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.batches = []
+
+    def test_bw(self):
+        agg = BandwidthAggregator('BW', self.batches.append, 60, self.clock)
+        agg('100 200')
+        agg('1 2')
+        self.clock.advance(59)
+        self.assertEqual(self.batches, [])
+        agg('10 20')
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [{None: (111, 222)}])
+
+    def test_per_id(self):
+        agg = BandwidthAggregator('CIRC_BW', self.batches.append, 1, self.clock)
+        agg('ID=1 READ=5 WRITTEN=6')
+        agg('ID=2 READ=1 WRITTEN=1')
+        agg('ID=1 READ=5 WRITTEN=4')
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [{1: (10, 10), 2: (1, 1)}])
+
+    def test_stream_bw(self):
+        agg = BandwidthAggregator('STREAM_BW', self.batches.append, 1, self.clock)
+        agg('12 100 5')
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [{12: (5, 100)}])
+
+    def test_idle(self):
+        agg = BandwidthAggregator('CONN_BW', self.batches.append, 1, self.clock)
+        agg('ID=1 TYPE=OR READ=5 WRITTEN=6')
+        self.clock.advance(1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(10)
+        self.assertEqual(len(self.batches), 1)
+
+    def test_stop(self):
+        agg = BandwidthAggregator('BW', self.batches.append, 1, self.clock)
+        agg('1 1')
+        agg.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(agg.totals, {})
+
+    def test_not_bandwidth(self):
+        self.assertRaises(ValueError, BandwidthAggregator, 'CIRC', self.batches.append, 1, self.clock)
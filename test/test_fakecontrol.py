@@ -0,0 +1,169 @@
+from zope.interface import implements
+from twisted.trial import unittest
+from twisted.test import iosim
+from twisted.internet import task
+from twisted.internet.interfaces import IReactorCore
+
+from txtorcon import TorControlProtocol, TorState
+from txtorcon.interface import IStreamAttacher
+from txtorcon.fakecontrol import FakeTorControlFactory, synthetic_consensus
+
+
+class FakeReactor(task.Clock):
+    implements(IReactorCore)
+
+    def addSystemEventTrigger(self, *args):
+        return 1
+
+    def removeSystemEventTrigger(self, id):
+        pass
+
+
+class ConsensusTests(unittest.TestCase):
+
+    def test_repeatable(self):
+        self.assertEqual(synthetic_consensus(10, seed=1), synthetic_consensus(10, seed=1))
+        self.assertNotEqual(synthetic_consensus(10, seed=1), synthetic_consensus(10, seed=2))
+
+    def test_routers(self):
+        routers = synthetic_consensus(50)
+        self.assertEqual(len(routers), 50)
+        self.assertEqual(len(set(r['name'] for r in routers)), 50)
+        self.assertTrue(all(len(r['id']) == 20 for r in routers))
+
+
+class FakeControlTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeReactor()
+        self.factory = FakeTorControlFactory(routers=20, password='secret', reactor=self.clock)
+
+    def connect(self, password='secret'):
+        server = self.factory.buildProtocol(None)
+        client = TorControlProtocol(lambda: password)
+        self.pump = iosim.connect(server, iosim.FakeTransport(server, isServer=True),
+                                  client, iosim.FakeTransport(client, isServer=False))
+        return client
+
+    def test_bootstrap_state(self):
+        proto = self.connect()
+        state = TorState(proto)
+        self.pump.flush()
+        self.assertEqual(proto.version, '0.2.5.10 (fake)')
+        self.assertTrue(self.successResultOf(state.post_bootstrap) is state)
+        self.assertEqual(len(state.routers_by_hash), 20)
+
+    def test_bootstrap_microdescriptors(self):
+        proto = self.connect()
+        state = TorState(proto, microdescriptors=True)
+        self.pump.flush()
+        self.assertTrue(self.successResultOf(state.post_bootstrap) is state)
+        self.assertEqual(len(state.routers_by_hash), 20)
+        exits = set(r for r in state.all_routers if r.has_flag('exit'))
+        for router in state.all_routers:
+            self.assertEqual(router.or_hash, None)
+            self.assertEqual(router.microdescriptor.digest, router.md_digest)
+            self.assertEqual(len(router.microdescriptor.ntor_onion_key), 32)
+        self.assertEqual(state.routers_where(port=80), exits)
+        first = state.routers['fake0']
+        second = state.routers['fake1']
+        self.assertEqual(state.router_family(first), [second])
+        self.assertEqual(state.router_family(second), [first])
+        self.assertEqual(state.router_family(state.routers['fake2']), [])
+
+    def test_wrong_password(self):
+        proto = self.connect('wrong')
+        self.pump.flush()
+        self.failureResultOf(proto.post_bootstrap)
+        self.assertEqual(self.factory.connections, [])
+
+    def test_cookie(self):
+        self.factory = FakeTorControlFactory(routers=1, cookie_file=self.mktemp(), reactor=self.clock)
+        server = self.factory.buildProtocol(None)
+        server.makeConnection(iosim.FakeTransport(server, isServer=True))
+        written = []
+        server.transport.write = written.append
+        server.lineReceived('AUTHENTICATE ' + ('00' * 32))
+        self.assertTrue(written[-1].startswith('515 '))
+        server = self.factory.buildProtocol(None)
+        server.makeConnection(iosim.FakeTransport(server, isServer=True))
+        server.transport.write = written.append
+        server.lineReceived('PROTOCOLINFO 1')
+        self.assertTrue('COOKIEFILE="%s"' % self.factory.cookie_file in written[-1])
+        server.lineReceived('AUTHENTICATE ' + self.factory.cookie.encode('hex'))
+        self.assertEqual(written[-1], '250 OK\r\n')
+
+    def test_unauthenticated(self):
+        server = self.factory.buildProtocol(None)
+        server.makeConnection(iosim.FakeTransport(server, isServer=True))
+        written = []
+        server.transport.write = written.append
+        server.lineReceived('GETINFO version')
+        self.assertEqual(written, ['514 Authentication required.\r\n'])
+
+    def test_commands(self):
+        proto = self.connect()
+        self.pump.flush()
+        results = []
+
+        def command(cmd):
+            proto.queue_command(cmd).addBoth(results.append)
+            self.pump.flush()
+            return str(results[-1])
+
+        self.assertEqual(command('EXTENDCIRCUIT 0 fake1,fake2'), 'EXTENDED 1')
+        self.assertEqual(self.factory.circuits[1][0], 'BUILT')
+        self.assertTrue('Unknown circuit' in command('EXTENDCIRCUIT 99 fake1'))
+        self.assertTrue('No such router' in command('EXTENDCIRCUIT 0 nonesuch'))
+        self.assertEqual(command('SETCONF SocksPort=9999'), 'OK')
+        self.assertEqual(command('GETCONF SocksPort'), 'SocksPort=9999')
+        self.assertTrue('Unknown stream' in command('ATTACHSTREAM 123 1'))
+        self.assertTrue('Unrecognized command' in command('FOO'))
+        self.assertTrue('Unrecognized key' in command('GETINFO foo'))
+        self.assertTrue('Unrecognized event' in command('SETEVENTS FOO'))
+        self.assertEqual(command('CLOSECIRCUIT 1'), 'OK')
+        self.assertEqual(self.factory.circuits, {})
+
+    def test_flood(self):
+        proto = self.connect()
+        state = TorState(proto)
+        self.pump.flush()
+        bandwidth = []
+        proto.add_event_listener('BW', bandwidth.append)
+        self.pump.flush()
+
+        self.factory.max_circuits = 5
+        self.factory.start_flood(300, interval=0.1)
+        for x in range(10):
+            self.clock.advance(0.1)
+            self.pump.flush()
+        self.factory.stop_flood()
+
+        self.assertEqual(self.factory._flood, None)
+        ## 30 events per tick, 11 ticks (LoopingCall runs right away)
+        self.assertEqual(len(bandwidth), 110)
+        self.assertEqual(len(self.factory.circuits), 5)
+        self.assertEqual(sorted(state.circuits.keys()), sorted(self.factory.circuits.keys()))
+        self.assertEqual(sorted(state.streams.keys()), sorted(self.factory.streams.keys()))
+
+    def test_attacher_latency(self):
+        proto = self.connect()
+        state = TorState(proto)
+        self.pump.flush()
+
+        class Attacher(object):
+            implements(IStreamAttacher)
+
+            def attach_stream(self, stream, circuits):
+                return circuits.values()[0]
+        circid = self.factory.build_circuit()
+        self.pump.flush()
+        state.set_attacher(Attacher(), self.clock)
+        self.pump.flush()
+        self.assertEqual(self.factory.conf['__LeaveStreamsUnattached'], '1')
+
+        streamid = self.factory.new_stream()
+        self.clock.advance(0.25)
+        self.pump.flush()
+        self.assertEqual(self.factory.streams[streamid][:2], ('SUCCEEDED', circid))
+        self.assertEqual(self.factory.attach_latencies, [0.25])
@@ -2,7 +2,37 @@ from twisted.trial import unittest
 
 from txtorcon import log
 
+from StringIO import StringIO
+
 
 class LoggingTests(unittest.TestCase):
     def test_debug(self):
         log.debug_logging()
+
+
+class DebugLogTests(unittest.TestCase):
+
+    def test_file(self):
+        f = StringIO()
+        debuglog = log.DebugLog(f)
+        debuglog.command_sent('GETINFO version')
+        debuglog.line_received('250-version=0.2.5.10')
+        debuglog.line_received('250 OK')
+        self.assertEqual(f.getvalue(), 'GETINFO version\n250-version=0.2.5.10\n250 OK\n')
+
+    def test_ring_buffer(self):
+        now = [0]
+
+        def clock():
+            now[0] += 1
+            return now[0]
+        debuglog = log.RingBufferLog(size=2, clock=clock)
+        debuglog.command_sent('GETINFO version')
+        debuglog.line_received('250-version=0.2.5.10')
+        debuglog.line_received('250 OK')
+        self.assertEqual(list(debuglog.entries), [(2, '<', '250-version=0.2.5.10'),
+                                                  (3, '<', '250 OK')])
+
+        f = StringIO()
+        debuglog.dump(f)
+        self.assertEqual(f.getvalue(), '2.000000 < 250-version=0.2.5.10\n3.000000 < 250 OK\n')
@@ -0,0 +1,82 @@
+import base64
+import hashlib
+
+from twisted.trial import unittest
+
+from txtorcon.microdesc import Microdescriptor, MicrodescriptorParser, microdescriptor_digest
+
+
+MICRODESC = '''onion-key
+-----BEGIN RSA PUBLIC KEY-----
+MIGJAoGBAMhPQtZPaxP3ukybV5LfofKQr20/ljpRk0e9IlGWWMSTkfVvBcHsa6IM
+H2KE6s4uuPHp7FqhakXAzJbODobnPHY8l1E4efyrqMQZXEQk2IMhgSNtG6YqUrVF
+CxdSKSSy0mmcBe2TOyQsahlGZ9Pudxfnrey7KcfqnArEOqNH09RpAgMBAAE=
+-----END RSA PUBLIC KEY-----
+ntor-onion-key Yf7lC6rUr8EIXN7jJ5X+fmhFCyvCjXZ4ieKl6fgOSgM
+a [2001:db8::1]:9001
+family $AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA $BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB~bar
+p accept 80,443
+p6 accept 443
+id ed25519 dGVzdHRlc3R0ZXN0dGVzdHRlc3R0ZXN0dGVzdHRlc3Q
+'''
+
+
+class MicrodescriptorTests(unittest.TestCase):
+
+    def test_digest(self):
+        md = Microdescriptor(MICRODESC)
+        self.assertEqual(md.digest, base64.b64encode(hashlib.sha256(MICRODESC).digest()).rstrip('='))
+        self.assertEqual(md.digest, microdescriptor_digest(MICRODESC))
+        self.assertEqual(Microdescriptor(MICRODESC, digest='foo').digest, 'foo')
+
+    def test_lazy(self):
+        md = Microdescriptor(MICRODESC)
+        self.assertEqual(md.policy, 'accept 80,443')
+        self.assertEqual(md._fields, None)
+        self.assertEqual(len(md.family), 2)
+        self.assertNotEqual(md._fields, None)
+
+    def test_fields(self):
+        md = Microdescriptor(MICRODESC)
+        self.assertEqual(len(md.onion_key), 140)
+        self.assertEqual(len(md.ntor_onion_key), 32)
+        self.assertEqual(md.ed25519_id, 'test' * 8)
+        self.assertEqual(md.family, ('$AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+                                     '$BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB~bar'))
+        self.assertEqual(md.policy6, 'accept 443')
+        self.assertEqual(md.ip_v6, ('[2001:db8::1]:9001',))
+
+    def test_minimal(self):
+        md = Microdescriptor('onion-key\nntor-onion-key Yf7lC6rUr8EIXN7jJ5X+fmhFCyvCjXZ4ieKl6fgOSgM\n')
+        self.assertEqual(md.onion_key, None)
+        self.assertEqual(md.ed25519_id, None)
+        self.assertEqual(md.family, ())
+        self.assertEqual(md.policy, 'reject 1-65535')
+        self.assertEqual(md.policy6, 'reject 1-65535')
+        self.assertEqual(md.ip_v6, ())
+        self.assertEqual(Microdescriptor('onion-key\n').ntor_onion_key, None)
+        self.assertEqual(Microdescriptor('onion-key\np accept 80').policy, 'accept 80')
+
+    def test_repr(self):
+        md = Microdescriptor(MICRODESC, digest='foo')
+        self.assertEqual(repr(md), '<Microdescriptor foo>')
+
+
+class MicrodescriptorParserTests(unittest.TestCase):
+
+    def test_parse(self):
+        parser = MicrodescriptorParser()
+        lines = ['md/all='] + MICRODESC.split('\n') + ['onion-key', 'p accept 22', '.']
+        for line in lines:
+            parser.process(line)
+        mds = parser.finish()
+        self.assertEqual(len(mds), 2)
+        self.assertEqual(mds[0].text, MICRODESC)
+        self.assertEqual(mds[0].digest, microdescriptor_digest(MICRODESC))
+        self.assertEqual(mds[1].text, 'onion-key\np accept 22\n')
+        self.assertEqual(mds[1].policy, 'accept 22')
+
+    def test_empty(self):
+        parser = MicrodescriptorParser()
+        parser.process('md/all=')
+        self.assertEqual(parser.finish(), [])
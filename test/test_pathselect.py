@@ -0,0 +1,134 @@
+import random
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from zope.interface import implements
+from zope.interface.verify import verifyObject
+
+from txtorcon import TorState
+from txtorcon.interface import IRouterListener, ITorControlProtocol
+from txtorcon.pathselect import PathSelector, subnet
+
+
+class FakeControlProtocol:
+    implements(ITorControlProtocol)
+
+    def __init__(self):
+        self.post_bootstrap = defer.succeed(self)
+        self.on_disconnect = defer.Deferred()
+
+
+def router_lines(name, ip, flags, bandwidth, policy='reject 1-65535'):
+    digest = name.ljust(20, 'x').encode('base64')[:27]
+    return ['r %s %s MAANkj30tnFvmoh7FsjVFr+cmcs 2014-12-17 23:57:03 %s 9001 0' % (name, digest, ip),
+            's ' + flags,
+            'w Bandwidth=%d' % bandwidth,
+            'p ' + policy]
+
+
+CONSENSUS = '\n'.join(
+    router_lines('guard1', '10.1.0.1', 'Fast Guard Running Stable Valid', 1000) +
+    router_lines('guard2', '10.2.0.1', 'Fast Guard Running Stable Valid', 3000) +
+    router_lines('middle1', '10.3.0.1', 'Fast Running Valid', 2000) +
+    router_lines('middle2', '10.1.0.2', 'Fast Running Valid', 2000) +
+    router_lines('exit1', '10.4.0.1', 'Exit Fast Running Valid', 1000, 'accept 80,443') +
+    router_lines('exit2', '10.5.0.1', 'Exit Fast Running Valid', 1000, 'accept 80') +
+    router_lines('badexit', '10.6.0.1', 'BadExit Exit Fast Running Valid', 9000, 'accept 80,443') +
+    router_lines('slow', '10.7.0.1', 'Running Valid', 9000))
+
+
+class PathSelectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.state = TorState(FakeControlProtocol(), bootstrap=False)
+        self.state._update_network_status(CONSENSUS)
+        self.selector = self.state.path_selector
+        self.selector.random = random.Random(0)
+
+    def names(self, routers):
+        return [r.name for r in routers]
+
+    def counts(self, role, tries=4000, **kw):
+        counts = {}
+        for x in range(tries):
+            name = self.selector.choose(role, **kw).name
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(IRouterListener, self.selector))
+
+    def test_subnet(self):
+        self.assertEqual(subnet(self.state.routers['guard1']), '10.1')
+        self.assertEqual(subnet(self.state.routers['middle2']), '10.1')
+
+    def test_roles(self):
+        self.assertEqual(sorted(self.counts('guard')), ['guard1', 'guard2'])
+        self.assertEqual(sorted(self.counts('middle')),
+                         ['badexit', 'exit1', 'exit2', 'guard1', 'guard2', 'middle1', 'middle2'])
+        self.assertEqual(sorted(self.counts('exit')), ['exit1', 'exit2'])
+        self.assertEqual(sorted(self.counts('exit', port=443)), ['exit1'])
+        self.assertRaises(ValueError, self.selector.choose, 'rendezvous')
+
+    def test_weighted(self):
+        counts = self.counts('guard')
+        ## guard2 has three times the bandwidth
+        self.assertTrue(2.5 < counts['guard2'] / float(counts['guard1']) < 3.5)
+
+    def test_exclusions(self):
+        guard1 = self.state.routers['guard1']
+        exit1 = self.state.routers['exit1']
+        for x in range(200):
+            router = self.selector.choose('middle', path=[guard1, exit1])
+            self.assertTrue(router.name not in ('guard1', 'exit1', 'middle2'))
+
+    def test_family(self):
+        families = {'middle1': ['guard2'], 'guard2': ['middle1']}
+        self.selector.family = lambda r: [self.state.routers[n] for n in families.get(r.name, [])]
+        guard2 = self.state.routers['guard2']
+        exit1 = self.state.routers['exit1']
+        for x in range(200):
+            router = self.selector.choose('middle', path=[guard2, exit1])
+            self.assertTrue(router.name in ('guard1', 'middle2', 'exit2', 'badexit'))
+
+    def test_nothing_left(self):
+        path = [self.state.routers['exit1'], self.state.routers['exit2']]
+        self.assertRaises(RuntimeError, self.selector.choose, 'exit', path=path)
+
+    def test_random_path(self):
+        for x in range(100):
+            path = self.state.random_path(length=4, exit_port=443)
+            self.assertEqual(len(path), 4)
+            self.assertEqual(len(set(subnet(r) for r in path)), 4)
+            self.assertTrue(path[0].name.startswith('guard'))
+            self.assertEqual(path[-1].name, 'exit1')
+        self.assertRaises(ValueError, self.state.random_path, length=1)
+
+    def test_entry_guards(self):
+        self.state.entry_guards['$' + 'x' * 40] = self.state.routers['guard1']
+        for x in range(50):
+            self.assertEqual(self.state.random_path()[0].name, 'guard1')
+        self.assertTrue(self.state.random_path(using_guards=False)[0].name.startswith('guard'))
+
+    def test_rebuilt_on_change(self):
+        self.assertEqual(sorted(self.counts('exit', port=443)), ['exit1'])
+        self.state._update_network_status(CONSENSUS.replace('accept 80\n', 'accept 443\n'))
+        self.assertEqual(sorted(self.counts('exit', port=443)), ['exit1', 'exit2'])
+        self.state._update_network_status(CONSENSUS.replace('BadExit ', ''))
+        self.assertEqual(sorted(self.counts('exit', port=443)), ['badexit', 'exit1'])
+
+    def test_tables_kept(self):
+        self.selector.choose('middle')
+        table = self.selector._tables['middle', None]
+        self.state._update_network_status(CONSENSUS.replace('2014-12-17', '2014-12-18'))
+        self.selector.choose('middle')
+        self.assertTrue(self.selector._tables['middle', None] is table)
+
+    def test_no_bandwidth(self):
+        self.state._update_network_status(CONSENSUS.replace('Bandwidth=1000', 'Bandwidth=0')
+                                                   .replace('Bandwidth=3000', 'Bandwidth=0'))
+        self.assertEqual(sorted(self.counts('guard', tries=200)), ['guard1', 'guard2'])
+
+    def test_standalone(self):
+        selector = PathSelector(self.state)
+        self.assertTrue(selector.choose('exit').name in ('exit1', 'exit2'))
@@ -0,0 +1,137 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.internet.interfaces import IStreamClientEndpoint
+from zope.interface import implements
+
+from txtorcon import TorControlProtocol, TorControlPool, ITorControlProtocol
+from txtorcon import TorState, TorProtocolFactory, build_tor_connection, PRIORITY_BULK
+from txtorcon.pool import connect_pool
+
+
+def make_protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    transport = proto_helpers.StringTransport()
+    proto.makeConnection(transport)
+    return proto
+
+
+class FakeEndpoint(object):
+    """
+    Hands out connected TorControlProtocols; the test fires their
+    post_bootstrap.
+    """
+    implements(IStreamClientEndpoint)
+
+    def __init__(self):
+        self.protocols = []
+
+    def connect(self, factory):
+        proto = factory.buildProtocol(None)
+        proto.connectionMade = lambda: None
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.protocols.append(proto)
+        return defer.succeed(proto)
+
+
+class PoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.primary = make_protocol()
+        self.secondary = make_protocol()
+        self.pool = TorControlPool(self.primary, [self.secondary])
+
+    def test_interface(self):
+        self.assertTrue(ITorControlProtocol.providedBy(self.pool))
+        self.assertTrue(ITorControlProtocol(self.pool) is self.pool)
+
+    def test_delegates(self):
+        self.assertTrue(self.pool.post_bootstrap is self.primary.post_bootstrap)
+        self.primary.valid_signals = ['NEWNYM']
+        self.pool.signal('NEWNYM')
+        self.assertEqual(self.primary.transport.value(), 'SIGNAL NEWNYM\r\n')
+
+    def test_interactive_on_primary(self):
+        self.pool.get_info('version')
+        self.pool.get_conf_raw('SOCKSPort')
+        self.pool.queue_command('GETINFO config-file')
+        self.assertEqual(self.primary.transport.value(), 'GETINFO version\r\n')
+        self.assertEqual(len(self.primary.commands), 2)
+        self.assertEqual(self.secondary.transport.value(), '')
+
+    def test_bulk_on_secondary(self):
+        results = []
+        self.pool.get_info_incremental('ns/all', results.append)
+        self.pool.get_info_raw('desc/all-recent')
+        self.pool.queue_command('GETINFO md/all', priority=PRIORITY_BULK)
+        self.assertEqual(self.primary.transport.value(), '')
+        self.assertEqual(self.secondary.transport.value(), 'GETINFO ns/all\r\n')
+        self.assertEqual(len(self.secondary.commands), 2)
+
+        ## the primary isn't held up behind them
+        d = self.pool.queue_command('ATTACHSTREAM 1 2')
+        self.assertEqual(self.primary.transport.value(), 'ATTACHSTREAM 1 2\r\n')
+        self.primary.dataReceived('250 OK\r\n')
+        self.assertTrue(d.called)
+
+    def test_bulk_writes_on_primary(self):
+        self.pool.queue_command('SETCONF Foo=bar', priority=PRIORITY_BULK)
+        self.assertEqual(self.primary.transport.value(), 'SETCONF Foo=bar\r\n')
+
+    def test_mixed_keys_on_primary(self):
+        self.pool.get_info_raw('ns/all', 'version')
+        self.assertEqual(self.primary.transport.value(), 'GETINFO ns/all version\r\n')
+
+    def test_least_busy(self):
+        other = make_protocol()
+        self.pool.add_secondary(other)
+        self.pool.get_info_raw('ns/all')
+        self.pool.get_info_raw('md/all')
+        self.assertEqual(self.secondary.transport.value(), 'GETINFO ns/all\r\n')
+        self.assertEqual(other.transport.value(), 'GETINFO md/all\r\n')
+
+    def test_secondary_lost(self):
+        self.secondary.connectionLost(failure.Failure(RuntimeError('gone')))
+        self.assertEqual(self.pool.secondaries, [])
+        self.pool.get_info_raw('ns/all')
+        self.assertEqual(self.primary.transport.value(), 'GETINFO ns/all\r\n')
+
+    def test_torstate(self):
+        state = TorState(self.pool, bootstrap=False)
+        self.assertTrue(state.protocol is self.pool)
+
+
+class ConnectPoolTests(unittest.TestCase):
+
+    def test_connect(self):
+        endpoint = FakeEndpoint()
+        d = connect_pool(endpoint, TorProtocolFactory(), 3)
+        self.assertEqual(len(endpoint.protocols), 3)
+        self.assertFalse(d.called)
+        for proto in endpoint.protocols:
+            proto.post_bootstrap.callback(proto)
+        pool = self.successResultOf(d)
+        self.assertTrue(pool.primary is endpoint.protocols[0])
+        self.assertEqual(pool.secondaries, endpoint.protocols[1:])
+
+    def test_connect_failed(self):
+        endpoint = FakeEndpoint()
+        d = connect_pool(endpoint, TorProtocolFactory(), 3)
+        (first, second, third) = endpoint.protocols
+        first.post_bootstrap.callback(first)
+        second.post_bootstrap.errback(RuntimeError('bad password'))
+        third.post_bootstrap.callback(third)
+        self.assertTrue(first.transport.disconnecting)
+        self.assertTrue(third.transport.disconnecting)
+        f = self.failureResultOf(d, RuntimeError)
+        self.assertEqual(str(f.value), 'bad password')
+
+    def test_build_tor_connection(self):
+        endpoint = FakeEndpoint()
+        d = build_tor_connection(endpoint, build_state=False, connections=2)
+        for proto in endpoint.protocols:
+            proto.post_bootstrap.callback(proto)
+        pool = self.successResultOf(d)
+        self.assertTrue(isinstance(pool, TorControlPool))
@@ -0,0 +1,116 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.python import failure
+from zope.interface import implements
+
+from txtorcon import TorReconnector, TorState
+
+
+class FakeEndpoint(object):
+    """
+    Hands out TorControlProtocols on StringTransports; the test
+    bootstraps them with bootstrap().
+    """
+    implements(IStreamClientEndpoint)
+
+    def __init__(self):
+        self.protocols = []
+        self.refuse = False
+
+    def connect(self, factory):
+        if self.refuse:
+            return defer.fail(ConnectionRefusedError())
+        proto = factory.buildProtocol(None)
+        proto.connectionMade = lambda: None
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto._set_valid_events('STREAM CIRC NS NEWCONSENSUS ADDRMAP')
+        self.protocols.append(proto)
+        return defer.succeed(proto)
+
+
+def answer_everything(proto, valid_after='2014-01-01 00:00:00'):
+    """
+    Answers every command proto sends until it stops sending them;
+    everything gets "250 OK" except consensus/valid-after.
+    """
+
+    while proto.in_flight:
+        cmd = proto.in_flight[0][1]
+        if cmd == 'GETINFO consensus/valid-after':
+            proto.dataReceived('250-consensus/valid-after=%s\r\n250 OK\r\n' % valid_after)
+        else:
+            proto.dataReceived('250 OK\r\n')
+
+
+def disconnect(proto):
+    proto.connectionLost(failure.Failure(ConnectionDone()))
+
+
+class ReconnectTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.endpoint = FakeEndpoint()
+        self.reconnector = TorReconnector(self.endpoint, reactor=self.clock,
+                                          initial_delay=1, max_delay=4)
+
+    def start(self):
+        d = self.reconnector.start()
+        proto = self.endpoint.protocols[-1]
+        proto.post_bootstrap.callback(proto)
+        answer_everything(proto)
+        return self.successResultOf(d)
+
+    def test_start(self):
+        state = self.start()
+        self.assertTrue(isinstance(state, TorState))
+        self.assertEqual(state.consensus_valid_after, '2014-01-01 00:00:00')
+        self.assertTrue(self.reconnector.state is state)
+
+    def test_reconnect_resync(self):
+        state = self.start()
+        resynced = []
+        self.reconnector.add_resync_listener(resynced.append)
+        first = self.endpoint.protocols[0]
+        disconnect(first)
+        self.assertEqual(len(self.endpoint.protocols), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.endpoint.protocols), 2)
+
+        proto = self.endpoint.protocols[1]
+        proto.post_bootstrap.callback(proto)
+        answer_everything(proto)
+        self.assertTrue(state.protocol is proto)
+        self.assertEqual(resynced, [state])
+        ## same consensus, so no ns/all
+        self.assertFalse('GETINFO ns/all' in proto.transport.value())
+        self.assertTrue('GETINFO circuit-status' in proto.transport.value())
+        self.assertTrue(proto.transport.value().startswith('SETEVENTS '))
+
+    def test_backoff(self):
+        self.start()
+        self.endpoint.refuse = True
+        disconnect(self.endpoint.protocols[0])
+        delays = []
+        for x in range(4):
+            self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+            delays.append(self.clock.getDelayedCalls()[0].getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4, 4])
+
+        self.endpoint.refuse = False
+        self.clock.advance(4)
+        proto = self.endpoint.protocols[-1]
+        proto.post_bootstrap.callback(proto)
+        answer_everything(proto)
+        self.assertEqual(self.reconnector.delay, 1)
+
+    def test_stop(self):
+        self.start()
+        self.endpoint.refuse = True
+        disconnect(self.endpoint.protocols[0])
+        self.reconnector.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -1,7 +1,7 @@
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from txtorcon.router import Router, hexIdFromHash, hashFromHexId
+from txtorcon.router import Router, hexIdFromHash, hashFromHexId, flag_mask, flags_from_mask
 
 
 class FakeController(object):
@@ -148,3 +148,39 @@ class RouterTests(unittest.TestCase):
     def test_repr_no_update(self):
         router = Router(FakeController())
         repr(router)
+
+    def test_compact(self):
+        router = Router(object())
+        router.update("foo",
+                      "AHhuQ8zFQJdT8l42Axxc6m6kNwI",
+                      "MAANkj30tnFvmoh7FsjVFr+cmcs",
+                      "2011-12-16 15:11:34",
+                      "1.2.3.4",
+                      "24051", "24052")
+        self.assertFalse(hasattr(router, '__dict__'))
+        self.assertEqual(router.or_port, 24051)
+        self.assertEqual(router.dir_port, 24052)
+        self.assertEqual(router.id_hash, 'AHhuQ8zFQJdT8l42Axxc6m6kNwI')
+        self.assertEqual(router.id_digest, '00786E43CCC5409753F25E36031C5CEA6EA43702'.decode('hex'))
+        self.assertEqual(router.or_hash, 'MAANkj30tnFvmoh7FsjVFr+cmcs')
+        self.assertEqual(router.ip_v6, ())
+
+    def test_flag_mask(self):
+        router = Router(object())
+        router.flags = 'Running Fast Guard SomethingNew'
+        self.assertEqual(router.flags, ('fast', 'guard', 'running', 'somethingnew'))
+        self.assertTrue('guard' in router.flags)
+        self.assertTrue(router.has_flag('Guard'))
+        self.assertFalse(router.has_flag('exit'))
+        self.assertTrue(router.flag_mask & flag_mask('guard'))
+        self.assertEqual(router.flag_mask, flag_mask(['somethingnew', 'guard', 'fast', 'running']))
+        self.assertTrue(flags_from_mask(router.flag_mask) is router.flags)
+        self.assertFalse(router.name_is_unique)
+
+    def test_shared_policy(self):
+        routers = [Router(object()), Router(object())]
+        for router in routers:
+            router.policy = 'reject 1-65535'
+        self.assertTrue(routers[0].rejected_ports is routers[1].rejected_ports)
+        self.assertEqual(routers[0].accepted_ports, None)
+        self.assertFalse(routers[0].accepts_port(80))
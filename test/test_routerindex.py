@@ -0,0 +1,123 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from zope.interface import implements
+from zope.interface.verify import verifyObject
+
+from txtorcon import TorState
+from txtorcon.interface import IRouterListener, ITorControlProtocol
+from txtorcon.routerindex import RouterIndex, bandwidth_bucket
+
+
+class FakeControlProtocol:
+    implements(ITorControlProtocol)
+
+    def __init__(self):
+        self.post_bootstrap = defer.succeed(self)
+        self.on_disconnect = defer.Deferred()
+
+    def get_info_raw(self, key):
+        return defer.Deferred()
+
+
+class FakeLocation(object):
+
+    def __init__(self, countrycode, asn=None):
+        self.countrycode = countrycode
+        self.asn = asn
+
+
+CONSENSUS = """r exit1 YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 10.0.0.1 443 80
+s Exit Fast Running Stable Valid
+w Bandwidth=5000
+p accept 80,443
+r exit2 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 10.0.0.2 9001 0
+s Exit Fast Running Valid
+w Bandwidth=70
+p accept 80
+r guard1 qqqqqqqqqqqqqqqqqqqqqqqqqqo QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 10.0.0.3 9001 0
+s Fast Guard Running Stable Valid
+w Bandwidth=9000
+p reject 1-65535"""
+
+
+class RouterIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.state = TorState(FakeControlProtocol(), bootstrap=False)
+        self.state._update_network_status(CONSENSUS)
+        self.locations = {'exit1': FakeLocation('DE', 'AS1'),
+                          'exit2': FakeLocation('US', 'AS2'),
+                          'guard1': FakeLocation('DE', 'AS1')}
+        for router in self.state.all_routers:
+            router._location = self.locations[router.name]
+
+    def names(self, routers):
+        return sorted(r.name for r in routers)
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(IRouterListener, RouterIndex()))
+
+    def test_bucket(self):
+        self.assertEqual(bandwidth_bucket(0), 0)
+        self.assertEqual(bandwidth_bucket(1), 1)
+        self.assertEqual(bandwidth_bucket(1023), 10)
+        self.assertEqual(bandwidth_bucket(1024), 11)
+
+    def test_everything(self):
+        self.assertEqual(self.names(self.state.routers_where()), ['exit1', 'exit2', 'guard1'])
+
+    def test_flags(self):
+        self.assertEqual(self.names(self.state.routers_where(flags=['exit', 'stable'])), ['exit1'])
+        self.assertEqual(self.names(self.state.routers_where(flags='Fast Running')), ['exit1', 'exit2', 'guard1'])
+        self.assertEqual(self.state.routers_where(flags=['authority']), set())
+
+    def test_port(self):
+        self.assertEqual(self.names(self.state.routers_where(port=443)), ['exit1'])
+        self.assertEqual(self.names(self.state.routers_where(port=80)), ['exit1', 'exit2'])
+        self.assertEqual(self.state.routers_where(port=22), set())
+
+    def test_bandwidth(self):
+        self.assertEqual(self.names(self.state.routers_where(min_bandwidth=5000)), ['exit1', 'guard1'])
+        self.assertEqual(self.names(self.state.routers_where(min_bandwidth=5001)), ['guard1'])
+
+    def test_country(self):
+        self.assertEqual(self.names(self.state.routers_where(flags=['exit'], country='DE')), ['exit1'])
+        self.assertEqual(self.names(self.state.routers_where(asn='AS1')), ['exit1', 'guard1'])
+        self.assertEqual(self.state.routers_where(country='FR'), set())
+
+    def test_country_learned_later(self):
+        self.locations['exit2'].countrycode = None
+        self.assertEqual(self.state.routers_where(country='US'), set())
+        ## e.g. Tor answered an ip-to-country query
+        self.locations['exit2'].countrycode = 'US'
+        self.assertEqual(self.names(self.state.routers_where(country='US')), ['exit2'])
+
+    def test_updates(self):
+        self.state.routers_where(country='DE')
+        self.assertEqual(self.names(self.state.routers_where(port=80)), ['exit1', 'exit2'])
+        self.assertEqual(self.names(self.state.routers_where(min_bandwidth=6000)), ['guard1'])
+        self.state._update_network_status(CONSENSUS.replace('Exit Fast Running Valid', 'Fast Running Stable Valid')
+                                                   .replace('Bandwidth=70', 'Bandwidth=7000')
+                                                   .replace('p accept 80\n', 'p accept 22\n'))
+        self.assertEqual(self.names(self.state.routers_where(flags=['exit'])), ['exit1'])
+        self.assertEqual(self.names(self.state.routers_where(flags=['stable'])), ['exit1', 'exit2', 'guard1'])
+        self.assertEqual(self.names(self.state.routers_where(port=22)), ['exit2'])
+        self.assertEqual(self.names(self.state.routers_where(port=80)), ['exit1'])
+        self.assertEqual(self.names(self.state.routers_where(min_bandwidth=6000)), ['exit2', 'guard1'])
+
+    def test_moved(self):
+        self.state.routers_where(country='DE')
+        router = self.state.routers['exit2']
+        self.state._update_network_status(CONSENSUS.replace('10.0.0.2', '10.0.0.22'))
+        ## the IP changed, so it was looked up again (finding nothing,
+        ## with no GeoIP database)
+        self.assertEqual(self.state.routers_where(country='US'), set())
+        router._location = FakeLocation('FR')
+        self.assertEqual(self.names(self.state.routers_where(country='FR')), ['exit2'])
+
+    def test_removed(self):
+        self.state.routers_where(country='DE')
+        self.state._update_network_status(CONSENSUS.split('\n', 4)[4])
+        self.assertEqual(self.names(self.state.routers_where()), ['exit2', 'guard1'])
+        self.assertEqual(self.names(self.state.routers_where(country='DE')), ['guard1'])
+        self.assertEqual(self.names(self.state.routers_where(port=443)), [])
@@ -5,17 +5,22 @@ from os.path import exists
 from twisted.python import log, failure
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import defer, error
+from twisted.internet import defer, error, task
+from twisted.internet.error import TimeoutError
 
-from txtorcon import TorControlProtocol, TorProtocolFactory, TorState
+from txtorcon import TorControlProtocol, TorProtocolFactory, TorState, TorProtocolError
 from txtorcon import ITorControlProtocol
-from txtorcon.torcontrolprotocol import parse_keywords, DEFAULT_VALUE
+from txtorcon.torcontrolprotocol import parse_keywords, DEFAULT_VALUE, CommandQueue
+from txtorcon.torcontrolprotocol import parse_keywords_lazy, parse_keyword_args, unquote
+from txtorcon.torcontrolprotocol import PRIORITY_URGENT, PRIORITY_INTERACTIVE, PRIORITY_BULK
 from txtorcon.util import hmac_sha256
+from txtorcon.log import RingBufferLog, DebugLog
 
 import types
 import functools
 import tempfile
 import base64
+from StringIO import StringIO
 
 
 class CallbackChecker:
@@ -33,6 +38,27 @@ class CallbackChecker:
         return v
 
 
+def wait_for_cookie_reads(protocol):
+    """
+    The cookie file is read in a thread; this wraps
+    protocol._read_cookie so that tests can wait on the returned list
+    of Deferreds, each of which fires once the protocol has done
+    whatever it does with the cookie data.
+    """
+
+    reads = []
+    read_cookie = protocol._read_cookie
+
+    def wrapper(cookie):
+        d = read_cookie(cookie)
+        result = defer.Deferred()
+        d.addBoth(result.callback)
+        reads.append(d)
+        return result
+    protocol._read_cookie = wrapper
+    return reads
+
+
 class InterfaceTests(unittest.TestCase):
     def test_implements(self):
         self.assertTrue(ITorControlProtocol.implementedBy(TorControlProtocol))
@@ -74,7 +100,9 @@ class AuthenticationTests(unittest.TestCase):
     def send(self, line):
         self.protocol.dataReceived(line.strip() + "\r\n")
 
+    @defer.inlineCallbacks
     def test_authenticate_cookie(self):
+        reads = wait_for_cookie_reads(self.protocol)
         self.protocol.makeConnection(self.transport)
         self.assertEqual(self.transport.value(), 'PROTOCOLINFO 1\r\n')
         self.transport.clear()
@@ -85,9 +113,31 @@ class AuthenticationTests(unittest.TestCase):
         self.send('250-AUTH METHODS=COOKIE,HASHEDPASSWORD COOKIEFILE="authcookie"')
         self.send('250-VERSION Tor="0.2.2.34"')
         self.send('250 OK')
+        self.assertEqual(self.transport.value(), '')
 
+        yield reads[0]
         self.assertEqual(self.transport.value(), 'AUTHENTICATE %s\r\n' % cookie_data.encode("hex"))
 
+    def test_read_cookie_uses_reactor(self):
+        class FakeThreadPool(object):
+            def callInThreadWithCallback(self, on_result, f, *args):
+                on_result(True, f(*args))
+
+        class ThreadedClock(task.Clock):
+            pool = FakeThreadPool()
+
+            def getThreadPool(self):
+                return self.pool
+
+            def callFromThread(self, f, *args):
+                f(*args)
+
+        with open('authcookie', 'w') as f:
+            f.write('cookiedata!cookiedata!cookiedata')
+        protocol = TorControlProtocol(reactor=ThreadedClock())
+        d = protocol._read_cookie('authcookie')
+        self.assertEqual(self.successResultOf(d), 'cookiedata!cookiedata!cookiedata')
+
     def test_authenticate_password(self):
         self.protocol.password_function = lambda: 'foo'
         self.protocol.makeConnection(self.transport)
@@ -271,35 +321,42 @@ OK''')
         except RuntimeError, e:
             self.assertTrue('find AUTH line' in str(e))
 
+    @defer.inlineCallbacks
     def test_authenticate_not_enough_cookie_data(self):
         with tempfile.NamedTemporaryFile() as cookietmp:
             cookietmp.write('x' * 35)  # too much data
             cookietmp.flush()
 
-            try:
-                self.protocol._do_authenticate('''PROTOCOLINFO 1
+            self.protocol._do_authenticate('''PROTOCOLINFO 1
 AUTH METHODS=COOKIE COOKIEFILE="%s"
 VERSION Tor="0.2.2.35"
 OK''' % cookietmp.name)
-                self.assertTrue(False)
+            try:
+                yield self.protocol.post_bootstrap
+                self.fail()
             except RuntimeError, e:
                 self.assertTrue('cookie to be 32' in str(e))
 
+    @defer.inlineCallbacks
     def test_authenticate_not_enough_safecookie_data(self):
         with tempfile.NamedTemporaryFile() as cookietmp:
             cookietmp.write('x' * 35)  # too much data
             cookietmp.flush()
 
-            try:
-                self.protocol._do_authenticate('''PROTOCOLINFO 1
+            self.protocol._do_authenticate('''PROTOCOLINFO 1
 AUTH METHODS=SAFECOOKIE COOKIEFILE="%s"
 VERSION Tor="0.2.2.35"
 OK''' % cookietmp.name)
-                self.assertTrue(False)
+            try:
+                yield self.protocol.post_bootstrap
+                self.fail()
             except RuntimeError, e:
                 self.assertTrue('cookie to be 32' in str(e))
+            self.assertEqual(self.transport.value(), '')
 
+    @defer.inlineCallbacks
     def test_authenticate_safecookie(self):
+        reads = wait_for_cookie_reads(self.protocol)
         with tempfile.NamedTemporaryFile() as cookietmp:
             cookiedata = str(bytearray([0] * 32))
             cookietmp.write(cookiedata)
@@ -309,6 +366,7 @@ OK''' % cookietmp.name)
 AUTH METHODS=SAFECOOKIE COOKIEFILE="%s"
 VERSION Tor="0.2.2.35"
 OK''' % cookietmp.name)
+            yield reads[0]
             self.assertTrue('AUTHCHALLENGE SAFECOOKIE ' in self.transport.value())
             client_nonce = base64.b16decode(self.transport.value().split()[-1])
             self.transport.clear()
@@ -361,6 +419,26 @@ OK''' % cookietmp.name)
 
         return d
 
+    def test_bootstrap_pipelined(self):
+        d = self.protocol.post_bootstrap
+        d.addCallback(self.confirm_version_events)
+
+        self.protocol._bootstrap()
+        ## nothing waits on anything else, so all three go out at
+        ## once, even with the default pipeline_depth
+        self.assertEqual(self.transport.value(),
+                         'GETINFO version\r\nGETINFO events/names\r\nUSEFEATURE EXTENDED_EVENTS\r\n')
+        self.assertEqual(self.protocol.pipeline_depth, 1)
+        self.protocol.queue_command('GETINFO config-file')
+        self.assertEqual(len(self.protocol.commands), 1)
+
+        self.send("250-version=foo")
+        self.send("250 OK")
+        self.send("250-events/names=GUARD STREAM CIRC NS NEWCONSENSUS ORCONN NEWDESC ADDRMAP STATUS_GENERAL")
+        self.send("250 OK")
+        self.send("250 OK")
+        return d
+
     def test_async(self):
         """
         test the example from control-spec.txt to see that we
@@ -486,6 +564,35 @@ OK''' % cookietmp.name)
         self.protocol.start_debug()
         self.assertTrue(exists('txtorcon-debug.log'))
 
+    def test_debug_file(self):
+        f = StringIO()
+        self.protocol.start_debug(f)
+        self.assertTrue(isinstance(self.protocol.debuglog, DebugLog))
+        self.protocol.get_info_raw('version')
+        self.send("250 version=0.2.5.10")
+        self.assertEqual(f.getvalue(), 'GETINFO version\n250 version=0.2.5.10\n')
+
+    def test_debug_bad_log(self):
+        self.assertRaises(TypeError, self.protocol.start_debug, object())
+
+    def test_debug_ring_buffer(self):
+        debuglog = RingBufferLog(size=10)
+        self.protocol.start_debug(debuglog)
+        d = self.protocol.get_info_raw('version')
+        self.send("250-version=0.2.5.10")
+        self.send("250 OK")
+        self.assertEqual([(x[1], x[2]) for x in debuglog.entries],
+                         [('>', 'GETINFO version'),
+                          ('<', '250-version=0.2.5.10'),
+                          ('<', '250 OK')])
+
+        self.protocol.stop_debug()
+        self.assertEqual(self.protocol.debuglog, None)
+        self.protocol.get_info_raw('version')
+        self.send("250 version=0.2.5.10")
+        self.assertEqual(len(debuglog.entries), 3)
+        return d
+
     def error(self, failure):
         print "ERROR", failure
         self.assertTrue(False)
@@ -597,6 +704,60 @@ OK''' % cookietmp.name)
         self.send("650 STREAM 2345 NEW 4321 2.3.4.5:666 REASON=MISC")
         self.assertEqual(listener.stream_events, 2)
 
+    def test_typed_eventlistener(self):
+        self.protocol._set_valid_events('CIRC')
+        records = []
+        raw = []
+        self.protocol.add_event_listener('CIRC', records.append, typed=True)
+        self.protocol.add_event_listener('CIRC', records.append, typed=True)
+        self.protocol.add_event_listener('CIRC', raw.append)
+        self.send("250 OK")
+        self.send("650 CIRC 1 BUILT $AAAA=a,$BBBB=b PURPOSE=GENERAL")
+        self.assertEqual(raw, ['1 BUILT $AAAA=a,$BBBB=b PURPOSE=GENERAL'])
+        self.assertEqual(len(records), 2)
+        ## parsed just once, for all the typed listeners
+        self.assertTrue(records[0] is records[1])
+        self.assertEqual(records[0].id, 1)
+        self.assertEqual(records[0].path, ['$AAAA=a', '$BBBB=b'])
+
+        self.transport.clear()
+        self.protocol.remove_event_listener('CIRC', raw.append)
+        self.protocol.remove_event_listener('CIRC', records.append)
+        self.assertEqual(self.transport.value(), '')
+        self.protocol.remove_event_listener('CIRC', records.append)
+        self.assertEqual(self.transport.value(), 'SETEVENTS \r\n')
+
+    def test_mixed_listener_order(self):
+        self.protocol._set_valid_events('CIRC')
+        calls = []
+        self.protocol.add_event_listener('CIRC', lambda r: calls.append(('typed', r.id)), typed=True)
+        self.protocol.add_event_listener('CIRC', lambda d: calls.append(('raw', d.split()[0])))
+        self.protocol.add_event_listener('CIRC', lambda r: calls.append(('typed', r.id)), typed=True)
+        self.send("250 OK")
+        self.send("650 CIRC 1 LAUNCHED PURPOSE=GENERAL")
+        ## in the order they were added, not raw ones first
+        self.assertEqual(calls, [('typed', 1), ('raw', '1'), ('typed', 1)])
+
+    def test_windowed_eventlistener(self):
+        self.protocol._set_valid_events('CIRC CIRC_BW')
+        clock = task.Clock()
+        batches = []
+        self.protocol.add_event_listener('CIRC_BW', batches.append, window=60, reactor=clock)
+        self.assertRaises(ValueError, self.protocol.add_event_listener,
+                          'CIRC', batches.append, window=60, reactor=clock)
+        self.send("250 OK")
+        for x in range(10):
+            self.send("650 CIRC_BW ID=%d READ=10 WRITTEN=%d" % (x % 2, x))
+        self.assertEqual(batches, [])
+        clock.advance(60)
+        self.assertEqual(batches, [{0: (50, 20), 1: (50, 25)}])
+
+        self.send("650 CIRC_BW ID=1 READ=10 WRITTEN=10")
+        self.transport.clear()
+        self.protocol.remove_event_listener('CIRC_BW', batches.append)
+        self.assertEqual(self.transport.value(), 'SETEVENTS \r\n')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
     def test_remove_eventlistener(self):
         self.protocol._set_valid_events('STREAM')
 
@@ -688,6 +849,21 @@ p accept 43,53,79-81,110,143,194,220,443,953,989-990,993,995,1194,1293,1723,1863
 
         return d
 
+    def test_big_multiline_reply(self):
+        d = self.protocol.get_info_raw('ns/all')
+        data = ['250+ns/all=']
+        data.extend(['line %d' % x for x in range(50000)])
+        data.extend(['.', '250 OK', ''])
+        self.protocol.dataReceived('\r\n'.join(data))
+
+        def check(reply):
+            lines = reply.split('\n')
+            self.assertEqual(len(lines), 50001)
+            self.assertEqual(lines[0], 'ns/all=')
+            self.assertEqual(lines[-1], 'line 49999')
+        d.addCallback(check)
+        return d
+
     def test_plus_line_no_command(self):
         self.protocol.lineReceived("650+NS\r\n")
         self.protocol.lineReceived("r Gabor gFpAHsFOHGATy12ZUswRf0ZrqAU GG6GDp40cQfR3ODvkBT0r+Q09kw 2012-05-12 16:54:56 91.219.238.71 443 80\r\n")
@@ -702,6 +878,571 @@ p accept 43,53,79-81,110,143,194,220,443,953,989-990,993,995,1194,1293,1723,1863
         self.protocol.lineReceived("650 OK\r\n")
 
 
+class PipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol(pipeline_depth=3)
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_factory_depth(self):
+        proto = TorProtocolFactory(pipeline_depth=5).buildProtocol(None)
+        self.assertEqual(proto.pipeline_depth, 5)
+
+    def test_fills_pipeline(self):
+        for x in range(4):
+            self.protocol.queue_command('GETINFO key%d' % x)
+        self.assertEqual(self.transport.value(),
+                         'GETINFO key0\r\nGETINFO key1\r\nGETINFO key2\r\n')
+        self.assertEqual(len(self.protocol.in_flight), 3)
+        self.assertEqual(len(self.protocol.commands), 1)
+
+        self.transport.clear()
+        self.send("250 OK")
+        self.assertEqual(self.transport.value(), 'GETINFO key3\r\n')
+        self.assertEqual(len(self.protocol.in_flight), 3)
+        self.assertEqual(len(self.protocol.commands), 0)
+
+    def test_replies_in_order(self):
+        results = []
+        for x in range(3):
+            d = self.protocol.get_info_raw('key%d' % x)
+            d.addCallback(results.append)
+        d.addErrback(lambda f: results.append(f.value.code))
+
+        self.send("250-key0=zero")
+        self.send("250 OK")
+        self.send("250+key1=")
+        self.send("one")
+        self.send(".")
+        self.send("250 OK")
+        self.send("552 Unrecognized key \"key2\"")
+
+        self.assertEqual(results, ['key0=zero', 'key1=\none', 552])
+        self.assertEqual(len(self.protocol.in_flight), 0)
+        self.assertEqual(self.protocol.command, None)
+
+    def test_error_in_pipeline(self):
+        d0 = self.protocol.get_info_raw('bad')
+        d1 = self.protocol.get_info_raw('good')
+        d1.addCallback(CallbackChecker('good=yes'))
+
+        self.send('552 Unrecognized key "bad"')
+        self.send("250-good=yes")
+        self.send("250 OK")
+
+        self.assertTrue(d1.called)
+        return self.assertFailure(d0, TorProtocolError)
+
+    def test_event_between_replies(self):
+        self.protocol._set_valid_events('CIRC')
+        events = []
+        self.protocol.add_event_listener('CIRC', events.append)
+        d0 = self.protocol.get_info_raw('key0')
+        d0.addCallback(CallbackChecker('key0=zero'))
+        d1 = self.protocol.get_info_raw('key1')
+        d1.addCallback(CallbackChecker('key1=one'))
+
+        self.send("250 OK")             # SETEVENTS
+        self.send("650 CIRC 1000 EXTENDED moria1,moria2")
+        self.send("250 key0=zero")
+        self.send("250 key1=one")
+
+        self.assertEqual(events, ['1000 EXTENDED moria1,moria2'])
+        self.assertTrue(d0.called)
+        self.assertTrue(d1.called)
+
+    def test_depth_increase(self):
+        self.protocol.pipeline_depth = 1
+        for x in range(3):
+            self.protocol.queue_command('GETINFO key%d' % x)
+        self.assertEqual(len(self.protocol.in_flight), 1)
+
+        self.protocol.pipeline_depth = 3
+        self.send("250 OK")
+        self.assertEqual(len(self.protocol.in_flight), 2)
+        self.assertEqual(len(self.protocol.commands), 0)
+
+
+class PriorityTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_queue_order(self):
+        q = CommandQueue()
+        q.append('bulk0', PRIORITY_BULK)
+        q.append('normal0')
+        q.append('urgent0', PRIORITY_URGENT)
+        q.append('normal1', PRIORITY_INTERACTIVE)
+        q.append('bulk1', PRIORITY_BULK)
+        self.assertEqual(len(q), 5)
+        self.assertEqual(list(q), ['urgent0', 'normal0', 'normal1', 'bulk0', 'bulk1'])
+        self.assertEqual(q[1], 'normal0')
+        self.assertEqual(q.popleft(), 'urgent0')
+        self.assertEqual(q.popleft(), 'normal0')
+        self.assertEqual(len(q), 3)
+
+    def test_queue_empty(self):
+        q = CommandQueue()
+        self.assertRaises(IndexError, q.popleft)
+
+    def test_unknown_priority(self):
+        self.assertRaises(ValueError, self.protocol.queue_command, 'FOO', priority=42)
+
+    def test_urgent_jumps_queue(self):
+        self.protocol.get_info_incremental('ns/all', lambda _: None)
+        self.protocol.get_conf('SocksPort')
+        self.protocol.get_info_incremental('md/all', lambda _: None)
+        self.protocol.queue_command('ATTACHSTREAM 1 0', priority=PRIORITY_URGENT)
+        self.assertEqual(self.transport.value(), 'GETINFO ns/all\r\n')
+
+        self.transport.clear()
+        self.send("250 OK")
+        self.assertEqual(self.transport.value(), 'ATTACHSTREAM 1 0\r\n')
+        self.transport.clear()
+        self.send("250 OK")
+        self.assertEqual(self.transport.value(), 'GETCONF SocksPort\r\n')
+        self.transport.clear()
+        self.send("250 SocksPort=9050")
+        self.assertEqual(self.transport.value(), 'GETINFO md/all\r\n')
+
+
+class CoalescingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.clock = task.Clock()
+        self.protocol.start_coalescing(self.clock)
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_single_query(self):
+        results = []
+        self.protocol.get_info_raw('version').addCallback(results.append)
+        self.assertEqual(self.transport.value(), '')
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        self.send('250-version=0.2.4.20')
+        self.send('250 OK')
+        self.assertEqual(results, ['version=0.2.4.20'])
+
+    def test_merged_info(self):
+        a = []
+        b = []
+        self.protocol.get_info_raw('version', 'net/listeners/socks').addCallback(a.append)
+        self.protocol.get_info('config-file', 'version').addCallback(b.append)
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(),
+                         'GETINFO version net/listeners/socks config-file\r\n')
+        self.send('250-version=0.2.4.20')
+        self.send('250-net/listeners/socks="127.0.0.1:9050"')
+        self.send('250+config-file=')
+        self.send('/etc/tor/torrc')
+        self.send('.')
+        self.send('250 OK')
+        self.assertEqual(a, ['version=0.2.4.20\nnet/listeners/socks="127.0.0.1:9050"'])
+        self.assertEqual(b, [{'config-file': '\n/etc/tor/torrc', 'version': '0.2.4.20'}])
+
+    def test_merged_conf(self):
+        a = []
+        b = []
+        self.protocol.get_conf('socksport').addCallback(a.append)
+        self.protocol.get_conf_raw('ORPort', 'SOCKSPort').addCallback(b.append)
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), 'GETCONF socksport ORPort\r\n')
+        self.send('250-SocksPort=9050')
+        self.send('250 ORPort=0')
+        self.assertEqual(a, [{'SocksPort': '9050'}])
+        self.assertEqual(b, ['ORPort=0\nSocksPort=9050'])
+
+    def test_error_falls_back(self):
+        good = []
+        bad = []
+        self.protocol.get_info_raw('version').addCallback(good.append)
+        self.protocol.get_info_raw('bogus').addErrback(lambda f: bad.append(f.value.code))
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), 'GETINFO version bogus\r\n')
+        self.transport.clear()
+        self.send('552 Unrecognized key "bogus"')
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        self.send('250-version=0.2.4.20')
+        self.send('250 OK')
+        self.send('552 Unrecognized key "bogus"')
+        self.assertEqual(good, ['version=0.2.4.20'])
+        self.assertEqual(bad, [552])
+
+    def test_unattributed_reply_falls_back(self):
+        a = []
+        b = []
+        self.protocol.get_conf_raw('HiddenServiceOptions').addCallback(a.append)
+        self.protocol.get_conf_raw('SOCKSPort').addCallback(b.append)
+        self.clock.advance(0)
+        self.transport.clear()
+        self.send('250-HiddenServiceDir=/fake/path')
+        self.send('250-HiddenServicePort=80 127.0.0.1:1234')
+        self.send('250 SocksPort=9050')
+        self.assertEqual(self.transport.value(), 'GETCONF HiddenServiceOptions\r\n')
+        self.send('250-HiddenServiceDir=/fake/path')
+        self.send('250 HiddenServicePort=80 127.0.0.1:1234')
+        self.assertEqual(self.transport.value(),
+                         'GETCONF HiddenServiceOptions\r\nGETCONF SOCKSPort\r\n')
+        self.send('250 SocksPort=9050')
+        self.assertEqual(a, ['HiddenServiceDir=/fake/path\nHiddenServicePort=80 127.0.0.1:1234'])
+        self.assertEqual(b, ['SocksPort=9050'])
+
+    def test_ambiguous_reply_falls_back(self):
+        a = []
+        b = []
+        self.protocol.get_info_raw('config-text').addCallback(a.append)
+        self.protocol.get_info_raw('version').addCallback(b.append)
+        self.clock.advance(0)
+        self.transport.clear()
+        ## a line of config-text's value looks like the start of version's
+        self.send('250+config-text=')
+        self.send('SocksPort 9050')
+        self.send('version=fake')
+        self.send('.')
+        self.send('250-version=0.2.4.20')
+        self.send('250 OK')
+        self.assertEqual(self.transport.value(), 'GETINFO config-text\r\n')
+        self.send('250+config-text=')
+        self.send('SocksPort 9050')
+        self.send('version=fake')
+        self.send('.')
+        self.send('250 OK')
+        self.assertEqual(self.transport.value(), 'GETINFO config-text\r\nGETINFO version\r\n')
+        self.send('250-version=0.2.4.20')
+        self.send('250 OK')
+        self.assertEqual(a, ['config-text=\nSocksPort 9050\nversion=fake'])
+        self.assertEqual(b, ['version=0.2.4.20'])
+
+    def test_stop_flushes(self):
+        self.protocol.get_info_raw('version')
+        self.protocol.get_info_raw('config-file')
+        self.protocol.stop_coalescing()
+        self.assertEqual(self.transport.value(), 'GETINFO version config-file\r\n')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.protocol.get_info_raw('version')
+        self.assertEqual(len(self.protocol.commands), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class RecordConsumer(object):
+    """
+    IConsumer for the get_info_stream tests; pauses its producer
+    after every `pause_after` records if that's set.
+    """
+
+    def __init__(self, pause_after=None):
+        self.records = []
+        self.producer = None
+        self.unregistered = False
+        self.pause_after = pause_after
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.unregistered = True
+
+    def write(self, record):
+        self.records.append(record)
+        if self.pause_after and len(self.records) % self.pause_after == 0:
+            self.producer.pauseProducing()
+
+
+class StreamingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, data):
+        self.protocol.dataReceived(data.replace('\n', '\r\n'))
+
+    ns = ('250+ns/all=\n'
+          'r a AAAA BBBB 2013-01-01 00:00:00 1.2.3.4 9001 0\n'
+          's Fast Running\n'
+          'r b CCCC DDDD 2013-01-01 00:00:00 5.6.7.8 443 0\n'
+          's Exit\n'
+          'w Bandwidth=100\n'
+          '.\n'
+          '250 OK\n')
+
+    def test_records(self):
+        consumer = RecordConsumer()
+        d = self.protocol.get_info_stream('ns/all', consumer)
+        self.assertEqual(self.transport.value(), 'GETINFO ns/all\r\n')
+        self.assertTrue(consumer.producer is not None)
+        self.send(self.ns)
+        self.assertEqual(consumer.records,
+                         ['r a AAAA BBBB 2013-01-01 00:00:00 1.2.3.4 9001 0\ns Fast Running',
+                          'r b CCCC DDDD 2013-01-01 00:00:00 5.6.7.8 443 0\ns Exit\nw Bandwidth=100'])
+        self.assertTrue(consumer.unregistered)
+        self.assertTrue(d.called)
+
+    def test_lines(self):
+        consumer = RecordConsumer()
+        self.protocol.get_info_stream('config/names', consumer)
+        self.send('250+config/names=\nfoo Bar\nbaz Qux\n.\n250 OK\n')
+        self.assertEqual(consumer.records, ['foo Bar', 'baz Qux'])
+
+    def test_single_line(self):
+        consumer = RecordConsumer()
+        self.protocol.get_info_stream('version', consumer)
+        self.send('250-version=0.2.4.20\n250 OK\n')
+        self.assertEqual(consumer.records, ['0.2.4.20'])
+
+    def test_pause_resume(self):
+        consumer = RecordConsumer(pause_after=1)
+        d = self.protocol.get_info_stream('config/names', consumer, priority=PRIORITY_URGENT)
+        self.send('250+config/names=\nfoo Bar\nbaz Qux\n')
+        self.assertEqual(consumer.records, ['foo Bar'])
+        self.assertEqual(self.transport.producerState, 'paused')
+        consumer.pause_after = None
+        consumer.producer.resumeProducing()
+        self.assertEqual(consumer.records, ['foo Bar', 'baz Qux'])
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.send('.\n250 OK\n')
+        self.assertTrue(d.called)
+
+    def test_paused_at_end(self):
+        consumer = RecordConsumer(pause_after=1)
+        d = self.protocol.get_info_stream('config/names', consumer)
+        self.send('250+config/names=\nfoo Bar\nbaz Qux\n.\n250 OK\n')
+        self.assertEqual(consumer.records, ['foo Bar'])
+        self.assertFalse(d.called)
+        self.assertFalse(consumer.unregistered)
+        consumer.pause_after = None
+        consumer.producer.resumeProducing()
+        self.assertEqual(consumer.records, ['foo Bar', 'baz Qux'])
+        self.assertTrue(consumer.unregistered)
+        self.assertTrue(d.called)
+
+    def test_stop(self):
+        consumer = RecordConsumer(pause_after=1)
+        d = self.protocol.get_info_stream('config/names', consumer)
+        self.send('250+config/names=\nfoo Bar\nbaz Qux\n')
+        consumer.producer.stopProducing()
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.send('quux Foo\n.\n250 OK\n')
+        self.assertEqual(consumer.records, ['foo Bar'])
+        self.assertTrue(d.called)
+
+    def test_error(self):
+        consumer = RecordConsumer()
+        d = self.protocol.get_info_stream('bogus', consumer)
+        self.send('552 Unrecognized key "bogus"\n')
+        self.assertTrue(consumer.unregistered)
+        return self.assertFailure(d, TorProtocolError)
+
+
+class CommandTimeoutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = TorControlProtocol(reactor=self.clock)
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_cancel_queued(self):
+        self.protocol.queue_command('GETINFO version')
+        d = self.protocol.queue_command('GETINFO config-file')
+        self.assertEqual(len(self.protocol.commands), 1)
+        d.cancel()
+        self.assertEqual(len(self.protocol.commands), 0)
+        self.send('250 OK')
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancel_in_flight(self):
+        d = self.protocol.queue_command('GETINFO version')
+        results = []
+        self.protocol.queue_command('GETINFO config-file').addCallback(results.append)
+        d.cancel()
+        ## the reply to the cancelled command is thrown away
+        self.send('250 OK')
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\nGETINFO config-file\r\n')
+        self.send('250 config-file=/etc/tor/torrc')
+        self.assertEqual(results, ['config-file=/etc/tor/torrc'])
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancel_incremental(self):
+        lines = []
+        d = self.protocol.get_info_incremental('ns/all', lines.append)
+        d.cancel()
+        self.send('250+ns/all=')
+        self.send('r foo')
+        self.send('.')
+        self.send('250 OK')
+        self.assertEqual(lines, [])
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_timeout_queued(self):
+        self.protocol.queue_command('GETINFO version')
+        d = self.protocol.queue_command('GETINFO config-file', timeout=5)
+        self.clock.advance(5)
+        self.assertEqual(len(self.protocol.commands), 0)
+        self.send('250 OK')
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        return self.assertFailure(d, TimeoutError)
+
+    def test_timeout_in_flight(self):
+        self.protocol.command_timeout = 10
+        d = self.protocol.queue_command('GETINFO version')
+        self.clock.advance(10)
+        self.assertFailure(d, TimeoutError)
+        results = []
+        self.protocol.queue_command('GETINFO config-file').addCallback(results.append)
+        self.send('250 version=0.2.4.20')
+        self.send('250 config-file=/etc/tor/torrc')
+        self.assertEqual(results, ['config-file=/etc/tor/torrc'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return d
+
+    def test_timeout_keeps_pipeline(self):
+        d = self.protocol.queue_command('GETINFO version', timeout=5)
+        results = []
+        self.protocol.queue_command('GETINFO config-file').addCallback(results.append)
+        self.clock.advance(5)
+        self.assertFailure(d, TimeoutError)
+        ## the timed-out command still has to be answered before
+        ## anything behind it is written
+        self.assertEqual(self.protocol.command[0], d)
+        self.assertEqual([c[0] for c in self.protocol.in_flight], [d])
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        self.send('250 version=0.2.4.20')
+        self.assertEqual(len(self.protocol.in_flight), 1)
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\nGETINFO config-file\r\n')
+        self.send('250 config-file=/etc/tor/torrc')
+        self.assertEqual(results, ['config-file=/etc/tor/torrc'])
+        return d
+
+    def test_no_timeout(self):
+        d = self.protocol.queue_command('GETINFO version', timeout=5)
+        self.send('250 OK')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return d
+
+    def test_latency(self):
+        self.protocol.queue_command('GETINFO version')
+        self.protocol.queue_command('GETINFO config-file')
+        self.protocol.queue_command('SIGNAL NEWNYM').addErrback(lambda f: None)
+        self.clock.advance(2)
+        self.send('250 OK')
+        self.clock.advance(1)
+        self.send('250 OK')
+        self.send('552 Unrecognized signal')
+        getinfo = self.protocol.latency['GETINFO']
+        self.assertEqual(getinfo.count, 2)
+        self.assertEqual(getinfo.max, 2)
+        self.assertEqual(getinfo.last, 1)
+        self.assertEqual(getinfo.mean, 1.5)
+        self.assertEqual(self.protocol.latency['SIGNAL'].count, 1)
+        self.assertTrue('count=2' in str(getinfo))
+
+
+class ChunkParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_many_replies_one_chunk(self):
+        self.protocol._set_valid_events('CIRC')
+        events = []
+        self.protocol.add_event_listener('CIRC', events.append)
+        results = []
+        self.protocol.get_info_raw('a').addCallback(results.append)
+        self.protocol.get_info_raw('b').addCallback(results.append)
+        self.protocol.get_info_raw('c').addCallback(results.append)
+
+        self.protocol.dataReceived('250 OK\r\n'
+                                   '650 CIRC 1 LAUNCHED\r\n'
+                                   '250 a=1\r\n'
+                                   '650-CIRC 2 EXTENDED\r\n'
+                                   '650 FOO=bar\r\n'
+                                   '250+b=\r\nline\r\n.\r\n250 OK\r\n'
+                                   '250-c=3\r\n250 OK\r\n')
+        self.assertEqual(results, ['a=1', 'b=\nline', 'c=3'])
+        self.assertEqual(events, ['1 LAUNCHED', '2 EXTENDED\nFOO=bar'])
+
+    def test_split_chunks(self):
+        results = []
+        self.protocol.get_info_raw('a').addCallback(results.append)
+        reply = '250+a=\r\nfirst\r\nsecond\r\n.\r\n250 OK\r\n'
+        for c in reply:
+            self.protocol.dataReceived(c)
+        self.assertEqual(results, ['a=\nfirst\nsecond'])
+
+    def test_garbage(self):
+        self.assertRaises(RuntimeError, self.protocol.dataReceived, 'foo\r\n')
+
+    def test_unknown_separator(self):
+        self.assertRaises(RuntimeError, self.protocol.dataReceived, '250*foo\r\n')
+
+    def test_unknown_separator_continuation(self):
+        self.protocol.get_info_raw('a').addErrback(lambda _: None)
+        self.protocol.dataReceived('250-a=1\r\n')
+        self.assertRaises(RuntimeError, self.protocol.dataReceived, '250*foo\r\n')
+
+    def test_unexpected_code(self):
+        self.protocol.get_info_raw('a').addErrback(lambda _: None)
+        self.protocol.dataReceived('250-a=1\r\n')
+        self.assertRaises(RuntimeError, self.protocol.dataReceived, '251 OK\r\n')
+
+    def test_line_too_long(self):
+        self.protocol.dataReceived('250-' + 'x' * TorControlProtocol.MAX_LENGTH + '\r\n')
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_partial_line_too_long(self):
+        self.protocol.dataReceived('250-' + 'x' * TorControlProtocol.MAX_LENGTH)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_ignore_after_disconnect(self):
+        results = []
+        self.protocol.get_info_raw('a').addCallback(results.append)
+        self.transport.loseConnection()
+        self.protocol.dataReceived('250 a=1\r\n')
+        self.assertEqual(results, [])
+
+    def test_event_during_incremental(self):
+        self.protocol._set_valid_events('CIRC')
+        events = []
+        self.protocol.add_event_listener('CIRC', events.append)
+        self.protocol.dataReceived('250 OK\r\n')
+
+        lines = []
+        self.protocol.get_info_incremental('ns/all', lines.append)
+        self.protocol.dataReceived('650-CIRC 1 LAUNCHED\r\n650 FOO=bar\r\n'
+                                   '250+ns/all=\r\nr foo\r\n.\r\n250 OK\r\n')
+        self.assertEqual(events, ['1 LAUNCHED\nFOO=bar'])
+        self.assertEqual(lines, ['ns/all=', 'r foo'])
+
+
 class ParseTests(unittest.TestCase):
 
     def setUp(self):
@@ -788,6 +1529,59 @@ OK
         x = parse_keywords('foo=')
         self.assertEqual(x, {'foo': ''})
 
+    def test_quoted_escapes(self):
+        x = parse_keywords(r'foo="a \"quoted\" \\ line\nnext\101"')
+        self.assertEqual(x, {'foo': 'a "quoted" \\ line\nnextA'})
+
+    def test_unquote_not_one_string(self):
+        self.assertEqual(unquote('"a" "b"'), '"a" "b"')
+        self.assertEqual(unquote(r'"a\" "b\"'), r'"a\" "b\"')
+        self.assertEqual(unquote(r'"a\"'), r'"a\"')
+        self.assertEqual(unquote('"'), '"')
+        self.assertEqual(unquote(r'"\0\12x"'), '\x00\nx')
+
+    def test_keywords_ok_in_value(self):
+        x = parse_keywords('foo=bar\nOK\nbaz\nquux=1')
+        self.assertEqual(x, {'foo': 'bar\nbaz', 'quux': '1'})
+
+    def test_keyword_args(self):
+        x = parse_keyword_args('METHODS=COOKIE,SAFECOOKIE COOKIEFILE="/home/some one/.tor/control_auth_cookie"')
+        self.assertEqual(x, {'METHODS': 'COOKIE,SAFECOOKIE',
+                             'COOKIEFILE': '/home/some one/.tor/control_auth_cookie'})
+
+    def test_keyword_args_windows_path(self):
+        x = parse_keyword_args(r'METHODS=COOKIE COOKIEFILE="C:\\Tor\\control_auth_cookie" EMPTY=')
+        self.assertEqual(x, {'METHODS': 'COOKIE',
+                             'COOKIEFILE': r'C:\Tor\control_auth_cookie',
+                             'EMPTY': ''})
+
+    def test_keyword_args_bare_words(self):
+        x = parse_keyword_args('AUTHCHALLENGE SERVERHASH=AB SERVERNONCE=CD')
+        self.assertEqual(x, {'AUTHCHALLENGE': DEFAULT_VALUE, 'SERVERHASH': 'AB', 'SERVERNONCE': 'CD'})
+
+    def test_lazy_matches(self):
+        for text in ['foo=bar\nfoo=baz\nfoo=zarimba',
+                     'Foo=bar\nBar',
+                     'foo',
+                     'foo=bar\nOK\nbaz\nquux=1',
+                     'ns/name/foo=\nr foo\ns Fast\nns/name/bar=\nr bar\ns Exit\nOK\n',
+                     'Tor="0.1.2.3.4-rc44"']:
+            self.assertEqual(dict(parse_keywords_lazy(text)), parse_keywords(text))
+            self.assertEqual(dict(parse_keywords_lazy(text, multiline_values=False)),
+                             parse_keywords(text, multiline_values=False))
+
+    def test_lazy(self):
+        x = parse_keywords_lazy('small=1\nbig=\n' + ('r foo\n' * 1000) + 'OK')
+        self.assertEqual(len(x), 2)
+        self.assertTrue('big' in x)
+        self.assertFalse('nothing' in x)
+        self.assertEqual(x._values, {})
+        self.assertEqual(x['small'], '1')
+        self.assertEqual(x._values.keys(), ['small'])
+        self.assertTrue(x['big'] is x['big'])
+        self.assertEqual(x['big'].count('r foo'), 1000)
+        self.assertRaises(KeyError, lambda: x['nothing'])
+
     def test_network_status(self):
         self.controller._update_network_status("""ns/all=
 r right2privassy3 ADQ6gCT3DiFHKPDFr3rODBUI8HM JehnjB8l4Js47dyjLCEmE8VJqao 2011-12-02 03:36:40 50.63.8.215 9023 0
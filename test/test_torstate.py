@@ -10,6 +10,8 @@ import tempfile
 
 from txtorcon import TorControlProtocol, TorProtocolError, TorState, Stream, Circuit, build_tor_connection, build_local_tor_connection
 from txtorcon.interface import ITorControlProtocol, IStreamAttacher, ICircuitListener, IStreamListener, StreamListenerMixin, CircuitListenerMixin
+from txtorcon.interface import IRouterListener, RouterListenerMixin
+from txtorcon.microdesc import Microdescriptor, microdescriptor_digest
 
 
 class CircuitListener(object):
@@ -173,6 +175,9 @@ class FakeControlProtocol:
         self.post_bootstrap = defer.succeed(self)
         self.on_disconnect = defer.Deferred()
 
+    def get_info_raw(self, key):
+        return defer.Deferred()
+
 
 class InternalMethodsTests(unittest.TestCase):
 
@@ -228,7 +233,8 @@ class BootstrapTests(unittest.TestCase):
         self.assertEqual(state.tor_pid, 0)
 
     def test_build_with_answers(self):
-        p = FakeEndpointAnswers(['',     # ns/all
+        p = FakeEndpointAnswers(['2015-01-01 00:00:00',  # consensus/valid-after
+                                 '',     # ns/all
                                  '',     # circuit-status
                                  '',     # stream-status
                                  '',     # address-mappings/all
@@ -243,7 +249,8 @@ class BootstrapTests(unittest.TestCase):
         return d
 
     def test_build_with_answers_no_pid(self):
-        p = FakeEndpointAnswers(['',    # ns/all
+        p = FakeEndpointAnswers(['2015-01-01 00:00:00',  # consensus/valid-after
+                                 '',    # ns/all
                                  '',    # circuit-status
                                  '',    # stream-status
                                  '',    # address-mappings/all
@@ -257,7 +264,8 @@ class BootstrapTests(unittest.TestCase):
         return d
 
     def test_build_with_answers_guards_unfound_entry(self):
-        p = FakeEndpointAnswers(['',    # ns/all
+        p = FakeEndpointAnswers(['2015-01-01 00:00:00',  # consensus/valid-after
+                                 '',    # ns/all
                                  '',    # circuit-status
                                  '',    # stream-status
                                  '',    # address-mappings/all
@@ -338,6 +346,9 @@ class StateTests(unittest.TestCase):
         self.protocol.is_owned = 999
         self.state._bootstrap()
 
+        self.send("250-consensus/valid-after=2015-01-01 00:00:00")
+        self.send("250 OK")
+
         self.send("250+ns/all=")
         self.send(".")
         self.send("250 OK")
@@ -371,6 +382,7 @@ class StateTests(unittest.TestCase):
         self.send("250-ip-to-country/0.0.0.0=??")
         self.send("250 OK")
 
+        self.assertEqual(self.state.consensus_valid_after, '2015-01-01 00:00:00')
         self.assertEqual(len(self.state.entry_guards), 2)
         self.assertTrue('$0000000000000000000000000000000000000000' in self.state.entry_guards)
         self.assertEqual(self.state.entry_guards['$0000000000000000000000000000000000000000'], fakerouter)
@@ -395,6 +407,9 @@ class StateTests(unittest.TestCase):
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
 
+        self.send("250-consensus/valid-after=2015-01-01 00:00:00")
+        self.send("250 OK")
+
         self.send("250+ns/all=")
         self.send(".")
         self.send("250 OK")
@@ -440,6 +455,9 @@ class StateTests(unittest.TestCase):
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
 
+        self.send("250-consensus/valid-after=2015-01-01 00:00:00")
+        self.send("250 OK")
+
         self.send("250+ns/all=")
         self.send(".")
         self.send("250 OK")
@@ -532,6 +550,147 @@ class StateTests(unittest.TestCase):
         self.assertEqual(len(self.protocol.commands), 3)
         self.assertEqual(self.protocol.commands[2][1], 'ATTACHSTREAM 4 1')
 
+    def _resync_protocol(self):
+        proto = TorControlProtocol()
+        proto.connectionMade = lambda: None
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto._set_valid_events('STREAM CIRC NS NEWCONSENSUS ADDRMAP')
+        return proto
+
+    def _answer(self, proto, answers):
+        "answers is a dict of command -> reply lines; everything else gets 250 OK"
+        while proto.in_flight:
+            cmd = proto.in_flight[0][1]
+            proto.dataReceived(answers.get(cmd, '250 OK') + '\r\n')
+
+    def test_resync(self):
+        self.protocol._set_valid_events('STREAM CIRC NS NEWCONSENSUS ADDRMAP')
+        self.state._add_events()
+        while self.protocol.in_flight:
+            self.send("250 OK")
+        self.state.consensus_valid_after = '2014-01-01 00:00:00'
+        self.state._circuit_update('1 BUILT PURPOSE=GENERAL')
+        self.state._circuit_update('2 BUILT PURPOSE=GENERAL')
+        self.state._stream_update('10 SUCCEEDED 2 1.2.3.4:80')
+        closed = []
+
+        class ClosedListener(CircuitListenerMixin):
+            def circuit_closed(self, circuit, **kw):
+                closed.append(circuit.id)
+        self.state.circuits[1].listen(ClosedListener())
+
+        proto = self._resync_protocol()
+        d = self.state.resync(proto)
+        self._answer(proto, {
+            'GETINFO consensus/valid-after': '250-consensus/valid-after=2014-01-01 00:00:00\r\n250 OK',
+            'GETINFO circuit-status': '250-circuit-status=2 BUILT PURPOSE=GENERAL\r\n250 OK',
+            'GETINFO address-mappings/all': '250-address-mappings/all=www.example.com 1.2.3.4 NEVER\r\n250 OK',
+        })
+        self.assertTrue(self.successResultOf(d) is self.state)
+        self.assertTrue(self.state.protocol is proto)
+        self.assertEqual(self.state.circuits.keys(), [2])
+        self.assertEqual(self.state.streams, {})
+        self.assertEqual(closed, [1])
+        self.assertTrue('www.example.com' in self.state.addrmap.addr)
+        self.assertFalse('ns/all' in proto.transport.value())
+        ## our own listeners came along
+        self.assertEqual(sorted(proto.events.keys()), sorted(self.state.event_map.keys()))
+
+    def test_resync_new_consensus(self):
+        self.state.consensus_valid_after = '2014-01-01 00:00:00'
+        self.state._update_network_status('r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80\ns Fast Running')
+        fake = self.state.routers['fake']
+        placeholder = self.state.router_from_id('$' + 'A' * 40)
+        proto = self._resync_protocol()
+        d = self.state.resync(proto)
+        self._answer(proto, {
+            'GETINFO consensus/valid-after': '250-consensus/valid-after=2014-01-01 01:00:00\r\n250 OK',
+            'GETINFO ns/all': '250+ns/all=\r\nr fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80\r\ns Fast Running\r\nr other 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0\r\ns Fast Running\r\n.\r\n250 OK',
+        })
+        self.successResultOf(d)
+        self.assertEqual(self.state.consensus_valid_after, '2014-01-01 01:00:00')
+        ## the unchanged router is kept, but talks to the new connection
+        self.assertTrue(self.state.routers['fake'] is fake)
+        self.assertTrue(fake.controller is proto)
+        self.assertTrue(self.state.routers['other'].controller is proto)
+        self.assertTrue(placeholder.controller is proto)
+
+    def test_resync_after_newconsensus(self):
+        self.protocol._set_valid_events('STREAM CIRC NS NEWCONSENSUS ADDRMAP')
+        self.state._add_events()
+        while self.protocol.in_flight:
+            self.send("250 OK")
+        self.state.consensus_valid_after = '2014-01-01 00:00:00'
+        self.protocol.dataReceived('\r\n'.join([
+            '650+NEWCONSENSUS',
+            'r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80',
+            's Fast Running',
+            '.',
+            '650 OK', '']))
+        self.assertEqual(self.protocol.in_flight[0][1], 'GETINFO consensus/valid-after')
+        self.send('250-consensus/valid-after=2014-01-01 01:00:00')
+        self.send('250 OK')
+        self.assertEqual(self.state.consensus_valid_after, '2014-01-01 01:00:00')
+
+        proto = self._resync_protocol()
+        d = self.state.resync(proto)
+        self._answer(proto, {
+            'GETINFO consensus/valid-after': '250-consensus/valid-after=2014-01-01 01:00:00\r\n250 OK',
+        })
+        self.successResultOf(d)
+        self.assertFalse('ns/all' in proto.transport.value())
+        self.assertTrue('fake' in self.state.routers)
+
+    def test_ns_event_during_load(self):
+        self.state._update_network_status('r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80\ns Fast Running\nw Bandwidth=10')
+        loading = []
+
+        def get_info_incremental(key, line_cb):
+            loading.append((line_cb, defer.Deferred()))
+            return loading[-1][1]
+        self.protocol.get_info_incremental = get_info_incremental
+        d = self.state._load_routers()
+        [(line_cb, done)] = loading
+        line_cb('ns/all=')
+        line_cb('r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80')
+        line_cb('s Fast Running')
+        ## e.g. on the primary, while a secondary is sending ns/all
+        self.state._network_status_event('r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80\ns Fast Running\nw Bandwidth=30')
+        self.assertEqual(self.state.routers['fake'].bandwidth, 10)
+        line_cb('w Bandwidth=20')
+        line_cb('r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0')
+        line_cb('s Fast Running')
+        line_cb('.')
+        done.callback('')
+        self.successResultOf(d)
+        ## nothing listed before the NS event was evicted, and the
+        ## NS event was applied afterwards
+        self.assertEqual(sorted(r.name for r in self.state.all_routers), ['PPrivCom012', 'fake'])
+        self.assertEqual(self.state.routers['fake'].bandwidth, 30)
+
+    def test_resync_no_valid_after(self):
+        proto = self._resync_protocol()
+        d = self.state.resync(proto)
+        self._answer(proto, {
+            'GETINFO consensus/valid-after': '552 Unrecognized key "consensus/valid-after"',
+        })
+        self.successResultOf(d)
+        self.assertTrue('GETINFO ns/all' in proto.transport.value())
+        self.assertEqual(self.state.consensus_valid_after, None)
+
+    def test_attach_is_urgent(self):
+        class MyAttacher(object):
+            implements(IStreamAttacher)
+
+            def attach_stream(self, stream, circuits):
+                return None
+
+        self.state.set_attacher(MyAttacher(), FakeReactor(self))
+        self.protocol.get_info_incremental('ns/all', lambda _: None)
+        self.protocol.get_info_raw('version')
+        self.state._stream_update("1 NEW 0 ca.yahoo.com:80 PURPOSE=USER")
+        self.assertEqual(self.protocol.commands[0][1], 'ATTACHSTREAM 1 0')
+
     def test_attacher_defer(self):
         class MyAttacher(object):
             implements(IStreamAttacher)
@@ -687,6 +846,18 @@ class StateTests(unittest.TestCase):
         self.state._circuit_update('365 CLOSED $E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris,$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus,$253DFF1838A2B7782BE7735F74E50090D46CA1BC=chomsky PURPOSE=GENERAL REASON=TIMEOUT')
         self.assertTrue(365 not in self.state.circuits)
 
+    def test_raw_listener_after_state(self):
+        self.protocol._set_valid_events('CIRC STREAM ORCONN BW NEWCONSENSUS NS ADDRMAP')
+        self.state._add_events()
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
+        found = []
+        ## a raw listener added after TorState's sees what TorState did
+        self.protocol.add_event_listener('CIRC', lambda data: found.append(self.state.circuits.get(int(data.split()[0]))))
+        self.send("650 CIRC 123 LAUNCHED PURPOSE=GENERAL")
+        self.assertEqual(len(found), 1)
+        self.assertTrue(found[0] is self.state.circuits[123])
+
     def test_circuit_listener(self):
         events = 'CIRC STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR NEWDESC ADDRMAP AUTHDIR_NEWDESCS DESCCHANGED NS STATUS_GENERAL STATUS_CLIENT STATUS_SERVER GUARD STREAM_BW CLIENTS_SEEN NEWCONSENSUS BUILDTIMEOUT_SET'
         self.protocol._set_valid_events(events)
@@ -856,6 +1027,9 @@ p accept 43,53,79-81,110,143,194,220,443,953,989-990,993,995,1194,1293,1723,1863
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
 
+        self.send("250-consensus/valid-after=2015-01-01 00:00:00")
+        self.send("250 OK")
+
         self.send("250+ns/all=")
         self.send(".")
         self.send("250 OK")
@@ -913,6 +1087,9 @@ p reject 1-65535
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
 
+        self.send("250-consensus/valid-after=2015-01-01 00:00:00")
+        self.send("250 OK")
+
         self.send("250+ns/all=")
         self.send(".")
         self.send("250 OK")
@@ -960,6 +1137,9 @@ w Bandwidth=166
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
 
+        self.send("250-consensus/valid-after=2015-01-01 00:00:00")
+        self.send("250 OK")
+
         self.send("250+ns/all=")
         self.send(".")
         self.send("250 OK")
@@ -1107,3 +1287,259 @@ s Fast Guard Running Stable Valid
     def test_listener_mixins(self):
         self.assertTrue(verifyClass(IStreamListener, StreamListenerMixin))
         self.assertTrue(verifyClass(ICircuitListener, CircuitListenerMixin))
+        self.assertTrue(verifyClass(IRouterListener, RouterListenerMixin))
+
+
+class RouterListener(RouterListenerMixin):
+
+    def __init__(self):
+        self.events = []
+
+    def router_added(self, router):
+        self.events.append(('added', router.name))
+
+    def router_removed(self, router):
+        self.events.append(('removed', router.name))
+
+    def router_updated(self, router, changes):
+        self.events.append(('updated', router.name, changes))
+
+
+class ConsensusDiffTests(unittest.TestCase):
+
+    consensus = """r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Guard Running Stable Valid
+w Bandwidth=518000
+p accept 43,53,79-81
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Running Stable Valid
+w Bandwidth=51500
+p reject 1-65535"""
+
+    def setUp(self):
+        self.state = TorState(FakeControlProtocol(), bootstrap=False)
+        self.listener = RouterListener()
+        self.state.add_router_listener(self.listener)
+        self.state._update_network_status(self.consensus)
+
+    def test_added(self):
+        self.assertEqual(self.listener.events, [('added', 'fake'), ('added', 'PPrivCom012')])
+        self.assertEqual(len(self.state.all_routers), 2)
+        self.assertEqual(self.state.routers['fake'].modified.day, 12)
+        self.assertTrue('$624926802351575FF7E4E3D60EFA3BFB56E67E8A' in self.state.guards)
+
+    def test_unchanged(self):
+        diff = self.state._update_network_status(self.consensus)
+        self.assertEqual(len(diff), 0)
+        self.assertEqual(len(self.listener.events), 2)
+        self.assertEqual(len(self.state.all_routers), 2)
+
+    def test_updated(self):
+        router = self.state.routers['fake']
+        self.state._update_network_status(self.consensus.replace('12.45.56.78', '12.45.56.79')
+                                                         .replace('Exit Fast Guard', 'Exit Fast')
+                                                         .replace('79-81', '80'))
+        self.assertTrue(self.state.routers['fake'] is router)
+        self.assertEqual(router.ip, '12.45.56.79')
+        self.assertEqual(self.listener.events[2:],
+                         [('updated', 'fake', {'ip': '12.45.56.78',
+                                               'flags': ('exit', 'fast', 'guard', 'running', 'stable', 'valid'),
+                                               'policy': 'accept 43,53,79-81'})])
+        self.assertFalse(router.accepts_port(79))
+        self.assertEqual(self.state.guards, {})
+
+    def test_renamed(self):
+        self.state._update_network_status(self.consensus.replace('r fake', 'r notfake'))
+        self.assertEqual(self.listener.events[2:], [('updated', 'notfake', {'name': 'fake'})])
+        self.assertTrue('fake' not in self.state.routers)
+        self.assertTrue('fake' not in self.state.routers_by_name)
+        self.assertEqual(self.state.routers['notfake'].id_hex, '$624926802351575FF7E4E3D60EFA3BFB56E67E8A')
+
+    def test_renamed_authority(self):
+        consensus = self.consensus.replace('Exit Fast Guard', 'Authority Exit Fast Guard')
+        self.state._update_network_status(consensus)
+        router = self.state.authorities['fake']
+        self.state._update_network_status(consensus.replace('r fake', 'r notfake'))
+        self.assertEqual(self.state.authorities, {'notfake': router})
+        self.state._update_network_status(self.consensus.split('\n', 4)[4])
+        self.assertEqual(self.state.authorities, {})
+
+    def test_removed(self):
+        self.state._update_network_status(self.consensus.split('\n', 4)[4])
+        self.assertEqual(self.listener.events[2:], [('removed', 'fake')])
+        self.assertTrue('fake' not in self.state.routers)
+        self.assertTrue('$624926802351575FF7E4E3D60EFA3BFB56E67E8A' not in self.state.routers)
+        self.assertEqual(self.state.guards, {})
+        self.assertEqual(len(self.state.all_routers), 1)
+
+    def test_ns_event(self):
+        ## an NS event only lists the routers it's about
+        self.state._network_status_event(self.consensus.split('\n', 4)[4].replace('51500', '6000'))
+        self.assertEqual(self.listener.events[2:], [('updated', 'PPrivCom012', {'bandwidth': 51500})])
+        self.assertTrue('fake' in self.state.routers)
+
+    def test_duplicate_names(self):
+        self.state._update_network_status(self.consensus.replace('r PPrivCom012', 'r fake'))
+        self.assertTrue('fake' not in self.state.routers)
+        self.assertEqual(len(self.state.routers_by_name['fake']), 2)
+        self.state._update_network_status(self.consensus)
+        self.assertTrue(self.state.routers['fake'] is self.state.routers_by_name['fake'][0])
+
+    def test_known_from_circuit(self):
+        router = self.state.router_from_id('$AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+        self.assertFalse(router.from_consensus)
+        self.state._update_network_status(self.consensus + """
+r late qqqqqqqqqqqqqqqqqqqqqqqqqqo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Fast""")
+        self.assertTrue(self.state.routers_by_hash['$AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'] is router)
+        self.assertTrue(router.from_consensus)
+        self.assertEqual(self.listener.events[2:], [('added', 'late')])
+
+    def test_error_resets(self):
+        self.assertRaises(RuntimeError, self.state._update_network_status, 'r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80\nw Bandwidth=1')
+        diff = self.state._update_network_status(self.consensus)
+        self.assertEqual(len(diff), 0)
+
+    def test_evict_in_use(self):
+        router = self.state.routers['fake']
+        circuit = Circuit(self.state)
+        circuit.path = [router]
+        self.state.circuits[1] = circuit
+        diff = self.state._update_network_status(self.consensus.split('\n', 4)[4])
+        self.assertEqual(diff.evicted, 0)
+        self.assertTrue(self.state.routers['fake'] is router)
+        self.assertEqual(self.state.consensus_generation, 2)
+        self.assertEqual(router.generation, 1)
+
+        del self.state.circuits[1]
+        self.assertEqual(self.state.evict_routers(), 1)
+        self.assertEqual(self.listener.events[2:], [('removed', 'fake')])
+        self.assertTrue('fake' not in self.state.routers)
+        self.assertEqual(self.state.evict_routers(), 0)
+
+    def test_evict_placeholder(self):
+        router = self.state.router_from_id('$AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA~foo')
+        self.assertEqual(self.state.evict_routers(), 0)
+        diff = self.state._update_network_status(self.consensus)
+        self.assertEqual(diff.evicted, 1)
+        self.assertEqual(diff.removed, [])
+        self.assertTrue(router.id_hex not in self.state.routers)
+        self.assertEqual(len(self.listener.events), 2)
+
+
+class MicrodescriptorTests(unittest.TestCase):
+
+    consensus = """r fake YkkmgCNRV1/35OPWDvo7+1bmfoo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Guard Running Stable Valid
+w Bandwidth=518000
+m AAAA
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Running Stable Valid
+w Bandwidth=51500
+m BBBB"""
+
+    def setUp(self):
+        self.state = TorState(FakeControlProtocol(), bootstrap=False, microdescriptors=True)
+        self.listener = RouterListener()
+        self.state.add_router_listener(self.listener)
+        self.state._update_network_status(self.consensus, parser=self.state._microdesc_consensus_parser)
+        self.fake = self.state.routers['fake']
+        self.other = self.state.routers['PPrivCom012']
+
+    def microdescriptors(self, fake_family='', other_family=''):
+        return [Microdescriptor('onion-key\np accept 80\nfamily %s\n' % fake_family, digest='AAAA'),
+                Microdescriptor('onion-key\nfamily %s\n' % other_family, digest='BBBB'),
+                Microdescriptor('onion-key\n', digest='CCCC')]
+
+    def test_routers(self):
+        self.assertEqual(self.fake.md_digest, 'AAAA')
+        self.assertEqual(self.fake.or_hash, None)
+        self.assertEqual(self.fake.microdescriptor, None)
+        self.assertEqual(self.state.router_family(self.fake), [])
+
+    def test_add(self):
+        self.assertEqual(self.state._add_microdescriptors(self.microdescriptors()), 2)
+        self.assertEqual(self.fake.microdescriptor.digest, 'AAAA')
+        self.assertTrue(self.fake.accepts_port(80))
+        self.assertFalse(self.other.accepts_port(80))
+        self.assertEqual(self.state.routers_where(port=80), set([self.fake]))
+        self.assertEqual(self.listener.events[2:],
+                         [('updated', 'fake', {'policy': ''}), ('updated', 'PPrivCom012', {'policy': ''})])
+
+    def test_changed_digest(self):
+        self.state._update_network_status(self.consensus.replace('m AAAA', 'm CCCC'),
+                                          parser=self.state._microdesc_consensus_parser)
+        self.assertEqual(self.listener.events[2:], [('updated', 'fake', {'md_digest': 'AAAA'})])
+        self.assertEqual(self.state._add_microdescriptors(self.microdescriptors()), 2)
+        self.assertEqual(self.fake.microdescriptor.digest, 'CCCC')
+
+    def test_family(self):
+        self.state._add_microdescriptors(self.microdescriptors('$' + self.other.id_hex[1:], 'fake'))
+        self.assertEqual(self.state.router_family(self.fake), [self.other])
+        self.assertEqual(self.state.router_family(self.other), [self.fake])
+        self.assertEqual(self.state.path_selector.family(self.fake), [self.other])
+
+    def test_family_not_mutual(self):
+        self.state._add_microdescriptors(self.microdescriptors('$' + self.other.id_hex[1:] + '~PPrivCom012'))
+        self.assertEqual(self.state.router_family(self.fake), [])
+
+    def test_load(self):
+        lines = ['md/all=', 'onion-key', 'p accept 80', 'family', '.']
+
+        def get_info_incremental(key, line_cb):
+            self.assertEqual(key, 'md/all')
+            for line in lines:
+                line_cb(line)
+            return defer.succeed('')
+        self.state.protocol.get_info_incremental = get_info_incremental
+        self.state._update_network_status(self.consensus.replace('AAAA', microdescriptor_digest('onion-key\np accept 80\nfamily\n')),
+                                          parser=self.state._microdesc_consensus_parser)
+        d = self.state.load_microdescriptors()
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertTrue(self.fake.accepts_port(80))
+
+    def answer_incremental(self, answers):
+        "answers is a dict of key -> lines; returns the keys asked for"
+        keys = []
+
+        def get_info_incremental(key, line_cb):
+            keys.append(key)
+            for line in answers[key]:
+                line_cb(line)
+            return defer.succeed('')
+        self.state.protocol.get_info_incremental = get_info_incremental
+        return keys
+
+    def test_new_consensus_event(self):
+        text = 'onion-key\np accept 80\nfamily\n'
+        keys = self.answer_incremental({'md/all': ['md/all='] + text.split('\n') + ['.']})
+        self.state._new_consensus_event(self.consensus.replace('AAAA', microdescriptor_digest(text)))
+        self.assertEqual(keys, ['md/all'])
+        self.assertEqual(self.fake.md_digest, microdescriptor_digest(text))
+        self.assertEqual(self.fake.microdescriptor.text, text)
+        self.assertTrue(self.fake.accepts_port(80))
+
+    def test_new_consensus_event_unchanged(self):
+        keys = self.answer_incremental({})
+        self.state._new_consensus_event(self.consensus.replace('518000', '519000'))
+        self.assertEqual(keys, [])
+        self.assertEqual(self.fake.bandwidth, 519000)
+
+    def test_new_consensus_event_ns_format(self):
+        ## no "m" lines, so the microdescriptor consensus is re-read
+        text = 'onion-key\np accept 80\nfamily\n'
+        keys = self.answer_incremental({
+            'dir/status-vote/current/consensus-microdesc': self.consensus.replace('AAAA', microdescriptor_digest(text)).split('\n'),
+            'md/all': ['md/all='] + text.split('\n') + ['.'],
+        })
+        event = '\n'.join(line for line in self.consensus.split('\n') if not line.startswith('m '))
+        self.state._new_consensus_event(event)
+        self.assertEqual(keys, ['dir/status-vote/current/consensus-microdesc', 'md/all'])
+        self.assertEqual(self.fake.md_digest, microdescriptor_digest(text))
+        self.assertTrue(self.fake.accepts_port(80))
+
+    def test_new_consensus_event_ns(self):
+        state = TorState(FakeControlProtocol(), bootstrap=False)
+        state.protocol.get_info_incremental = lambda *args: self.fail('nothing to load')
+        state._new_consensus_event('r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80\ns Fast Running\nw Bandwidth=1000\np accept 80')
+        self.assertTrue(state.routers['fake'].accepts_port(80))
@@ -0,0 +1,201 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol, TorState
+from txtorcon.transcript import TranscriptLog, TranscriptReplay
+from txtorcon.transcript import record_transcript, read_transcript
+
+from StringIO import StringIO
+
+
+EVENTS = 'STREAM CIRC NS NEWCONSENSUS ADDRMAP ORCONN BW'
+
+ANSWERS = {
+    'PROTOCOLINFO 1': '250-PROTOCOLINFO 1\r\n250-AUTH METHODS=HASHEDPASSWORD\r\n250-VERSION Tor="0.2.5.10"\r\n250 OK',
+    'GETINFO version': '250-version=0.2.5.10\r\n250 OK',
+    'GETINFO events/names': '250-events/names=' + EVENTS + '\r\n250 OK',
+    'GETINFO ns/all': '\r\n'.join(['250+ns/all=',
+                                   'r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80',
+                                   's Exit Fast Guard Running Stable Valid',
+                                   'w Bandwidth=518000',
+                                   '.',
+                                   '250 OK']),
+    'GETINFO circuit-status': '250-circuit-status=1 BUILT $624926802351575FF7E4E3D60EFA3BFB56E67E8A~fake PURPOSE=GENERAL\r\n250 OK',
+    'GETINFO stream-status': '250-stream-status=\r\n250 OK',
+    'GETINFO address-mappings/all': '250-address-mappings/all=\r\n250 OK',
+    'GETINFO entry-guards': '250-entry-guards=\r\n250 OK',
+    'GETINFO process/pid': '250-process/pid=1234\r\n250 OK',
+}
+
+
+def answer(proto):
+    "answer everything outstanding, using ANSWERS or '250 OK'"
+    while proto.in_flight:
+        cmd = proto.in_flight[0][1]
+        proto.dataReceived(ANSWERS.get(cmd, '250 OK') + '\r\n')
+
+
+def record_session(f, clock):
+    """
+    Drive a TorControlProtocol and TorState through connecting,
+    bootstrapping and a few events, recording it all to f.
+    """
+
+    proto = TorControlProtocol(lambda: 'password')
+    proto.start_debug(TranscriptLog(f, clock))
+    proto.makeConnection(proto_helpers.StringTransport())
+    answer(proto)
+    state = TorState(proto)
+    answer(proto)
+    proto.dataReceived('650 CIRC 2 LAUNCHED PURPOSE=GENERAL\r\n')
+    proto.dataReceived('650 STREAM 10 NEW 0 www.example.com:80 SOURCE_ADDR=127.0.0.1:1234 PURPOSE=USER\r\n')
+    return state
+
+
+class TranscriptLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+
+    def clock(self):
+        self.now += 0.5
+        return self.now
+
+    def test_format(self):
+        f = StringIO()
+        log = TranscriptLog(f, self.clock)
+        log.command_sent('GETINFO version')
+        log.line_received('250-version=0.2.5.10')
+        log.line_received('250 OK')
+        self.assertEqual(f.getvalue(), '0.500000 > GETINFO version\n'
+                                       '1.000000 < 250-version=0.2.5.10\n'
+                                       '1.500000 < 250 OK\n')
+
+    def test_redacts_authenticate(self):
+        f = StringIO()
+        log = TranscriptLog(f, self.clock)
+        log.command_sent('AUTHENTICATE 736563726574')
+        self.assertEqual(f.getvalue(), '0.500000 > AUTHENTICATE\n')
+
+    def test_round_trip(self):
+        f = StringIO()
+        log = TranscriptLog(f, self.clock)
+        log.command_sent('+LOADCONF\r\nSocksPort 9050\r\n.')
+        log.line_received('250 OK')
+        entries = read_transcript(StringIO(f.getvalue() + '\n'))
+        self.assertEqual(entries, [(0.5, '>', '+LOADCONF\r\nSocksPort 9050\r\n.'),
+                                   (1.0, '<', '250 OK')])
+
+    def test_record_session(self):
+        f = StringIO()
+        record_session(f, self.clock)
+        entries = read_transcript(StringIO(f.getvalue()))
+        self.assertEqual(entries[0][1:], ('>', 'PROTOCOLINFO 1'))
+        self.assertTrue((0, '>', 'AUTHENTICATE') in [(0,) + e[1:] for e in entries])
+        self.assertEqual(entries[-1][1:], ('<', '650 STREAM 10 NEW 0 www.example.com:80 SOURCE_ADDR=127.0.0.1:1234 PURPOSE=USER'))
+
+    def test_record_bootstrapped(self):
+        proto = TorControlProtocol()
+        proto.version = '0.2.5.10'
+        proto._set_valid_events('CIRC STREAM')
+        proto.valid_signals = ['NEWNYM']
+        f = StringIO()
+        transcript = record_transcript(proto, f, self.clock)
+        self.assertTrue(proto.debuglog is transcript)
+        self.assertEqual(f.getvalue(), '0.500000 # version 0.2.5.10\n'
+                                       '1.000000 # events CIRC STREAM\n'
+                                       '1.500000 # signals NEWNYM\n')
+
+
+class TranscriptReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        f = StringIO()
+        self.recorded = record_session(f, self.clock)
+        self.entries = read_transcript(StringIO(f.getvalue()))
+
+    def clock(self):
+        self.now += 0.001
+        return self.now
+
+    def test_replay_state(self):
+        replay = TranscriptReplay(self.entries)
+        proto = TorControlProtocol()
+        replay.connect(proto)
+        state = TorState(proto)
+        self.assertTrue(replay.run() > 0)
+
+        self.assertEqual(replay.mismatch, None)
+        self.assertTrue(replay.finished())
+        self.assertEqual(proto.version, '0.2.5.10')
+        self.assertTrue(self.successResultOf(state.post_bootstrap) is state)
+        self.assertEqual(sorted(state.routers.keys()), sorted(self.recorded.routers.keys()))
+        self.assertEqual(sorted(state.circuits.keys()), [1, 2])
+        self.assertEqual(sorted(state.streams.keys()), [10])
+        self.assertEqual(state.tor_pid, 1234)
+
+    def test_replay_mismatch(self):
+        replay = TranscriptReplay(self.entries)
+        proto = TorControlProtocol()
+        replay.connect(proto)
+        state = TorState(proto)
+        proto.queue_command('SIGNAL NEWNYM')
+        replay.run()
+        replay.run()
+        ## the bootstrap commands were queued first
+        self.assertEqual(replay.mismatch, ('GETINFO consensus/valid-after', 'SIGNAL NEWNYM'))
+        self.assertEqual(state.routers, {})
+        self.assertTrue(replay.finished())
+
+    def test_replay_not_strict(self):
+        replay = TranscriptReplay(self.entries, strict=False)
+        proto = TorControlProtocol()
+        replay.connect(proto)
+        proto.queue_command('SIGNAL NEWNYM')
+        replay.run()
+        self.assertEqual(replay.mismatch, None)
+
+    def test_replay_after_bootstrap(self):
+        entries = [(0.0, '#', 'version 0.2.5.10'),
+                   (0.0, '#', 'events CIRC STREAM'),
+                   (0.0, '#', 'signals NEWNYM'),
+                   (1.0, '<', '650 CIRC 1 LAUNCHED'),
+                   (2.0, '>', 'SETEVENTS CIRC'),
+                   (2.0, '<', '250 OK'),
+                   (3.0, '<', '650 CIRC 2 LAUNCHED')]
+        replay = TranscriptReplay(entries)
+        proto = TorControlProtocol()
+        replay.connect(proto)
+        self.assertTrue(self.successResultOf(proto.post_bootstrap) is proto)
+        self.assertEqual(proto.valid_signals, ['NEWNYM'])
+        self.assertEqual(sorted(proto.valid_events.keys()), ['CIRC', 'STREAM'])
+
+        events = []
+        proto.add_event_listener('CIRC', events.append)
+        ## nothing is delivered until run(), so we see both events
+        self.assertEqual(replay.run(), 3)
+        self.assertEqual(events, ['1 LAUNCHED', '2 LAUNCHED'])
+
+    def test_pause(self):
+        replay = TranscriptReplay(self.entries, chunk_lines=1)
+        proto = TorControlProtocol()
+        replay.connect(proto)
+        replay.pauseProducing()
+        self.assertEqual(replay.run(), 0)
+        replay.resumeProducing()
+        self.assertTrue(replay.lines_fed > 0)
+        self.assertEqual(proto.version, '0.2.5.10')
+
+    def test_lose_connection(self):
+        replay = TranscriptReplay(self.entries)
+        proto = TorControlProtocol()
+        replay.connect(proto)
+        lost = []
+        proto.on_disconnect.addCallback(lost.append)
+        replay.loseConnection()
+        replay.loseConnection()
+        self.assertTrue(replay.finished())
+        self.assertEqual(lost, [proto])
+        self.assertEqual(replay.getPeer(), None)
+        self.assertEqual(replay.getHost(), None)
@@ -12,7 +12,10 @@ from txtorcon.router import Router
 from txtorcon.circuit import Circuit
 from txtorcon.stream import Stream
 from txtorcon.torcontrolprotocol import TorControlProtocol, TorProtocolError, TorProtocolFactory, DEFAULT_VALUE
+from txtorcon.torcontrolprotocol import PRIORITY_URGENT, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from txtorcon.pool import TorControlPool
 from txtorcon.torstate import TorState, build_tor_connection, build_local_tor_connection
+from txtorcon.reconnect import TorReconnector
 from txtorcon.torconfig import TorConfig, HiddenService, TorProcessProtocol, launch_tor, TorNotFound
 from txtorcon.torinfo import TorInfo
 from txtorcon.addrmap import AddrMap
@@ -32,6 +35,8 @@ __all__ = ["Router",
            "Stream",
            "TorControlProtocol", "TorProtocolError", "TorProtocolFactory",
            "TorState", "DEFAULT_VALUE",
+           "PRIORITY_URGENT", "PRIORITY_INTERACTIVE", "PRIORITY_BULK",
+           "TorControlPool", "TorReconnector",
            "TorInfo",
            "build_tor_connection", "build_local_tor_connection", "launch_tor", "TorNotFound",
            "TorConfig", "HiddenService", "TorProcessProtocol",
@@ -46,5 +51,6 @@ __all__ = ["Router",
            "ITorControlProtocol",
            "IStreamListener", "IStreamAttacher", "StreamListenerMixin",
            "ICircuitContainer", "ICircuitListener", "CircuitListenerMixin",
-           "IRouterContainer", "IAddrListener", "IProgressProvider", "IHiddenService",
+           "IRouterContainer", "IRouterListener", "RouterListenerMixin",
+           "IAddrListener", "IProgressProvider", "IHiddenService",
            ]
@@ -0,0 +1,220 @@
+"""
+The routers in the consensus as NumPy arrays (one per attribute), for
+statistics over the whole network without a Python loop per router.
+NumPy is optional; it's only needed if you use this.
+"""
+
+import socket
+import struct
+
+from txtorcon.interface import RouterListenerMixin
+from txtorcon.router import flag_mask, _flag_bits
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['ConsensusColumns', 'ipv4_to_int']
+
+
+def ipv4_to_int(ip):
+    """
+    :return: an IPv4 address (like ``'1.2.3.4'``) as an int, or 0 if
+        it isn't one (e.g. ``'unknown'``)
+    """
+
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return 0
+
+
+class ConsensusColumns(RouterListenerMixin):
+    """
+    Keeps a NumPy array for each of these attributes of the routers
+    in a :class:`txtorcon.TorState`, with row ``n`` of every one
+    being ``routers[n]``:
+
+     - ``fingerprint``: the 20-byte identity digests (``S20``)
+     - ``ipv4``: the IPv4 addresses (``uint32``; 0 if unknown)
+     - ``bandwidth``: from the consensus (``int64``)
+     - ``flags``: the :attr:`txtorcon.Router.flag_mask` bitmasks
+       (``uint64``); see :meth:`has_flag`
+     - ``country``: an index into ``countries``, or -1 if the country
+       isn't known (``int16``)
+
+    It's an :class:`txtorcon.interface.IRouterListener` (added to
+    the state by the constructor) so the arrays follow each
+    NEWCONSENSUS. A router that goes away has the last row moved into
+    its place, so the arrays never have gaps (but rows don't stay
+    put; look routers up in ``rows``).
+
+    For example, the exit bandwidth in each country is::
+
+        columns = ConsensusColumns(state)
+        exits = columns.has_flag('exit')
+        totals = numpy.bincount(columns.country[exits] + 1,
+                                weights=columns.bandwidth[exits])
+
+    (``totals[i + 1]`` is for ``columns.countries[i]``; see also
+    :meth:`bandwidth_by_country`.)
+
+    ``country`` stays -1 for every row until it's first read; from
+    then on new and moved routers get theirs straight away, and rows
+    still at -1 are looked up again each time it's read.
+
+    :raises ImportError: if NumPy isn't installed
+    """
+
+    def __init__(self, state):
+        if numpy is None:
+            raise ImportError('ConsensusColumns needs NumPy; try "pip install txtorcon[analytics]"')
+        self.routers = []
+        """the Router for each row"""
+        self.rows = {}
+        """Router -> its row"""
+        self.countries = []
+        """country codes, in the order ``country`` refers to them"""
+        self._country_index = {}        # country code -> index in countries
+        self._located = False
+        self._allocate(max(64, len(state.routers_by_hash)))
+        for router in sorted(state.routers_by_hash.values(), key=lambda r: r.id_hex):
+            self.router_added(router)
+        state.add_router_listener(self)
+
+    def __len__(self):
+        return len(self.routers)
+
+    def _allocate(self, capacity):
+        used = len(self.routers)
+        columns = (('_fingerprint', 'S20', ''), ('_ipv4', numpy.uint32, 0),
+                   ('_bandwidth', numpy.int64, 0), ('_flags', numpy.uint64, 0),
+                   ('_country', numpy.int16, -1))
+        for (name, dtype, empty) in columns:
+            column = numpy.empty(capacity, dtype=dtype)
+            column.fill(empty)
+            if used:
+                column[:used] = getattr(self, name)[:used]
+            setattr(self, name, column)
+
+    ## the arrays; these are views, so they're only good until the
+    ## next consensus changes something
+
+    fingerprint = property(lambda self: self._fingerprint[:len(self.routers)])
+    ipv4 = property(lambda self: self._ipv4[:len(self.routers)])
+    bandwidth = property(lambda self: self._bandwidth[:len(self.routers)])
+    flags = property(lambda self: self._flags[:len(self.routers)])
+
+    @property
+    def country(self):
+        used = len(self.routers)
+        if not self._located:
+            self._located = True
+            for (row, router) in enumerate(self.routers):
+                self._country[row] = self._locate(router)
+        else:
+            for row in numpy.flatnonzero(self._country[:used] < 0):
+                self._country[row] = self._locate(self.routers[row])
+        return self._country[:used]
+
+    def _locate(self, router):
+        code = router.location.countrycode
+        if not code:
+            return -1
+        try:
+            return self._country_index[code]
+        except KeyError:
+            self.countries.append(code)
+            index = self._country_index[code] = len(self.countries) - 1
+            return index
+
+    def _fill(self, row, router):
+        self._fingerprint[row] = router.id_digest
+        self._ipv4[row] = ipv4_to_int(router.ip)
+        self._bandwidth[row] = router.bandwidth
+        self._flags[row] = router.flag_mask
+        self._country[row] = self._locate(router) if self._located else -1
+
+    ## IRouterListener
+
+    def router_added(self, router):
+        if router in self.rows:
+            return
+        row = len(self.routers)
+        if row == len(self._flags):
+            self._allocate(2 * row)
+        self.routers.append(router)
+        self.rows[router] = row
+        self._fill(row, router)
+
+    def router_removed(self, router):
+        row = self.rows.pop(router, None)
+        if row is None:
+            return
+        last = self.routers.pop()
+        if last is not router:
+            ## move the last row into the hole
+            self.routers[row] = last
+            self.rows[last] = row
+            for column in (self._fingerprint, self._ipv4, self._bandwidth, self._flags, self._country):
+                column[row] = column[len(self.routers)]
+
+    def router_updated(self, router, changes):
+        row = self.rows.get(router)
+        if row is None:
+            return
+        if 'ip' in changes:
+            self._ipv4[row] = ipv4_to_int(router.ip)
+            if self._located:
+                self._country[row] = self._locate(router)
+        if 'bandwidth' in changes:
+            self._bandwidth[row] = router.bandwidth
+        if 'flags' in changes:
+            self._flags[row] = router.flag_mask
+
+    ## queries
+
+    def has_flag(self, *flags):
+        """
+        :return: a boolean array, True for the routers with all the
+            flags given (e.g. ``has_flag('exit', 'fast')``)
+        """
+
+        mask = numpy.uint64(flag_mask(flags))
+        return (self.flags & mask) == mask
+
+    def flag_counts(self):
+        """
+        :return: a dict mapping each flag name to how many routers
+            have it
+        """
+
+        flags = self.flags
+        counts = {}
+        for (name, bit) in _flag_bits.items():
+            count = numpy.count_nonzero(flags & numpy.uint64(bit))
+            if count:
+                counts[name] = int(count)
+        return counts
+
+    def bandwidth_by_country(self, *flags):
+        """
+        :return: a dict mapping each country code to the total
+            bandwidth of the routers there with all of ``flags`` (for
+            example ``bandwidth_by_country('exit')``); routers whose
+            country isn't known are under None.
+        """
+
+        country = self.country
+        bandwidth = self.bandwidth
+        if flags:
+            chosen = self.has_flag(*flags)
+            country = country[chosen]
+            bandwidth = bandwidth[chosen]
+        totals = numpy.bincount(country + 1, weights=bandwidth, minlength=len(self.countries) + 1)
+        result = {}
+        for (index, total) in enumerate(totals):
+            if total:
+                result[self.countries[index - 1] if index else None] = int(total)
+        return result
@@ -0,0 +1,180 @@
+"""
+Parsing network-status documents (as from ``GETINFO ns/all`` or NS
+and NEWCONSENSUS events) a line at a time.
+"""
+
+import datetime
+
+__all__ = ['ConsensusParser', 'ConsensusDiff', 'parse_published']
+
+
+_published_cache = {}
+
+
+def parse_published(date, time):
+    """
+    :return: a datetime for the ``date`` (``YYYY-MM-DD``) and
+        ``time`` (``HH:MM:SS``) words of an "r" line. A consensus
+        only has so many different published times (and consecutive
+        consensuses share most of them) so these are cached.
+    """
+
+    key = date + time
+    try:
+        return _published_cache[key]
+    except KeyError:
+        pass
+    try:
+        published = datetime.datetime(int(date[:4]), int(date[5:7]), int(date[8:10]),
+                                      int(time[:2]), int(time[3:5]), int(time[6:8]))
+    except ValueError:
+        raise ValueError('Can\'t parse "%s %s" as a published time.' % (date, time))
+    if len(_published_cache) > 50000:
+        _published_cache.clear()
+    _published_cache[key] = published
+    return published
+
+
+def _skip(line):
+    pass
+
+
+def _ignorable(line):
+    stripped = line.strip()
+    return stripped in ('.', 'OK', '') or line[:3] == 'ns/'
+
+
+class ConsensusParser(object):
+    """
+    Feed this the lines of a network-status document one at a time
+    with :meth:`process`; it calls ``router_begin(line)`` for each "r"
+    line and then ``router_address``, ``router_flags``,
+    ``router_bandwidth`` and ``router_policy`` on ``target`` for the
+    "a", "s", "w" and "p" lines that follow. (This is what
+    :class:`txtorcon.TorState` uses; it replaces a more general
+    state-machine which tried a list of predicates for every line.)
+
+    Each line is dispatched on its first two characters. Lines out of
+    order raise RuntimeError; blank lines, "." and "OK" (and the
+    ``ns/all=`` at the start of a GETINFO reply) are ignored, and
+    mean the next thing must be an "r" line.
+
+    With ``flavor='microdesc'`` this parses a microdescriptor
+    consensus (as from ``GETINFO
+    dir/status-vote/current/consensus-microdesc``) instead: "r" lines
+    have no descriptor digest, there are no "p" lines and each router
+    ends with an "m" line, passed to ``router_microdesc``. "v" and
+    "pr" lines are skipped, and so is anything else between routers
+    (the document's header, footer and signatures).
+    """
+
+    def __init__(self, target, flavor='ns'):
+        begin = target._router_begin
+        ## state -> {line prefix: (handler, next state)}
+        if flavor == 'ns':
+            self._table = {
+                'waiting_r': {'r ': (begin, 'waiting_s')},
+                'waiting_s': {'s ': (target._router_flags, 'waiting_w'),
+                              'a ': (target._router_address, 'waiting_s')},
+                'waiting_w': {'w ': (target._router_bandwidth, 'waiting_p'),
+                              'r ': (begin, 'waiting_s')},
+                'waiting_p': {'p ': (target._router_policy, 'waiting_r'),
+                              'r ': (begin, 'waiting_s')},
+            }
+            self._lenient = ()
+        elif flavor == 'microdesc':
+            self._table = {
+                'waiting_r': {'r ': (begin, 'waiting_s')},
+                'waiting_s': {'s ': (target._router_flags, 'waiting_w'),
+                              'a ': (target._router_address, 'waiting_s')},
+                'waiting_w': {'v ': (_skip, 'waiting_w'),
+                              'pr': (_skip, 'waiting_w'),
+                              'w ': (target._router_bandwidth, 'waiting_m'),
+                              'm ': (target._router_microdesc, 'waiting_r'),
+                              'r ': (begin, 'waiting_s')},
+                'waiting_m': {'m ': (target._router_microdesc, 'waiting_r'),
+                              'r ': (begin, 'waiting_s')},
+            }
+            self._lenient = ('waiting_r',)
+        else:
+            raise ValueError('Unknown consensus flavor "%s"' % flavor)
+        self.flavor = flavor
+        self._expected = {
+            'waiting_r': 'r ',
+            'waiting_s': 's ',
+            'waiting_w': 'w ',
+            'waiting_p': 'p ',
+            'waiting_m': 'm ',
+        }
+        self.reset()
+
+    def reset(self):
+        "Forget any partly-parsed router; the next line must start one."
+        self.state = 'waiting_r'
+        self._transitions = self._table[self.state]
+
+    def process(self, line):
+        try:
+            (handler, state) = self._transitions[line[:2]]
+        except KeyError:
+            if _ignorable(line):
+                state = 'waiting_r'
+            elif self.state in self._lenient:
+                state = self.state
+            else:
+                raise RuntimeError('Expected "%s" while parsing routers not "%s"' % (self._expected[self.state], line))
+        else:
+            handler(line)
+        self.state = state
+        self._transitions = self._table[state]
+
+    def dotty(self):
+        """
+        :return: the states and transitions, as a graphviz graph
+        """
+
+        r = 'digraph fsm {\n\n'
+        for (name, transitions) in sorted(self._table.items()):
+            r += '%s;\n' % name
+            for (prefix, (handler, state)) in sorted(transitions.items()):
+                r += '%s -> %s [label="%s"]\n' % (name, state, prefix.strip())
+            r += '%s -> waiting_r [label="ignorable"]\n' % name
+        r += '\n}\n'
+        return r
+
+
+class ConsensusDiff(object):
+    """
+    What changed between one consensus (or NS event) and the routers
+    we already knew about, as collected by :class:`txtorcon.TorState`
+    while parsing it.
+
+    :ivar added: list of new Routers, in the order they appeared
+
+    :ivar removed: list of Routers which were evicted because they
+        weren't in the new consensus (always empty for an NS event,
+        which only lists the routers it's about); a router some
+        circuit still uses stays until it doesn't
+
+    :ivar evicted: how many Routers were evicted, including those
+        :meth:`txtorcon.TorState.router_from_id` made up
+
+    :ivar updated: dict mapping each changed Router to a dict of
+        attribute name -> previous value
+
+    :ivar seen: set of the hex IDs of every router in the update
+    """
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.updated = {}
+        self.seen = set()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.updated)
+
+    def __str__(self):
+        return '<ConsensusDiff added=%d removed=%d updated=%d>' % (len(self.added), len(self.removed),
+                                                                   len(self.updated))
@@ -0,0 +1,206 @@
+"""
+Typed records for Tor's asynchronous events.
+
+Each event is parsed just once (see :class:`txtorcon.torcontrolprotocol.Event`)
+into one of the namedtuples here and the same record is handed to every
+listener which asked for typed events via
+``add_event_listener(..., typed=True)``.
+
+Every record has an ``args`` member (a tuple of the event split on
+whitespace, as :class:`txtorcon.Circuit` and :class:`txtorcon.Stream`
+want it) and a ``flags`` member (the ``KEY=value`` arguments, as from
+:func:`txtorcon.util.find_keywords`).
+"""
+
+from collections import namedtuple
+
+from txtorcon.util import find_keywords
+
+__all__ = ['CircuitEvent', 'StreamEvent', 'BandwidthEvent', 'CircuitBandwidthEvent',
+           'StreamBandwidthEvent', 'ConnBandwidthEvent', 'ORConnEvent', 'UnknownEvent',
+           'decoder_for', 'BandwidthAggregator']
+
+
+CircuitEvent = namedtuple('CircuitEvent', ['id', 'status', 'path', 'flags', 'args'])
+"""CIRC: ``path`` is a list of LongNames (possibly empty)"""
+
+StreamEvent = namedtuple('StreamEvent', ['id', 'status', 'circuit_id', 'target', 'flags', 'args'])
+"""STREAM: ``circuit_id`` is 0 if the stream isn't attached"""
+
+BandwidthEvent = namedtuple('BandwidthEvent', ['read', 'written', 'flags', 'args'])
+"""BW: bytes read and written in the last second"""
+
+CircuitBandwidthEvent = namedtuple('CircuitBandwidthEvent', ['id', 'read', 'written', 'flags', 'args'])
+"""CIRC_BW"""
+
+StreamBandwidthEvent = namedtuple('StreamBandwidthEvent', ['id', 'written', 'read', 'flags', 'args'])
+"""STREAM_BW (note Tor sends the bytes written first)"""
+
+ConnBandwidthEvent = namedtuple('ConnBandwidthEvent', ['id', 'type', 'read', 'written', 'flags', 'args'])
+"""CONN_BW"""
+
+ORConnEvent = namedtuple('ORConnEvent', ['target', 'status', 'flags', 'args'])
+"""ORCONN"""
+
+UnknownEvent = namedtuple('UnknownEvent', ['name', 'text'])
+"""Any event we don't have a decoder for; ``text`` is as given to
+untyped listeners."""
+
+
+def _decode_circ(text):
+    args = tuple(text.split())
+    if len(args) > 2 and args[2][0] == '$':
+        path = args[2].split(',')
+    else:
+        path = []
+    return CircuitEvent(int(args[0]), args[1], path, find_keywords(args), args)
+
+
+def _decode_stream(text):
+    args = tuple(text.split())
+    return StreamEvent(int(args[0]), args[1], int(args[2]), args[3], find_keywords(args), args)
+
+
+def _decode_bw(text):
+    args = tuple(text.split())
+    return BandwidthEvent(int(args[0]), int(args[1]), find_keywords(args), args)
+
+
+def _decode_circ_bw(text):
+    args = tuple(text.split())
+    kw = find_keywords(args)
+    return CircuitBandwidthEvent(int(kw['ID']), int(kw['READ']), int(kw['WRITTEN']), kw, args)
+
+
+def _decode_stream_bw(text):
+    args = tuple(text.split())
+    return StreamBandwidthEvent(int(args[0]), int(args[1]), int(args[2]), find_keywords(args), args)
+
+
+def _decode_conn_bw(text):
+    args = tuple(text.split())
+    kw = find_keywords(args)
+    return ConnBandwidthEvent(int(kw['ID']), kw.get('TYPE'), int(kw['READ']), int(kw['WRITTEN']), kw, args)
+
+
+def _decode_orconn(text):
+    args = tuple(text.split())
+    return ORConnEvent(args[0], args[1], find_keywords(args), args)
+
+
+DECODERS = {
+    'CIRC': _decode_circ,
+    'STREAM': _decode_stream,
+    'BW': _decode_bw,
+    'CIRC_BW': _decode_circ_bw,
+    'STREAM_BW': _decode_stream_bw,
+    'CONN_BW': _decode_conn_bw,
+    'ORCONN': _decode_orconn,
+}
+
+
+def decoder_for(name):
+    """
+    :return: a callable which turns the text of a ``name`` event into
+        a record; for events we don't know this gives an
+        :class:`UnknownEvent`.
+    """
+
+    try:
+        return DECODERS[name]
+    except KeyError:
+        return lambda text: UnknownEvent(name, text)
+
+
+## these pull just (id, read, written) out of the bandwidth events,
+## for BandwidthAggregator
+
+
+def _bw_totals(text):
+    args = text.split()
+    return (None, int(args[0]), int(args[1]))
+
+
+def _stream_bw_totals(text):
+    args = text.split()
+    return (int(args[0]), int(args[2]), int(args[1]))
+
+
+def _keyword_bw_totals(text):
+    kw = find_keywords(text.split())
+    return (int(kw['ID']), int(kw['READ']), int(kw['WRITTEN']))
+
+
+_BANDWIDTH_TOTALS = {
+    'BW': _bw_totals,
+    'CIRC_BW': _keyword_bw_totals,
+    'STREAM_BW': _stream_bw_totals,
+    'CONN_BW': _keyword_bw_totals,
+}
+
+
+class BandwidthAggregator(object):
+    """
+    A listener for BW, CIRC_BW, STREAM_BW or CONN_BW events which sums
+    the bytes read and written per circuit (or stream, or connection)
+    ID and calls ``callback`` at most once every ``window`` seconds
+    with a dict mapping each ID to a ``(read, written)`` tuple. For BW
+    events the only key is None.
+
+    Nothing is delivered for a window in which no events arrived.
+
+    You can add one of these as an ordinary (untyped) event listener,
+    or use ``add_event_listener(..., window=seconds)`` which does it
+    for you.
+    """
+
+    def __init__(self, name, callback, window, reactor=None):
+        try:
+            self._totals_from = _BANDWIDTH_TOTALS[name]
+        except KeyError:
+            raise ValueError("Can't aggregate %s events." % name)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.name = name
+        self.callback = callback
+        self.window = window
+        self.reactor = reactor
+        self.totals = {}
+        self._delayed_call = None
+
+    def __call__(self, text):
+        (key, read, written) = self._totals_from(text)
+        try:
+            totals = self.totals[key]
+        except KeyError:
+            self.totals[key] = [read, written]
+            if self._delayed_call is None:
+                self._delayed_call = self.reactor.callLater(self.window, self.flush)
+            return
+        totals[0] += read
+        totals[1] += written
+
+    def flush(self):
+        """
+        Deliver whatever has been summed so far, and start a new window.
+        """
+
+        self._cancel()
+        totals = self.totals
+        self.totals = {}
+        if totals:
+            self.callback(dict((k, tuple(v)) for (k, v) in totals.items()))
+
+    def stop(self):
+        """
+        Throw away anything not yet delivered.
+        """
+
+        self._cancel()
+        self.totals = {}
+
+    def _cancel(self):
+        if self._delayed_call is not None:
+            if self._delayed_call.active():
+                self._delayed_call.cancel()
+            self._delayed_call = None
@@ -0,0 +1,577 @@
+"""
+A fake Tor control port, for load-testing txtorcon (or anything else
+which talks to Tor) on one machine with no network and no Tor.
+
+It speaks just enough of control-spec: PROTOCOLINFO, AUTHENTICATE,
+GETINFO (version, events/names, ns/all, the microdescriptor consensus,
+md/all, circuit-status, stream-status and a few more), GETCONF, SETCONF, SETEVENTS, USEFEATURE,
+EXTENDCIRCUIT, ATTACHSTREAM, CLOSECIRCUIT, CLOSESTREAM, SIGNAL and
+QUIT. The consensus is made up of ``routers`` synthetic routers, and
+:meth:`FakeTorControlFactory.start_flood` sends CIRC, STREAM and BW
+events at whatever rate you like.
+
+For example, to run one on port 9051::
+
+    python -m txtorcon.fakecontrol 9051 5000
+
+...and then connect with any password, e.g.
+``build_tor_connection(endpoint, password_function=lambda: 'x')``.
+"""
+
+import os
+import sys
+import random
+import base64
+import hashlib
+import binascii
+
+from twisted.internet import protocol, task
+from twisted.protocols.basic import LineOnlyReceiver
+
+from txtorcon.util import find_keywords
+from txtorcon.microdesc import microdescriptor_digest
+
+__all__ = ['FakeTorControlProtocol', 'FakeTorControlFactory', 'synthetic_consensus']
+
+
+EVENT_NAMES = ('CIRC', 'STREAM', 'ORCONN', 'BW', 'NEWDESC', 'ADDRMAP', 'NS', 'NEWCONSENSUS',
+               'GUARD', 'STREAM_BW', 'CIRC_BW', 'CONN_BW', 'STATUS_GENERAL', 'STATUS_CLIENT')
+
+VALID_AFTER = '2014-12-18 00:00:00'
+
+
+def synthetic_consensus(count, seed=0):
+    """
+    :return: a list of ``count`` made-up routers, each a dict with the
+        keys ``name``, ``id`` (20 bytes), ``digest`` (20 bytes),
+        ``ip``, ``or_port``, ``dir_port``, ``flags`` (list of strings)
+        and ``bandwidth``. The same ``seed`` gives the same routers.
+    """
+
+    rand = random.Random(seed)
+    routers = []
+    for x in range(count):
+        flags = ['Fast', 'Running', 'Stable', 'Valid']
+        if rand.random() < 0.4:
+            flags.insert(1, 'Guard')
+        if rand.random() < 0.3:
+            flags.insert(0, 'Exit')
+        routers.append(dict(
+            name='fake%d' % x,
+            id=''.join(chr(rand.randint(0, 255)) for _ in range(20)),
+            digest=''.join(chr(rand.randint(0, 255)) for _ in range(20)),
+            ip='10.%d.%d.%d' % (rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254)),
+            or_port=rand.choice([443, 9001]),
+            dir_port=rand.choice([0, 80, 9030]),
+            flags=flags,
+            bandwidth=int(rand.paretovariate(1.2) * 20),
+        ))
+    return routers
+
+
+def _network_status(router):
+    """
+    the ns/all lines for one of synthetic_consensus's routers. Like a
+    real consensus, descriptors were published at various times in
+    the preceding day and some routers have an IPv6 "a" line (both
+    derived from the ID, so the routers themselves don't change).
+    """
+    (hour, minute, second, v6) = [ord(x) for x in router['id'][:4]]
+    policy = 'accept 1-65535' if 'Exit' in router['flags'] else 'reject 1-65535'
+    lines = ['r %s %s %s 2014-12-17 %02d:%02d:%02d %s %d %d' % (router['name'],
+                                                                base64.b64encode(router['id']).rstrip('='),
+                                                                base64.b64encode(router['digest']).rstrip('='),
+                                                                hour % 24, minute % 60, second % 60,
+                                                                router['ip'], router['or_port'], router['dir_port'])]
+    if v6 < 50:
+        lines.append('a [2001:db8::%x]:%d' % (v6 * 256 + hour, router['or_port']))
+    lines.extend(['s ' + ' '.join(router['flags']),
+                  'w Bandwidth=%d' % router['bandwidth'],
+                  'p ' + policy])
+    return lines
+
+
+def _microdescriptor(router, family=()):
+    """
+    the md/all text for one of synthetic_consensus's routers; the keys
+    are made up from its ID. ``family`` is the other routers it lists.
+    """
+    key = base64.b64encode(hashlib.sha512(router['id']).digest() * 2)
+    lines = ['onion-key', '-----BEGIN RSA PUBLIC KEY-----']
+    lines.extend(key[x:x + 64] for x in range(0, len(key), 64))
+    lines.append('-----END RSA PUBLIC KEY-----')
+    lines.append('ntor-onion-key ' + base64.b64encode(hashlib.sha256(router['id']).digest()).rstrip('='))
+    if family:
+        lines.append('family ' + ' '.join('$' + binascii.b2a_hex(r['id']).upper() for r in family))
+    if 'Exit' in router['flags']:
+        lines.append('p accept 1-65535')
+    lines.append('id ed25519 ' + base64.b64encode(hashlib.sha256(router['digest']).digest()).rstrip('='))
+    return '\n'.join(lines) + '\n'
+
+
+def _microdesc_status(router, md):
+    """
+    the lines for one of synthetic_consensus's routers in a
+    microdescriptor consensus, given its microdescriptor's text
+    """
+    lines = _network_status(router)[:-1]
+    words = lines[0].split()
+    del words[3]                        # no descriptor digest
+    lines[0] = ' '.join(words)
+    lines.append('m ' + microdescriptor_digest(md))
+    return lines
+
+
+def _families(routers):
+    ## every tenth router is in a family with the next one
+    families = {}
+    for x in range(0, len(routers) - 1, 10):
+        families[x] = [routers[x + 1]]
+        families[x + 1] = [routers[x]]
+    return families
+
+
+def _long_name(router):
+    return '$%s~%s' % (binascii.b2a_hex(router['id']).upper(), router['name'])
+
+
+class FakeTorControlProtocol(LineOnlyReceiver):
+    """
+    One control connection to a :class:`FakeTorControlFactory`.
+    """
+
+    delimiter = '\r\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self):
+        self.authenticated = False
+        self.closing = False
+        self.events = set()
+        self._data_command = None
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.connections:
+            self.factory.connections.remove(self)
+
+    def send_event(self, name, text):
+        "Send an asynchronous event, if this connection asked for it."
+        if name in self.events:
+            self.transport.write('650 %s %s\r\n' % (name, text))
+
+    def lineReceived(self, line):
+        ## commands starting with "+" have data ending with "."
+        if self._data_command is not None:
+            if line == '.':
+                line = self._data_command
+                self._data_command = None
+            else:
+                return
+        elif line.startswith('+'):
+            self._data_command = line[1:]
+            return
+
+        self.factory.commands += 1
+        (verb, _, args) = line.partition(' ')
+        verb = verb.upper()
+        if not self.authenticated and verb not in ('PROTOCOLINFO', 'AUTHENTICATE', 'QUIT'):
+            self.closing = True
+            self.reply(['514 Authentication required.'])
+            return
+
+        handler = getattr(self, 'do_' + verb, None)
+        if handler is None:
+            self.reply(['510 Unrecognized command "%s"' % verb])
+            return
+        self.reply(handler(args))
+
+    def reply(self, lines):
+        self.transport.write('\r\n'.join(lines) + '\r\n')
+        if self.closing:
+            self.transport.loseConnection()
+
+    def do_PROTOCOLINFO(self, args):
+        if self.factory.cookie_file is not None:
+            methods = 'METHODS=COOKIE,HASHEDPASSWORD COOKIEFILE="%s"' % self.factory.cookie_file
+        else:
+            methods = 'METHODS=HASHEDPASSWORD'
+        return ['250-PROTOCOLINFO 1',
+                '250-AUTH ' + methods,
+                '250-VERSION Tor="%s"' % self.factory.version,
+                '250 OK']
+
+    def do_AUTHENTICATE(self, args):
+        ## a password may be quoted or hex-encoded; a cookie is hex
+        secret = args.strip()
+        if secret.startswith('"'):
+            secret = secret.strip('"')
+        else:
+            try:
+                secret = binascii.a2b_hex(secret)
+            except TypeError:
+                secret = None
+        if self.factory.password is None and self.factory.cookie is None:
+            ok = True
+        else:
+            ok = secret is not None and secret in (self.factory.password, self.factory.cookie)
+        if not ok:
+            self.closing = True
+            return ['515 Authentication failed: Password did not match HashedControlPassword value from configuration']
+        self.authenticated = True
+        return ['250 OK']
+
+    def do_QUIT(self, args):
+        self.closing = True
+        return ['250 closing connection']
+
+    def do_USEFEATURE(self, args):
+        return ['250 OK']
+
+    def do_SIGNAL(self, args):
+        return ['250 OK']
+
+    def do_SETEVENTS(self, args):
+        names = [x for x in args.split() if x != 'EXTENDED']
+        for name in names:
+            if name not in EVENT_NAMES:
+                return ['552 Unrecognized event "%s"' % name]
+        self.events = set(names)
+        return ['250 OK']
+
+    def do_GETINFO(self, args):
+        lines = []
+        for key in args.split():
+            try:
+                value = self.factory.info(key)
+            except KeyError:
+                return ['552 Unrecognized key "%s"' % key]
+            if '\n' in value or key in ('ns/all', 'md/all', 'circuit-status'):
+                lines.append('250+%s=' % key)
+                lines.extend(value.split('\n') if value else [])
+                lines.append('.')
+            else:
+                lines.append('250-%s=%s' % (key, value))
+        lines.append('250 OK')
+        return lines
+
+    def do_GETCONF(self, args):
+        keys = args.split()
+        lines = []
+        for key in keys:
+            if key in self.factory.conf:
+                lines.append('%s=%s' % (key, self.factory.conf[key]))
+            else:
+                lines.append(key)
+        if not lines:
+            return ['250 OK']
+        return ['250-' + x for x in lines[:-1]] + ['250 ' + lines[-1]]
+
+    def do_SETCONF(self, args):
+        for (key, value) in find_keywords(args.split()).items():
+            self.factory.conf[key] = value.strip('"')
+        return ['250 OK']
+
+    def do_EXTENDCIRCUIT(self, args):
+        args = args.split()
+        if not args:
+            return ['512 Missing argument to EXTENDCIRCUIT']
+        circid = int(args[0])
+        if circid != 0 and circid not in self.factory.circuits:
+            return ['552 Unknown circuit "%d"' % circid]
+        if len(args) > 1 and '=' not in args[1]:
+            path = args[1].split(',')
+        else:
+            path = None
+        circid = self.factory.build_circuit(path, circid)
+        if circid is None:
+            return ['552 No such router']
+        return ['250 EXTENDED %d' % circid]
+
+    def do_ATTACHSTREAM(self, args):
+        args = args.split()
+        if len(args) < 2:
+            return ['512 Missing argument to ATTACHSTREAM']
+        (streamid, circid) = (int(args[0]), int(args[1]))
+        if streamid not in self.factory.streams:
+            return ['552 Unknown stream "%d"' % streamid]
+        if circid != 0 and circid not in self.factory.circuits:
+            return ['552 Unknown circuit "%d"' % circid]
+        self.factory.attach_stream(streamid, circid)
+        return ['250 OK']
+
+    def do_CLOSECIRCUIT(self, args):
+        circid = int(args.split()[0])
+        if circid not in self.factory.circuits:
+            return ['552 Unknown circuit "%d"' % circid]
+        self.factory.close_circuit(circid)
+        return ['250 OK']
+
+    def do_CLOSESTREAM(self, args):
+        streamid = int(args.split()[0])
+        if streamid not in self.factory.streams:
+            return ['552 Unknown stream "%d"' % streamid]
+        self.factory.close_stream(streamid)
+        return ['250 OK']
+
+
+class FakeTorControlFactory(protocol.ServerFactory):
+    """
+    Listen with this to get a fake Tor control port. Everything about
+    the "Tor" (routers, circuits, streams and configuration) lives
+    here and is shared by all connections.
+
+    :ivar attach_latencies: for each stream attached by a controller
+        (when ``__LeaveStreamsUnattached`` is set) the seconds between
+        its NEW event and the ATTACHSTREAM.
+
+    :ivar commands: the number of commands we've answered.
+    """
+
+    protocol = FakeTorControlProtocol
+
+    def __init__(self, routers=100, password=None, cookie_file=None, seed=0,
+                 max_circuits=100, max_streams=100, reactor=None):
+        """
+        :param routers: how many routers are in the consensus
+
+        :param password: if not None, the password we want
+
+        :param cookie_file: if not None, we offer COOKIE authentication
+            and write a random cookie to this path. With neither this
+            nor a ``password``, anything authenticates.
+
+        :param max_circuits: event floods close the oldest circuit
+            once there are this many (and likewise ``max_streams``)
+        """
+
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.version = '0.2.5.10 (fake)'
+        self.password = password
+        self.cookie_file = cookie_file
+        self.cookie = None
+        if cookie_file is not None:
+            self.cookie = os.urandom(32)
+            with open(cookie_file, 'wb') as f:
+                f.write(self.cookie)
+        self.rand = random.Random(seed)
+        self.routers = synthetic_consensus(routers, seed)
+        self.max_circuits = max_circuits
+        self.max_streams = max_streams
+        self.conf = {'SocksPort': '9050', '__LeaveStreamsUnattached': '0'}
+        self.circuits = {}
+        self.streams = {}
+        self.connections = []
+        self.attach_latencies = []
+        self.commands = 0
+        self._next_id = 1
+        self._stream_created = {}
+        self._flood = None
+        self._flood_events = ()
+        self._flood_count = 0
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id - 1
+
+    def send_event(self, name, text):
+        for proto in self.connections:
+            proto.send_event(name, text)
+
+    def info(self, key):
+        """
+        :return: the value for GETINFO ``key``
+        :raises KeyError: if we don't know ``key``
+        """
+
+        if key == 'version':
+            return self.version
+        if key == 'events/names':
+            return ' '.join(EVENT_NAMES)
+        if key == 'ns/all':
+            lines = []
+            for router in self.routers:
+                lines.extend(_network_status(router))
+            return '\n'.join(lines)
+        if key == 'md/all':
+            families = _families(self.routers)
+            return ''.join(_microdescriptor(router, families.get(x, ()))
+                           for (x, router) in enumerate(self.routers)).rstrip('\n')
+        if key == 'dir/status-vote/current/consensus-microdesc':
+            families = _families(self.routers)
+            lines = ['network-status-version 3 microdesc',
+                     'vote-status consensus',
+                     'valid-after ' + VALID_AFTER,
+                     'known-flags Exit Fast Guard Running Stable Valid']
+            for (x, router) in enumerate(self.routers):
+                lines.extend(_microdesc_status(router, _microdescriptor(router, families.get(x, ()))))
+            lines.extend(['directory-footer',
+                          'bandwidth-weights Wgg=10000',
+                          'directory-signature 0000000000000000000000000000000000000000 0000000000000000000000000000000000000000',
+                          '-----BEGIN SIGNATURE-----',
+                          'AAAA',
+                          '-----END SIGNATURE-----'])
+            return '\n'.join(lines)
+        if key == 'circuit-status':
+            return '\n'.join(self._circuit_text(circid) for circid in sorted(self.circuits))
+        if key == 'stream-status':
+            return '\n'.join(self._stream_text(streamid) for streamid in sorted(self.streams))
+        if key in ('address-mappings/all', 'entry-guards'):
+            return ''
+        if key == 'process/pid':
+            return str(os.getpid())
+        if key == 'consensus/valid-after':
+            return VALID_AFTER
+        if key == 'status/bootstrap-phase':
+            return 'NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"'
+        raise KeyError(key)
+
+    def _circuit_text(self, circid):
+        (status, path) = self.circuits[circid]
+        if path:
+            return '%d %s %s PURPOSE=GENERAL' % (circid, status, ','.join(map(_long_name, path)))
+        return '%d %s PURPOSE=GENERAL' % (circid, status)
+
+    def _stream_text(self, streamid):
+        (status, circid, target) = self.streams[streamid]
+        return '%d %s %d %s' % (streamid, status, circid, target)
+
+    def _router(self, name):
+        name = name.lstrip('$').split('~')[0].split('=')[0]
+        for router in self.routers:
+            if router['name'] == name or binascii.b2a_hex(router['id']).upper() == name.upper():
+                return router
+        return None
+
+    def build_circuit(self, path=None, circid=0):
+        """
+        Build (or, if ``circid`` isn't 0, extend) a circuit through
+        ``path`` (router names or hex IDs; random routers if None),
+        sending the CIRC events as we go.
+
+        :return: the circuit ID, or None if a router wasn't found
+        """
+
+        if path is None:
+            path = self.rand.sample(self.routers, min(3, len(self.routers)))
+        else:
+            path = [self._router(x) for x in path]
+            if None in path:
+                return None
+        if circid == 0:
+            circid = self._new_id()
+            self.circuits[circid] = ('LAUNCHED', [])
+            self.send_event('CIRC', self._circuit_text(circid))
+        hops = self.circuits[circid][1]
+        for router in path:
+            hops = hops + [router]
+            self.circuits[circid] = ('EXTENDED', hops)
+            self.send_event('CIRC', self._circuit_text(circid))
+        self.circuits[circid] = ('BUILT', hops)
+        self.send_event('CIRC', self._circuit_text(circid))
+        return circid
+
+    def close_circuit(self, circid):
+        ## like Tor, close any streams on it first
+        for (streamid, (status, stream_circ, target)) in self.streams.items():
+            if stream_circ == circid:
+                self.close_stream(streamid)
+        self.circuits[circid] = ('CLOSED', self.circuits[circid][1])
+        self.send_event('CIRC', self._circuit_text(circid) + ' REASON=FINISHED')
+        del self.circuits[circid]
+
+    def new_stream(self, target=None):
+        """
+        Make a new stream (as if a SOCKS client connected); unless
+        ``__LeaveStreamsUnattached`` is set it's attached to a built
+        circuit (if there is one) right away.
+
+        :return: the stream ID
+        """
+
+        if target is None:
+            target = 'www%d.example.com:80' % self.rand.randint(0, 1000)
+        streamid = self._new_id()
+        self.streams[streamid] = ('NEW', 0, target)
+        self._stream_created[streamid] = self.reactor.seconds()
+        self.send_event('STREAM', self._stream_text(streamid) + ' SOURCE_ADDR=127.0.0.1:%d PURPOSE=USER' % (1024 + streamid % 60000))
+        if self.conf.get('__LeaveStreamsUnattached') != '1':
+            built = [c for (c, (status, path)) in self.circuits.items() if status == 'BUILT']
+            if built:
+                self.attach_stream(streamid, self.rand.choice(built), controller=False)
+        return streamid
+
+    def attach_stream(self, streamid, circid, controller=True):
+        created = self._stream_created.pop(streamid, None)
+        if controller and created is not None:
+            self.attach_latencies.append(self.reactor.seconds() - created)
+        if circid == 0:
+            circid = self.build_circuit()
+        target = self.streams[streamid][2]
+        self.streams[streamid] = ('SENTCONNECT', circid, target)
+        self.send_event('STREAM', self._stream_text(streamid))
+        self.streams[streamid] = ('SUCCEEDED', circid, target)
+        self.send_event('STREAM', self._stream_text(streamid))
+
+    def close_stream(self, streamid):
+        (status, circid, target) = self.streams.pop(streamid)
+        self._stream_created.pop(streamid, None)
+        self.send_event('STREAM', '%d CLOSED %d %s REASON=DONE' % (streamid, circid, target))
+
+    def start_flood(self, rate, events=('CIRC', 'STREAM', 'BW'), interval=0.1):
+        """
+        Send about ``rate`` events per second (to connections which
+        asked for them) until :meth:`stop_flood`, taking turns between
+        the kinds in ``events``: each CIRC turn builds (and perhaps
+        closes) a circuit, each STREAM turn opens (and perhaps closes)
+        a stream and each BW turn is one BW event.
+        """
+
+        self.stop_flood()
+        self._flood_events = events
+        self._flood_count = 0
+        self._flood = task.LoopingCall(self._flood_tick, max(1, int(rate * interval)))
+        self._flood.clock = self.reactor
+        self._flood.start(interval)
+
+    def stop_flood(self):
+        if self._flood is not None and self._flood.running:
+            self._flood.stop()
+        self._flood = None
+
+    def _flood_tick(self, count):
+        for x in range(count):
+            kind = self._flood_events[self._flood_count % len(self._flood_events)]
+            self._flood_count += 1
+            if kind == 'CIRC':
+                self.build_circuit()
+                if len(self.circuits) > self.max_circuits:
+                    self.close_circuit(min(self.circuits))
+            elif kind == 'STREAM':
+                self.new_stream()
+                if len(self.streams) > self.max_streams:
+                    self.close_stream(min(self.streams))
+            elif kind == 'BW':
+                self.send_event('BW', '%d %d' % (self.rand.randint(0, 65536), self.rand.randint(0, 65536)))
+
+
+def main(argv=sys.argv):
+    """
+    Run a fake control port: ``python -m txtorcon.fakecontrol [port [routers [events-per-second]]]``
+    """
+
+    from twisted.internet import reactor
+    port = int(argv[1]) if len(argv) > 1 else 9051
+    factory = FakeTorControlFactory(routers=int(argv[2]) if len(argv) > 2 else 1000)
+    reactor.listenTCP(port, factory, interface='127.0.0.1')
+    if len(argv) > 3:
+        factory.start_flood(int(argv[3]))
+    print "Fake Tor control port listening on 127.0.0.1:%d" % port
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
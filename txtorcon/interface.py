@@ -308,13 +308,15 @@ class ITorControlProtocol(Interface):
         the existing ones)
         """
 
-    def add_event_listener(evt, callback):
+    def add_event_listener(evt, callback, typed=False, window=None, reactor=None):
         """
         Add a listener to an Event object. This may be called multiple
         times for the same event. Every time the event happens, the
         callback method will be called. The callback has one argument
         (a string, the contents of the event, minus the '650' and the
-        name of the event)
+        name of the event) or, if typed is True, a record from
+        :mod:`txtorcon.events`. For bandwidth events, window=N instead
+        calls it with per-ID totals every N seconds.
 
         FIXME: should have an interface for the callback.
         """
@@ -341,6 +343,55 @@ class IRouterContainer(Interface):
         """
 
 
+class IRouterListener(Interface):
+    """
+    Notifications about changes to the routers in the consensus, as
+    :class:`txtorcon.TorState` hears about them (the initial
+    ``ns/all``, NEWCONSENSUS and NS events). Each update only calls
+    these for the routers which actually changed. See
+    :meth:`txtorcon.TorState.add_router_listener`.
+    """
+
+    def router_added(router):
+        "a Router we didn't know about appeared in the consensus"
+
+    def router_removed(router):
+        """
+        a Router was evicted: it isn't in the newest consensus and no
+        circuit goes through it (so it's not in TorState's lists
+        anymore). See :meth:`txtorcon.TorState.evict_routers`.
+        """
+
+    def router_updated(router, changes):
+        """
+        something about a Router we already knew changed.
+
+        :param changes:
+            a dict mapping the name of each attribute which changed
+            (``name``, ``or_hash``, ``modified``, ``ip``, ``or_port``,
+            ``dir_port``, ``ip_v6``, ``flags``, ``bandwidth``,
+            ``policy`` or ``md_digest``) to its previous value; the
+            Router already has the new ones.
+        """
+
+
+class RouterListenerMixin(object):
+    """
+    Implements all of IRouterListener with no-op methods. Subclass
+    from this if you don't care about most of the notifications.
+    """
+    implements(IRouterListener)
+
+    def router_added(self, router):
+        pass
+
+    def router_removed(self, router):
+        pass
+
+    def router_updated(self, router, changes):
+        pass
+
+
 class IAddrListener(Interface):
     def addrmap_added(addr):
         """
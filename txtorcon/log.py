@@ -2,9 +2,12 @@
 This module handles txtorcon debug messages.
 """
 
+import time
+from collections import deque
+
 from twisted.python import log as twlog
 
-__all__ = ['txtorlog']
+__all__ = ['txtorlog', 'DebugLog', 'RingBufferLog']
 
 txtorlog = twlog.LogPublisher()
 
@@ -15,3 +18,57 @@ def debug_logging():
 
     txtorlog.addObserver(stdobserver.emit)
     txtorlog.addObserver(fileobserver.emit)
+
+
+## The following are "debug logs" for TorControlProtocol; see
+## TorControlProtocol.start_debug. Any object with line_received()
+## and command_sent() methods will do.
+
+class DebugLog(object):
+    """
+    Writes every line we receive from Tor and every command we send
+    to a file-like object (this is what
+    :meth:`txtorcon.TorControlProtocol.start_debug` does by default).
+    """
+
+    def __init__(self, f):
+        self.file = f
+
+    def line_received(self, line):
+        self.file.write(line + '\n')
+        self.file.flush()
+
+    def command_sent(self, cmd):
+        self.file.write(cmd + '\n')
+        self.file.flush()
+
+
+class RingBufferLog(object):
+    """
+    Remembers the last ``size`` lines exchanged with Tor in memory
+    (with a timestamp and direction) so they can be dumped after
+    something goes wrong, without doing any I/O along the way.
+
+    :ivar entries:
+        a deque of (timestamp, direction, line) tuples, oldest first,
+        where direction is '<' for lines from Tor and '>' for our
+        commands.
+    """
+
+    def __init__(self, size=1000, clock=time.time):
+        self.entries = deque(maxlen=size)
+        self._clock = clock
+
+    def line_received(self, line):
+        self.entries.append((self._clock(), '<', line))
+
+    def command_sent(self, cmd):
+        self.entries.append((self._clock(), '>', cmd))
+
+    def dump(self, f):
+        """
+        Write all the entries we have to the file-like object f, one
+        per line.
+        """
+        for (timestamp, direction, line) in self.entries:
+            f.write('%.6f %s %s\n' % (timestamp, direction, line))
@@ -0,0 +1,186 @@
+"""
+Microdescriptors, as in ``GETINFO md/all``: what a Tor client
+actually downloads about each router (keys, family and a summary of
+the exit policy) instead of the full descriptor.
+"""
+
+import base64
+import hashlib
+
+__all__ = ['Microdescriptor', 'MicrodescriptorParser', 'microdescriptor_digest']
+
+
+def microdescriptor_digest(text):
+    """
+    :return: the digest of a microdescriptor's text, as on the "m"
+        line for it in a microdescriptor consensus (SHA256,
+        base64-encoded without the padding).
+    """
+
+    return base64.b64encode(hashlib.sha256(text).digest()).rstrip('=')
+
+
+def _b64decode(value):
+    return base64.b64decode(value + '=' * (-len(value) % 4))
+
+
+class Microdescriptor(object):
+    """
+    One router's microdescriptor. Only the text is kept until one of
+    the properties is asked for; most of them never are for most
+    routers, so the policy summaries and ntor key are found in the
+    text when they're wanted, everything else is split up the first
+    time any of it is, and keys aren't decoded until they're used.
+
+    :ivar text: the whole microdescriptor, as Tor sent it
+    """
+
+    __slots__ = ('text', '_digest', '_fields')
+
+    def __init__(self, text, digest=None):
+        self.text = text
+        self._digest = digest
+        self._fields = None
+
+    @property
+    def digest(self):
+        "how the consensus refers to us; see :func:`microdescriptor_digest`"
+        if self._digest is None:
+            self._digest = microdescriptor_digest(self.text)
+        return self._digest
+
+    def _value(self, keyword):
+        ## a keyword which appears at most once: look for just that
+        ## line (which is all loading a router needs) rather than
+        ## splitting up the whole thing
+        text = self.text
+        start = text.find('\n' + keyword + ' ')
+        if start < 0:
+            return None
+        start += len(keyword) + 2
+        end = text.find('\n', start)
+        if end < 0:
+            end = len(text)
+        return text[start:end].strip()
+
+    def _field(self, keyword):
+        if self._fields is None:
+            fields = {}
+            block = None
+            for line in self.text.split('\n'):
+                if block is not None:
+                    block.append(line)
+                    if line.startswith('-----END'):
+                        block = None
+                    continue
+                if line.startswith('-----BEGIN'):
+                    ## the onion-key's PEM block
+                    block = fields.setdefault('onion-key', [])
+                    block.append(line)
+                    continue
+                (word, _, rest) = line.partition(' ')
+                if word:
+                    fields.setdefault(word, []).append(rest)
+            self._fields = fields
+        return self._fields.get(keyword, ())
+
+    @property
+    def onion_key(self):
+        "the (TAP) onion key, as DER-encoded bytes, or None"
+        lines = self._field('onion-key')
+        body = ''.join(line for line in lines if line and not line.startswith('-----'))
+        if not body:
+            return None
+        return base64.b64decode(body)
+
+    @property
+    def ntor_onion_key(self):
+        "the 32-byte curve25519 ntor onion key, or None"
+        value = self._value('ntor-onion-key')
+        if value is None:
+            return None
+        return _b64decode(value)
+
+    @property
+    def ed25519_id(self):
+        "the 32-byte ed25519 identity, or None"
+        for value in self._field('id'):
+            (kind, _, key) = value.partition(' ')
+            if kind == 'ed25519':
+                return _b64decode(key.strip())
+        return None
+
+    @property
+    def family(self):
+        """
+        a tuple of the routers this one says are in its family, each
+        as ``$FINGERPRINT`` (maybe followed by ``~name`` or
+        ``=name``) or a nickname; see
+        :meth:`txtorcon.TorState.router_family`
+        """
+        words = []
+        for value in self._field('family'):
+            words.extend(value.split())
+        return tuple(words)
+
+    @property
+    def policy(self):
+        """
+        the IPv4 exit-policy summary, like ``accept 80,443`` (a
+        microdescriptor without one rejects everything)
+        """
+        return self._value('p') or 'reject 1-65535'
+
+    @property
+    def policy6(self):
+        "the IPv6 exit-policy summary, like ``policy``"
+        return self._value('p6') or 'reject 1-65535'
+
+    @property
+    def ip_v6(self):
+        "a tuple of the addresses from any ``a`` lines"
+        return tuple(value.strip() for value in self._field('a'))
+
+    def __repr__(self):
+        return '<Microdescriptor %s>' % self.digest
+
+
+class MicrodescriptorParser(object):
+    """
+    Feed this the lines of a ``GETINFO md/all`` (or ``md/id/...``)
+    reply one at a time with :meth:`process`, e.g. as the callback for
+    :meth:`txtorcon.TorControlProtocol.get_info_incremental`; each
+    microdescriptor starts at an "onion-key" line. Anything before the
+    first one (like the ``md/all=``) is ignored, as are blank lines
+    and the "." at the end.
+
+    :ivar microdescriptors: list of the
+        :class:`txtorcon.microdesc.Microdescriptor` instances found
+        so far
+    """
+
+    def __init__(self):
+        self.microdescriptors = []
+        self._lines = None
+
+    def process(self, line):
+        if line.startswith('onion-key'):
+            self._end()
+            self._lines = [line]
+        elif self._lines is not None and line not in ('.', ''):
+            self._lines.append(line)
+
+    def _end(self):
+        if self._lines:
+            ## Tor's digest covers the trailing newline
+            self.microdescriptors.append(Microdescriptor('\n'.join(self._lines) + '\n'))
+        self._lines = None
+
+    def finish(self):
+        """
+        :return: all the microdescriptors, once the last line has been
+            fed in
+        """
+
+        self._end()
+        return self.microdescriptors
@@ -0,0 +1,214 @@
+"""
+Choosing routers for circuits at random, weighted by bandwidth the
+way Tor does, to hand to :meth:`txtorcon.TorState.build_circuit`.
+"""
+
+import bisect
+import random
+
+from txtorcon.interface import RouterListenerMixin
+
+__all__ = ['PathSelector', 'subnet']
+
+
+def subnet(router):
+    """
+    :return: the /16 a router's IPv4 address is in (Tor won't put two
+        routers from the same /16 in one circuit), or None if its
+        address isn't known.
+    """
+
+    if router.ip == 'unknown':
+        return None
+    return router.ip.rsplit('.', 2)[0]
+
+
+class _WeightedTable(object):
+    """
+    Routers with the running totals of their bandwidths, so a
+    bandwidth-weighted choice is one random number and a bisect.
+    """
+
+    def __init__(self, routers):
+        self.routers = sorted(routers, key=lambda r: r.id_hex)
+        self.totals = []
+        total = 0
+        for router in self.routers:
+            total += router.bandwidth
+            self.totals.append(total)
+        if self.routers and not total:
+            ## no router reports any bandwidth, so treat them all
+            ## the same (as Tor does)
+            self.totals = range(1, len(self.routers) + 1)
+        self.total = self.totals[-1] if self.totals else 0
+
+    def __len__(self):
+        return len(self.routers)
+
+    def choose(self, rand):
+        return self.routers[bisect.bisect_right(self.totals, rand.random() * self.total)]
+
+    def weight(self, index):
+        if index == 0:
+            return self.totals[0]
+        return self.totals[index] - self.totals[index - 1]
+
+
+class PathSelector(RouterListenerMixin):
+    """
+    Picks guard, middle and exit routers at random, weighted by
+    bandwidth, and whole paths of them which don't share a /16 or a
+    family. :class:`txtorcon.TorState` keeps one as ``path_selector``
+    (see :meth:`txtorcon.TorState.random_path`).
+
+    A table of running bandwidth totals for each role (and, for exits,
+    each port asked about) is built the first time it's needed and
+    then kept until the consensus changes something, so choosing a
+    router takes a bisect rather than a pass over every router.
+
+    The roles are:
+
+     - guard: Guard, Fast, Stable, Running and Valid
+     - middle: Fast, Running and Valid
+     - exit: Exit, Fast, Running and Valid but not BadExit (and, if
+       given, with an exit policy accepting the port)
+
+    Bandwidths are the ones from the consensus ``w`` lines; Tor
+    further scales them by the position weights at the end of the
+    consensus (``Wgg``, ``Wee`` etc.), which we don't have.
+
+    :param family: if given, called with a Router to get the Routers
+        in its family (e.g. from its microdescriptor), none of which
+        are used alongside it. The consensus doesn't say.
+
+    :ivar random: where random numbers come from; by default a
+        :class:`random.SystemRandom`.
+    """
+
+    roles = {
+        'guard': ('guard', 'fast', 'stable', 'running', 'valid'),
+        'middle': ('fast', 'running', 'valid'),
+        'exit': ('exit', 'fast', 'running', 'valid'),
+    }
+
+    ## how many times to pick again when a choice isn't allowed
+    ## before looking through the candidates for ones that are
+    retries = 20
+
+    def __init__(self, state, family=None):
+        self.state = state
+        self.family = family
+        self.random = random.SystemRandom()
+        self._tables = {}               # (role, port) -> _WeightedTable
+
+    ## IRouterListener
+
+    def router_added(self, router):
+        self._tables.clear()
+
+    def router_removed(self, router):
+        self._tables.clear()
+
+    def router_updated(self, router, changes):
+        if 'flags' in changes or 'bandwidth' in changes or 'policy' in changes:
+            self._tables.clear()
+
+    ## choosing
+
+    def _table(self, role, port=None):
+        key = (role, port)
+        try:
+            return self._tables[key]
+        except KeyError:
+            pass
+        try:
+            flags = self.roles[role]
+        except KeyError:
+            raise ValueError('Unknown role "%s"; should be one of: %s' % (role, ', '.join(sorted(self.roles))))
+        routers = self.state.routers_where(flags=flags, port=port)
+        if role == 'exit':
+            routers -= self.state.routers_where(flags=('badexit',))
+        table = self._tables[key] = _WeightedTable(routers)
+        return table
+
+    def _excluder(self, path):
+        routers = set(path)
+        subnets = set()
+        for router in path:
+            subnets.add(subnet(router))
+            if self.family is not None:
+                routers.update(self.family(router))
+        subnets.discard(None)
+
+        def excluded(router):
+            if router in routers or subnet(router) in subnets:
+                return True
+            if self.family is not None:
+                return not routers.isdisjoint(self.family(router))
+            return False
+        return excluded
+
+    def choose(self, role, port=None, path=()):
+        """
+        :return: a Router for ``role`` (``'guard'``, ``'middle'`` or
+            ``'exit'``), chosen at random weighted by bandwidth.
+
+        :param port: for an exit, a port its exit policy must accept
+
+        :param path: Routers already chosen for the same circuit; the
+            one returned won't be any of them, nor in the same /16 or
+            family as any of them.
+        """
+
+        table = self._table(role, port)
+        excluded = self._excluder(path)
+        for x in range(self.retries):
+            if not table:
+                break
+            router = table.choose(self.random)
+            if not excluded(router):
+                return router
+
+        ## most of the weight must be excluded, so pick from what's left
+        allowed = [i for i in range(len(table)) if not excluded(table.routers[i])]
+        if not allowed:
+            raise RuntimeError('No %s router is usable with the path: %s' % (role, ', '.join(r.unique_name for r in path)))
+        choice = self.random.random() * sum(table.weight(i) for i in allowed)
+        for i in allowed:
+            choice -= table.weight(i)
+            if choice < 0:
+                break
+        return table.routers[i]
+
+    def random_path(self, length=3, exit_port=None, using_guards=True):
+        """
+        :return: a list of ``length`` Routers, suitable for
+            :meth:`txtorcon.TorState.build_circuit`: a guard, then
+            middle routers, then an exit. As Tor does, the exit is
+            chosen first, then the guard and then the middles.
+
+        :param exit_port: a port the exit's policy must accept
+
+        :param using_guards: if True (the default) and we know our
+            entry guards, the first router is one of those (at random)
+            rather than any router with the Guard flag; this is what
+            ``build_circuit`` wants.
+        """
+
+        if length < 2:
+            raise ValueError('A path needs at least 2 routers (a guard and an exit), not %d' % length)
+        path = [self.choose('exit', port=exit_port)]
+        guard = None
+        if using_guards:
+            excluded = self._excluder(path)
+            guards = sorted((g for g in self.state.entry_guards.values()
+                             if g.id_hex in self.state.routers_by_hash and not excluded(g)),
+                            key=lambda g: g.id_hex)
+            if guards:
+                guard = self.random.choice(guards)
+        if guard is None:
+            guard = self.choose('guard', path=path)
+        path.append(guard)
+        for x in range(length - 2):
+            path.append(self.choose('middle', path=path))
+        return [guard] + path[2:] + [path[0]]
@@ -0,0 +1,161 @@
+"""
+A pool of control connections to the same Tor which looks like a
+single :class:`txtorcon.TorControlProtocol`, so that big queries
+(``GETINFO ns/all`` and friends) don't hold up everything else.
+"""
+
+from twisted.internet import defer
+from zope.interface import implements
+
+from txtorcon.interface import ITorControlProtocol
+from txtorcon.torcontrolprotocol import parse_keywords
+from txtorcon.torcontrolprotocol import PRIORITY_INTERACTIVE, PRIORITY_BULK
+
+__all__ = ['TorControlPool', 'connect_pool']
+
+
+READ_VERBS = ('GETINFO', 'GETCONF', 'PROTOCOLINFO')
+"""Commands which only read from Tor, and so may be sent on any
+connection in any order"""
+
+BULK_INFO_PREFIXES = ('ns/', 'md/', 'desc/', 'extra-info/', 'dir/')
+"""GETINFO keys with these prefixes are (usually) big replies"""
+
+
+def _is_read(cmd):
+    return cmd.split(None, 1)[0].upper() in READ_VERBS
+
+
+class TorControlPool(object):
+    """
+    Several authenticated control connections to one Tor, used as if
+    they were a single :class:`txtorcon.TorControlProtocol` (so you
+    can give one to :class:`txtorcon.TorState` or
+    :class:`txtorcon.TorConfig`).
+
+    Bulk reads -- ``get_info_incremental``, ``get_info_stream``,
+    GETINFO of keys like ``ns/all`` or ``desc/all-recent`` and
+    read-only commands queued with ``PRIORITY_BULK`` -- go to the
+    least-busy secondary connection. Everything else, including all
+    event subscriptions and any command which changes Tor's state,
+    goes to the primary so those stay in order.
+
+    Any attribute not mentioned here (``post_bootstrap``,
+    ``on_disconnect``, ``version``, ``add_event_listener`` etc.)
+    is the primary's.
+
+    A secondary which disconnects is simply dropped from the pool;
+    with no secondaries left, everything goes to the primary.
+    """
+
+    implements(ITorControlProtocol)
+
+    def __init__(self, primary, secondaries=()):
+        """
+        :param primary: a bootstrapped TorControlProtocol
+        :param secondaries: more bootstrapped TorControlProtocols
+            connected to the same Tor
+        """
+
+        self.primary = primary
+        self.secondaries = []
+        for proto in secondaries:
+            self.add_secondary(proto)
+
+    def __getattr__(self, name):
+        ## only called for things we don't have ourselves; zope.interface
+        ## looks for things like __provides__, which mustn't come from
+        ## the primary
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def add_secondary(self, proto):
+        """
+        Start using another (bootstrapped) connection for bulk
+        reads.
+        """
+
+        self.secondaries.append(proto)
+        if proto.on_disconnect is not None:
+            proto.on_disconnect.addBoth(self._secondary_lost, proto)
+
+    def _secondary_lost(self, arg, proto):
+        if proto in self.secondaries:
+            self.secondaries.remove(proto)
+        return None
+
+    def bulk_connection(self):
+        """
+        :return: the TorControlProtocol the next bulk read should go
+            to; this is the secondary with the fewest commands queued
+            or awaiting a reply (or the primary, if there are none)
+        """
+
+        if not self.secondaries:
+            return self.primary
+        return min(self.secondaries, key=lambda p: len(p.commands) + len(p.in_flight))
+
+    def queue_command(self, cmd, arg=None, priority=PRIORITY_INTERACTIVE, timeout=None):
+        "See :meth:`txtorcon.TorControlProtocol.queue_command`"
+        proto = self.primary
+        if priority == PRIORITY_BULK and _is_read(cmd):
+            proto = self.bulk_connection()
+        return proto.queue_command(cmd, arg, priority=priority, timeout=timeout)
+
+    def get_info_raw(self, *args):
+        "See :meth:`txtorcon.TorControlProtocol.get_info_raw`"
+        keys = ' '.join(map(str, args)).split()
+        if keys and all(k.startswith(BULK_INFO_PREFIXES) for k in keys):
+            return self.bulk_connection().get_info_raw(*args)
+        return self.primary.get_info_raw(*args)
+
+    def get_info(self, *args):
+        "See :meth:`txtorcon.TorControlProtocol.get_info`"
+        return self.get_info_raw(*args).addCallback(parse_keywords)
+
+    def get_info_incremental(self, key, line_cb, priority=PRIORITY_BULK):
+        "See :meth:`txtorcon.TorControlProtocol.get_info_incremental`"
+        proto = self.primary
+        if priority == PRIORITY_BULK:
+            proto = self.bulk_connection()
+        return proto.get_info_incremental(key, line_cb, priority=priority)
+
+    def get_info_stream(self, key, consumer, record_start=None, priority=PRIORITY_BULK):
+        "See :meth:`txtorcon.TorControlProtocol.get_info_stream`"
+        proto = self.primary
+        if priority == PRIORITY_BULK:
+            proto = self.bulk_connection()
+        return proto.get_info_stream(key, consumer, record_start, priority=priority)
+
+
+def connect_pool(endpoint, factory, connections=2):
+    """
+    Connects to Tor ``connections`` times via ``endpoint`` (an
+    IStreamClientEndpoint) using ``factory`` (usually a
+    :class:`txtorcon.TorProtocolFactory`).
+
+    :return: a Deferred which callbacks with a :class:`TorControlPool`
+        once every connection has authenticated and bootstrapped. The
+        first connection to be asked for is the primary. If any of
+        them fails, the others are closed and the Deferred errbacks
+        with the first failure.
+    """
+
+    def bootstrapped(proto):
+        return proto.post_bootstrap
+
+    def all_done(results):
+        failures = [result for (ok, result) in results if not ok]
+        if failures:
+            for (ok, proto) in results:
+                if ok:
+                    proto.transport.loseConnection()
+            return failures[0]
+        protocols = [proto for (ok, proto) in results]
+        return TorControlPool(protocols[0], protocols[1:])
+
+    ds = [endpoint.connect(factory).addCallback(bootstrapped) for _ in range(connections)]
+    d = defer.DeferredList(ds, consumeErrors=True)
+    d.addCallback(all_done)
+    return d
@@ -0,0 +1,128 @@
+"""
+Keeps a :class:`txtorcon.TorState` connected to Tor across lost
+control connections and Tor restarts.
+"""
+
+from twisted.internet import defer
+
+from txtorcon.torcontrolprotocol import TorProtocolFactory
+from txtorcon.torstate import TorState
+from txtorcon.log import txtorlog
+
+__all__ = ['TorReconnector']
+
+
+class TorReconnector(object):
+    """
+    Connects to Tor via ``endpoint`` and builds a TorState. Whenever
+    the control connection is lost, this reconnects (waiting
+    ``initial_delay`` seconds at first, then backing off by ``factor``
+    up to ``max_delay`` between attempts), re-authenticates and then
+    brings the same TorState up to date with
+    :meth:`txtorcon.TorState.resync` -- so the router list is only
+    re-read if the consensus changed.
+
+    For example::
+
+        reconnector = TorReconnector(TCP4ClientEndpoint(reactor, "localhost", 9051))
+        d = reconnector.start()
+        d.addCallback(lambda state: ...)
+    """
+
+    def __init__(self, endpoint, password_function=lambda: None, reactor=None,
+                 initial_delay=1.0, max_delay=60.0, factor=2.0):
+        """
+        :param endpoint: an IStreamClientEndpoint for Tor's control port
+        :param password_function: see :class:`txtorcon.TorControlProtocol`
+        :param reactor: provides callLater; the global reactor by default
+        """
+
+        if reactor is None:
+            from twisted.internet import reactor
+        self.endpoint = endpoint
+        self.factory = TorProtocolFactory(password_function=password_function)
+        self.reactor = reactor
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+
+        self.state = None
+        """The TorState, once we've bootstrapped it the first time"""
+
+        self.delay = initial_delay
+        self.stopped = True
+        self.resync_listeners = []
+        self._started = None
+        self._delayed_connect = None
+
+    def start(self):
+        """
+        :return: a Deferred which callbacks with the TorState once the
+            first connection has bootstrapped
+        """
+
+        self.stopped = False
+        self._started = defer.Deferred()
+        self._connect()
+        return self._started
+
+    def stop(self):
+        """
+        Stop reconnecting. This doesn't close the current connection.
+        """
+
+        self.stopped = True
+        if self._delayed_connect is not None and self._delayed_connect.active():
+            self._delayed_connect.cancel()
+        self._delayed_connect = None
+
+    def add_resync_listener(self, callback):
+        """
+        ``callback`` is called with the TorState after each successful
+        reconnect and resync (but not after the first connection).
+        """
+
+        self.resync_listeners.append(callback)
+
+    def _connect(self):
+        self._delayed_connect = None
+        d = self.endpoint.connect(self.factory)
+        d.addCallback(lambda proto: proto.post_bootstrap)
+        d.addCallback(self._connected)
+        d.addErrback(self._failed)
+        return d
+
+    def _schedule_connect(self):
+        if self.stopped or self._delayed_connect is not None:
+            return
+        txtorlog.msg("Reconnecting to Tor in %s seconds." % self.delay)
+        self._delayed_connect = self.reactor.callLater(self.delay, self._connect)
+        self.delay = min(self.delay * self.factor, self.max_delay)
+
+    @defer.inlineCallbacks
+    def _connected(self, proto):
+        proto.on_disconnect.addBoth(self._disconnected)
+        if self.state is None:
+            state = TorState(proto)
+            yield state.post_bootstrap
+            self.state = state
+            self.delay = self.initial_delay
+            self._started.callback(state)
+        else:
+            yield self.state.resync(proto)
+            self.delay = self.initial_delay
+            for callback in self.resync_listeners:
+                callback(self.state)
+
+    def _disconnected(self, arg):
+        txtorlog.msg("Lost control connection to Tor.")
+        self._schedule_connect()
+        return None
+
+    def _failed(self, fail):
+        ## connecting, authenticating or resyncing failed (if the
+        ## connection was lost too, _disconnected already scheduled
+        ## the retry)
+        txtorlog.msg("Connecting to Tor failed: %s" % fail.getErrorMessage())
+        self._schedule_connect()
+        return None
@@ -1,5 +1,6 @@
 from util import NetLocation
 import types
+import binascii
 
 
 def hexIdFromHash(thehash):
@@ -7,7 +8,7 @@ def hexIdFromHash(thehash):
     From the base-64 encoded hashes Tor uses, this produces the longer
     hex-encoded hashes.
     """
-    return "$" + (thehash + "=").decode("base64").encode("hex").upper()
+    return "$" + binascii.b2a_hex(binascii.a2b_base64(thehash + "=")).upper()
 
 
 def hashFromHexId(hexid):
@@ -19,10 +20,108 @@ def hashFromHexId(hexid):
     return hexid.decode("hex").encode("base64")[:-2]
 
 
+## every flag we've seen gets a bit; a Router keeps its flags as the
+## OR of those, and the (sorted, lower-case) tuple for each distinct
+## combination is made once and shared
+_flag_bits = {}
+_flag_tuples = {}
+_flag_masks = {}                        # cache: "s" line -> mask
+for _name in ('authority', 'badexit', 'exit', 'fast', 'guard', 'hsdir', 'named',
+              'running', 'stable', 'unnamed', 'v2dir', 'valid'):
+    _flag_bits[_name] = 1 << len(_flag_bits)
+
+
+def flag_mask(flags):
+    """
+    :param flags: flag names (any case), as a list or a
+        space-separated string (like the end of an "s" line)
+
+    :return: the bitmask for these flags, as kept in
+        :attr:`Router.flag_mask`. Flags no one has seen before are
+        given new bits, as control-spec says we must tolerate them.
+    """
+
+    if isinstance(flags, types.StringTypes):
+        try:
+            return _flag_masks[flags]
+        except KeyError:
+            pass
+        words = flags.split()
+    else:
+        words = flags
+    mask = 0
+    for flag in words:
+        flag = flag.lower()
+        try:
+            mask |= _flag_bits[flag]
+        except KeyError:
+            _flag_bits[flag] = 1 << len(_flag_bits)
+            mask |= _flag_bits[flag]
+    if words is not flags:
+        if len(_flag_masks) > 10000:
+            _flag_masks.clear()
+        _flag_masks[flags] = mask
+    return mask
+
+
+def flags_from_mask(mask):
+    """
+    :return: a tuple of the (lower-case, sorted) flag names in ``mask``
+    """
+
+    try:
+        return _flag_tuples[mask]
+    except KeyError:
+        names = tuple(sorted(name for (name, bit) in _flag_bits.items() if mask & bit))
+        _flag_tuples[mask] = names
+        return names
+
+
+_NAMED = flag_mask('named')
+
+
+## parsed policies by text, shared by all the Routers with that policy
+_policies = {}
+
+
+def _parse_policy(word, ports):
+    key = word + ' ' + ports
+    try:
+        return _policies[key]
+    except KeyError:
+        pass
+    if word not in ('accept', 'reject'):
+        raise RuntimeError("Don't understand policy word \"%s\"" % word)
+    parsed = []
+    for port in ports.split(','):
+        if '-' in port:
+            (a, b) = port.split('-')
+            parsed.append(PortRange(int(a), int(b)))
+        else:
+            parsed.append(int(port))
+    parsed = tuple(parsed)
+    text = (word + ' ' + ','.join(map(str, parsed))) if parsed else ''
+    if len(_policies) > 10000:
+        _policies.clear()
+    policy = _policies[key] = (word == 'accept', parsed, text)
+    return policy
+
+
+_ports = {}
+
+
+def _port(port):
+    "ports as (shared) ints"
+    port = int(port)
+    return _ports.setdefault(port, port)
+
+
 class PortRange(object):
     """
     Represents a range of ports for Router policies.
     """
+    __slots__ = ('min', 'max')
+
     def __init__(self, a, b):
         self.min = a
         self.max = b
@@ -51,35 +150,90 @@ class Router(object):
     After setting the policy property you may call accepts_port() to
     find out if the router will accept a given port. This works with
     the reject or accept based policies.
+
+    There is one of these for every relay, so they're kept small:
+    there's no ``__dict__`` (subclasses get one, though), flags are a
+    bitmask (``flag_mask``; ``flags`` is a tuple of names), ports are
+    ints, the descriptor digest is kept in binary and routers with
+    the same policy share it.
     """
 
+    __slots__ = ('controller', 'name', 'id_hex', '_or_digest', 'modified', 'ip',
+                 'or_port', 'dir_port', 'ip_v6', '_flag_mask', 'name_is_unique',
+                 '_bandwidth', '_policy', '_location', 'from_consensus', 'generation',
+                 'md_digest', '_microdescriptor')
+
     def __init__(self, controller):
         self.controller = controller
-        self._flags = []
+        self._flag_mask = 0
         self.bandwidth = 0
         self.name_is_unique = False
-        self.accepted_ports = None
-        self.rejected_ports = None
+        self._policy = None
         self.id_hex = None
         self._location = None
         self.from_consensus = False
         self.ip = 'unknown'
-        self.ip_v6 = []                 # most routers have no IPv6 addresses
+        self.ip_v6 = ()                 # most routers have no IPv6 addresses
+        self.generation = 0             # see TorState.consensus_generation
+        self.md_digest = None           # from the "m" line of a microdesc consensus
+        self._microdescriptor = None
 
     unique_name = property(lambda x: x.name_is_unique and x.name or x.id_hex)
     "has the hex id if this router's name is not unique, or its name otherwise"
 
     def update(self, name, idhash, orhash, modified, ip, orport, dirport):
-        self.name = name
-        self.id_hash = idhash
+        self.name = intern(name)
         self.or_hash = orhash
         self.modified = modified
         self.ip = ip
-        self.or_port = orport
-        self.dir_port = dirport
+        self.or_port = _port(orport)
+        self.dir_port = _port(dirport)
         self._location = None
 
-        self.id_hex = hexIdFromHash(self.id_hash)
+        ## we keep the hex form (rather than binary) as it's also the
+        ## key TorState indexes us by, so it's shared with the dicts
+        self.id_hex = hexIdFromHash(idhash)
+
+    @property
+    def id_hash(self):
+        "the identity fingerprint, base64-encoded (as in the consensus)"
+        if self.id_hex is None:
+            return None
+        return hashFromHexId(self.id_hex)
+
+    @property
+    def id_digest(self):
+        "the identity fingerprint as 20 bytes"
+        if self.id_hex is None:
+            return None
+        return binascii.a2b_hex(self.id_hex[1:])
+
+    @property
+    def or_hash(self):
+        """
+        the descriptor digest, base64-encoded (as in the consensus);
+        None if we got this router from a microdescriptor consensus,
+        which doesn't have them
+        """
+        if self._or_digest is None:
+            return None
+        return binascii.b2a_base64(self._or_digest)[:-2]
+
+    @or_hash.setter
+    def or_hash(self, orhash):
+        if orhash is None:
+            self._or_digest = None
+        else:
+            self._or_digest = binascii.a2b_base64(orhash + '=')
+
+    @property
+    def microdescriptor(self):
+        """
+        the :class:`txtorcon.microdesc.Microdescriptor` for this
+        router, if it's been loaded (see
+        :meth:`txtorcon.TorState.load_microdescriptors`), or None
+        """
+        return self._microdescriptor
 
     @property
     def location(self):
@@ -105,10 +259,14 @@ class Router(object):
     @property
     def flags(self):
         """
-        A list of all the flags for this Router, each one an
-        all-lower-case string.
+        A tuple of all the flags for this Router, each one an
+        all-lower-case string (in alphabetical order, like Tor). See
+        also :attr:`flag_mask` and :meth:`has_flag`.
+
+        May be set to a list of flag names or a space-separated string
+        of them (of any case).
         """
-        return self._flags
+        return flags_from_mask(self._flag_mask)
 
     @flags.setter
     def flags(self, flags):
@@ -120,10 +278,25 @@ class Router(object):
         There is some current work in Twisted for open-ended constants
         (enums) support however, it seems.
         """
-        if isinstance(flags, types.StringType):
-            flags = flags.split()
-        self._flags = map(lambda x: x.lower(), flags)
-        self.name_is_unique = 'named' in self._flags
+        self.flag_mask = flag_mask(flags)
+
+    @property
+    def flag_mask(self):
+        """
+        This Router's flags as a bitmask; compare against
+        :func:`txtorcon.router.flag_mask`, e.g.
+        ``router.flag_mask & flag_mask('guard')``
+        """
+        return self._flag_mask
+
+    @flag_mask.setter
+    def flag_mask(self, mask):
+        self._flag_mask = mask
+        self.name_is_unique = bool(mask & _NAMED)
+
+    def has_flag(self, flag):
+        ":return: True if this Router has ``flag`` (any case)"
+        return bool(self._flag_mask & flag_mask((flag,)))
 
     @property
     def bandwidth(self):
@@ -140,12 +313,9 @@ class Router(object):
         Port policies for this Router.
         :return: a string describing the policy
         """
-        if self.accepted_ports:
-            return 'accept ' + ','.join(map(str, self.accepted_ports))
-        elif self.rejected_ports:
-            return 'reject ' + ','.join(map(str, self.rejected_ports))
-        else:
+        if self._policy is None:
             return ''
+        return self._policy[2]
 
     @policy.setter
     def policy(self, args):
@@ -153,42 +323,40 @@ class Router(object):
         setter for the policy descriptor
         """
 
-        word = args[0]
-        if word == 'reject':
-            self.accepted_ports = None
-            self.rejected_ports = []
-            target = self.rejected_ports
-
-        elif word == 'accept':
-            self.accepted_ports = []
-            self.rejected_ports = None
-            target = self.accepted_ports
+        if isinstance(args, types.StringTypes):
+            args = args.split()
+        self._policy = _parse_policy(args[0], args[1] if len(args) > 1 else '')
 
-        else:
-            raise RuntimeError("Don't understand policy word \"%s\"" % word)
+    @property
+    def accepted_ports(self):
+        "ports (and PortRanges) accepted, if this is an accept policy"
+        if self._policy is None or not self._policy[0]:
+            return None
+        return self._policy[1]
 
-        for port in args[1].split(','):
-            if '-' in port:
-                (a, b) = port.split('-')
-                target.append(PortRange(int(a), int(b)))
-            else:
-                target.append(int(port))
+    @property
+    def rejected_ports(self):
+        "ports (and PortRanges) rejected, if this is a reject policy"
+        if self._policy is None or self._policy[0]:
+            return None
+        return self._policy[1]
 
     def accepts_port(self, port):
         """
         Query whether this Router will accept the given port.
         """
 
-        if self.rejected_ports is None and self.accepted_ports is None:
+        if self._policy is None:
             raise RuntimeError("policy hasn't been set yet")
 
-        if self.rejected_ports:
-            for x in self.rejected_ports:
+        (accept, ports, text) = self._policy
+        if not accept and ports:
+            for x in ports:
                 if port == x:
                     return False
             return True
 
-        for x in self.accepted_ports:
+        for x in ports:
             if port == x:
                 return True
         return False
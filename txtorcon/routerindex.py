@@ -0,0 +1,229 @@
+"""
+Indexes over the routers in the consensus, so questions like "Exit,
+Fast and Stable routers in Germany accepting port 443" can be answered
+by intersecting a few sets rather than looking at every Router.
+"""
+
+from zope.interface import implements
+
+from txtorcon.interface import IRouterListener
+from txtorcon.router import flag_mask
+
+__all__ = ['RouterIndex', 'bandwidth_bucket']
+
+
+def bandwidth_bucket(bandwidth):
+    """
+    :return: the bucket a bandwidth is indexed under; bucket ``n``
+        holds bandwidths from ``2**(n-1)`` up to ``2**n - 1``.
+    """
+
+    return int(bandwidth).bit_length()
+
+
+def _add(index, key, router):
+    try:
+        index[key].add(router)
+    except KeyError:
+        index[key] = set([router])
+
+
+def _discard(index, key, router):
+    routers = index.get(key)
+    if routers is not None:
+        routers.discard(router)
+        if not routers:
+            del index[key]
+
+
+def _bits(mask):
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+
+class RouterIndex(object):
+    """
+    Keeps sets of Routers by flag, exit policy and bandwidth bucket
+    (and, once anyone asks for them, by country code and ASN),
+    updated as routers come and go: :class:`txtorcon.TorState` keeps
+    one as ``router_index`` and tells it about each change, as an
+    :class:`txtorcon.interface.IRouterListener`. Use
+    :meth:`txtorcon.TorState.routers_where` (or :meth:`where`) to
+    query it.
+
+    The country and ASN indexes are filled in from each
+    :attr:`txtorcon.Router.location` by the first query with a
+    ``country`` or ``asn``, and then kept up to date like the others.
+    Routers whose country wasn't known yet are looked at again on
+    each country query, as Tor may have answered since.
+    """
+
+    implements(IRouterListener)
+
+    def __init__(self):
+        self.routers = set()
+        self._by_flag = {}              # flag bit -> set of Routers
+        self._by_policy = {}            # policy text -> set of Routers
+        self._by_bandwidth = {}         # bandwidth_bucket -> set of Routers
+        self._by_country = None         # countrycode -> set of Routers
+        self._by_asn = None             # asn -> set of Routers
+        self._located = {}              # Router -> (countrycode, asn) indexed under
+        self._cache = {}                # (port or bandwidth query) -> set of Routers
+
+    def _index(self, router):
+        for bit in _bits(router.flag_mask):
+            _add(self._by_flag, bit, router)
+        _add(self._by_policy, router.policy, router)
+        _add(self._by_bandwidth, bandwidth_bucket(router.bandwidth), router)
+        if self._by_country is not None:
+            self._locate(router)
+
+    def _locate(self, router):
+        location = router.location
+        key = (location.countrycode or None, location.asn)
+        self._located[router] = key
+        _add(self._by_country, key[0], router)
+        _add(self._by_asn, key[1], router)
+
+    def _unlocate(self, router):
+        key = self._located.pop(router, None)
+        if key is not None:
+            _discard(self._by_country, key[0], router)
+            _discard(self._by_asn, key[1], router)
+
+    ## IRouterListener
+
+    def router_added(self, router):
+        self._cache.clear()
+        self.routers.add(router)
+        self._index(router)
+
+    def router_removed(self, router):
+        if router not in self.routers:
+            return
+        self._cache.clear()
+        self.routers.discard(router)
+        for bit in _bits(router.flag_mask):
+            _discard(self._by_flag, bit, router)
+        _discard(self._by_policy, router.policy, router)
+        _discard(self._by_bandwidth, bandwidth_bucket(router.bandwidth), router)
+        self._unlocate(router)
+
+    def router_updated(self, router, changes):
+        if router not in self.routers:
+            return
+        if 'flags' in changes:
+            old = flag_mask(changes['flags'])
+            for bit in _bits(old & ~router.flag_mask):
+                _discard(self._by_flag, bit, router)
+            for bit in _bits(router.flag_mask & ~old):
+                _add(self._by_flag, bit, router)
+        if 'policy' in changes:
+            self._cache.clear()
+            _discard(self._by_policy, changes['policy'], router)
+            _add(self._by_policy, router.policy, router)
+        if 'bandwidth' in changes:
+            self._cache.clear()
+            _discard(self._by_bandwidth, bandwidth_bucket(changes['bandwidth']), router)
+            _add(self._by_bandwidth, bandwidth_bucket(router.bandwidth), router)
+        if 'ip' in changes and router in self._located:
+            self._unlocate(router)
+            self._locate(router)
+
+    ## queries
+
+    def _ensure_located(self):
+        if self._by_country is None:
+            self._by_country = {}
+            self._by_asn = {}
+            for router in self.routers:
+                self._locate(router)
+
+    def _country(self, countrycode):
+        self._ensure_located()
+        for router in list(self._by_country.get(None, ())):
+            if router.location.countrycode:
+                self._unlocate(router)
+                self._locate(router)
+        return self._by_country.get(countrycode, set())
+
+    def _accepting(self, port):
+        ## attachers ask about the same few ports over and over, so
+        ## remember the answer until some router's policy changes
+        try:
+            return self._cache['port', port]
+        except KeyError:
+            pass
+        accepting = set()
+        for (policy, routers) in self._by_policy.items():
+            if not policy:
+                continue
+            ## every router in here has the same policy, so ask any
+            for router in routers:
+                break
+            if router.accepts_port(port):
+                accepting.update(routers)
+        self._cache['port', port] = accepting
+        return accepting
+
+    def _bandwidth_at_least(self, bandwidth):
+        try:
+            return self._cache['bandwidth', bandwidth]
+        except KeyError:
+            pass
+        lowest = bandwidth_bucket(bandwidth)
+        routers = self._cache['bandwidth', bandwidth] = set()
+        for (bucket, members) in self._by_bandwidth.items():
+            if bucket > lowest:
+                routers.update(members)
+            elif bucket == lowest:
+                routers.update(r for r in members if r.bandwidth >= bandwidth)
+        return routers
+
+    def where(self, flags=None, country=None, asn=None, port=None, min_bandwidth=None):
+        """
+        :return: a new set of the Routers matching all the criteria
+            given; with none at all, every Router.
+
+        :param flags: flag names (or a space-separated string of them)
+            a router must have all of, e.g. ``('exit', 'fast')``
+
+        :param country: a country code (e.g. ``'DE'``)
+
+        :param asn: an ASN, as from :class:`txtorcon.util.NetLocation`
+
+        :param port: a port the router's exit policy must accept
+
+        :param min_bandwidth: the least bandwidth a router may have
+        """
+
+        candidates = []
+        if flags:
+            mask = flag_mask(flags)
+            for bit in _bits(mask):
+                candidates.append(self._by_flag.get(bit, set()))
+        if country is not None:
+            candidates.append(self._country(country))
+        if asn is not None:
+            self._ensure_located()
+            candidates.append(self._by_asn.get(asn, set()))
+
+        if min_bandwidth is not None:
+            candidates.append(self._bandwidth_at_least(min_bandwidth))
+        if port is not None:
+            candidates.append(self._accepting(port))
+
+        ## a set of every router (e.g. "running") doesn't narrow
+        ## anything down, and intersecting big sets is the slow part
+        candidates = [c for c in candidates if len(c) < len(self.routers)]
+        if not candidates:
+            return set(self.routers)
+        candidates.sort(key=len)
+        result = set(candidates[0])
+        for other in candidates[1:]:
+            if not result:
+                break
+            result.intersection_update(other)
+        return result
@@ -1,14 +1,15 @@
 from __future__ import with_statement
 
 from twisted.python import log
-from twisted.internet import defer
-from twisted.internet.interfaces import IProtocolFactory
-from twisted.internet.error import ConnectionDone
+from twisted.internet import defer, threads
+from twisted.internet.interfaces import IProtocolFactory, IPushProducer
+from twisted.internet.error import ConnectionDone, TimeoutError
 from twisted.protocols.basic import LineOnlyReceiver
 from zope.interface import implements
 
 from txtorcon.util import hmac_sha256, compare_via_hash
-from txtorcon.log import txtorlog
+from txtorcon.log import txtorlog, DebugLog
+from txtorcon.events import decoder_for, BandwidthAggregator
 
 from txtorcon.interface import ITorControlProtocol
 from spaghetti import FSM, State, Transition
@@ -17,9 +18,20 @@ import os
 import re
 import types
 import base64
+from collections import deque, Mapping
 
 DEFAULT_VALUE = 'DEFAULT'
 
+## priorities for queue_command; lower numbers are issued first
+PRIORITY_URGENT = 0
+"""For commands that something is actively waiting on, like
+ATTACHSTREAM, CLOSESTREAM and CLOSECIRCUIT."""
+PRIORITY_INTERACTIVE = 1
+"""The default priority for commands."""
+PRIORITY_BULK = 2
+"""For large queries (like GETINFO ns/all) that shouldn't hold up
+anything else."""
+
 
 class TorProtocolError(RuntimeError):
     """
@@ -39,6 +51,19 @@ class TorProtocolError(RuntimeError):
         return str(self.code) + ' ' + self.text
 
 
+def _read_cookie_file(cookie):
+    """
+    Reads a Tor authentication cookie (this is run in a thread; see
+    TorControlProtocol._read_cookie)
+    """
+
+    with open(cookie, 'r') as cookiefile:
+        data = cookiefile.read()
+    if len(data) != 32:
+        raise RuntimeError("Expected authentication cookie to be 32 bytes, got %d" % len(data))
+    return data
+
+
 class TorProtocolFactory(object):
     """
     Builds TorControlProtocol objects. Implements IProtocolFactory for
@@ -50,7 +75,7 @@ class TorProtocolFactory(object):
 
     implements(IProtocolFactory)
 
-    def __init__(self, password_function=lambda: None):
+    def __init__(self, password_function=lambda: None, pipeline_depth=1):
         """
         Builds protocols to talk to a Tor client on the specified
         address. For example::
@@ -66,8 +91,13 @@ class TorProtocolFactory(object):
            password (or a Deferred). By default, it returns None. This
            is only queried if the Tor we connect to doesn't support
            (or hasn't enabled) COOKIE authentication.
+
+        :param pipeline_depth:
+           Passed on to every :class:`txtorcon.TorControlProtocol` we
+           build; see there.
         """
         self.password_function = password_function
+        self.pipeline_depth = pipeline_depth
 
     def doStart(self):
         ":api:`twisted.internet.interfaces.IProtocolFactory` API"
@@ -77,11 +107,358 @@ class TorProtocolFactory(object):
 
     def buildProtocol(self, addr):
         ":api:`twisted.internet.interfaces.IProtocolFactory` API"
-        proto = TorControlProtocol(self.password_function)
+        proto = TorControlProtocol(self.password_function,
+                                   pipeline_depth=self.pipeline_depth)
         proto.factory = self
         return proto
 
 
+class CommandQueue(object):
+    """
+    Holds the commands TorControlProtocol hasn't issued yet. There is
+    one first-in, first-out lane (a deque) per priority (see
+    PRIORITY_URGENT, PRIORITY_INTERACTIVE and PRIORITY_BULK) and the
+    oldest command in the most-urgent non-empty lane is issued next.
+
+    Iterating (or indexing) gives the commands in the order they would
+    be issued.
+    """
+
+    def __init__(self, priorities=PRIORITY_BULK + 1):
+        self.lanes = [deque() for _ in range(priorities)]
+        self._length = 0
+
+    def append(self, command, priority=PRIORITY_INTERACTIVE):
+        if priority < 0 or priority >= len(self.lanes):
+            raise ValueError("Unknown command priority %r" % (priority,))
+        self.lanes[priority].append(command)
+        self._length += 1
+
+    def popleft(self):
+        for lane in self.lanes:
+            if lane:
+                self._length -= 1
+                return lane.popleft()
+        raise IndexError("pop from an empty CommandQueue")
+
+    def remove(self, command):
+        """
+        Removes a command which hasn't been issued yet; raises
+        ValueError if it isn't queued.
+        """
+        for lane in self.lanes:
+            if command in lane:
+                lane.remove(command)
+                self._length -= 1
+                return
+        raise ValueError("Command not in queue")
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for lane in self.lanes:
+            for command in lane:
+                yield command
+
+    def __getitem__(self, idx):
+        return list(self)[idx]
+
+
+class CommandLatency(object):
+    """
+    Issue-to-reply latency, in seconds, of all the commands with one
+    verb (like GETINFO); see
+    :attr:`txtorcon.TorControlProtocol.latency`
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.last = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def __str__(self):
+        return '<CommandLatency count=%d mean=%s max=%f>' % (self.count, self.mean, self.max)
+
+
+class QueryCoalescer(object):
+    """
+    Merges the GETINFO (or GETCONF) queries made during one reactor
+    turn into a single command to Tor, and hands each caller back just
+    the part of the reply for the keys it asked for. See
+    :meth:`txtorcon.TorControlProtocol.start_coalescing`.
+
+    If Tor rejects the merged command (for example, because one of
+    the keys is unrecognized) each original query is re-issued on its
+    own so that only the bad ones fail.
+    """
+
+    def __init__(self, protocol, verb, reactor):
+        self.protocol = protocol
+        self.verb = verb
+        self.reactor = reactor
+        self.pending = []               # (keys, Deferred) tuples
+        self._delayed_flush = None
+
+    def _normalize(self, key):
+        ## GETCONF is case-insensitive and answers with Tor's idea of
+        ## the capitalization; GETINFO echoes the keys back as-is
+        if self.verb == 'GETCONF':
+            return key.lower()
+        return key
+
+    def query(self, keys):
+        """
+        :param keys: a list of keys
+
+        :return: a Deferred which fires with the raw reply to
+            ``<verb> <keys>`` (as from queue_command)
+        """
+        d = defer.Deferred()
+        self.pending.append((keys, d))
+        if self._delayed_flush is None:
+            self._delayed_flush = self.reactor.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Issue whatever is pending now. Called via callLater at the
+        end of the reactor turn in which the first query arrived.
+        """
+        if self._delayed_flush is not None:
+            if self._delayed_flush.active():
+                self._delayed_flush.cancel()
+            self._delayed_flush = None
+        pending = self.pending
+        self.pending = []
+        if len(pending) == 0:
+            return
+        if len(pending) == 1:
+            (keys, d) = pending[0]
+            self._issue(keys).chainDeferred(d)
+            return
+
+        allkeys = []
+        seen = set()
+        for (keys, d) in pending:
+            for k in keys:
+                if self._normalize(k) not in seen:
+                    seen.add(self._normalize(k))
+                    allkeys.append(k)
+        d = self._issue(allkeys)
+        d.addCallbacks(self._fan_out, self._fall_back,
+                       callbackArgs=(pending, allkeys), errbackArgs=(pending,))
+
+    def _issue(self, keys):
+        return self.protocol.queue_command('%s %s' % (self.verb, ' '.join(keys)))
+
+    def _split(self, raw, keys):
+        """
+        Splits a raw reply into a dict of (normalized) key -> list of
+        lines. Tor answers in the order the keys were asked for, so
+        each key's lines start at the first line beginning with that
+        key; any other line naming one of the keys (say, a line of
+        some multi-line value which happens to start with
+        ``net/listeners/socks=``) makes the split ambiguous.
+
+        Returns None if it's ambiguous, or if some line can't be
+        attributed to one of the keys we asked for (e.g. a GETCONF
+        of a "virtual" key like HiddenServiceOptions).
+        """
+        keys = [self._normalize(k) for k in keys]
+        wanted = set(keys)
+        chunks = {}
+        current = None
+        upcoming = iter(keys)
+        for line in raw.split('\n'):
+            key = self._normalize(line.split('=', 1)[0])
+            if key == current and self.verb == 'GETCONF':
+                ## options with several values are repeated
+                pass
+            elif key in wanted:
+                if key != next(upcoming, None):
+                    return None
+                current = key
+                chunks[key] = []
+            elif current is None or self.verb == 'GETCONF':
+                return None
+            chunks[current].append(line)
+        return chunks
+
+    def _fan_out(self, raw, pending, allkeys):
+        chunks = self._split(raw, allkeys)
+        if chunks is None:
+            return self._fall_back(None, pending)
+        for (keys, d) in pending:
+            lines = []
+            for k in keys:
+                lines.extend(chunks.get(self._normalize(k), []))
+            d.callback('\n'.join(lines))
+
+    def _fall_back(self, fail, pending):
+        if fail is not None and not fail.check(TorProtocolError):
+            for (keys, d) in pending:
+                d.errback(fail)
+            return
+        for (keys, d) in pending:
+            self._issue(keys).chainDeferred(d)
+
+
+RECORD_STARTS = {
+    'ns/': 'r ',
+    'md/': 'onion-key',
+    'desc/': 'router ',
+    'extra-info/': 'extra-info ',
+}
+"""The first line of each record in the replies to the GETINFO keys
+starting with these prefixes; see
+:meth:`txtorcon.TorControlProtocol.get_info_stream`"""
+
+
+class InfoRecordProducer(object):
+    """
+    Delivers the reply to a single (probably large) GETINFO key to an
+    IConsumer one record at a time, as it arrives. Used by
+    :meth:`txtorcon.TorControlProtocol.get_info_stream`.
+
+    A record is a string of one or more lines (joined with
+    newlines). If ``record_start`` is None each line is a record;
+    otherwise a record is every line from one which starts with
+    ``record_start`` up to the next.
+
+    While paused, the control connection's transport is paused too,
+    and any records already received are held here until
+    resumeProducing.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, protocol, key, consumer, record_start=None):
+        self.protocol = protocol
+        self.key = key
+        self.consumer = consumer
+        if record_start is None:
+            for (prefix, start) in RECORD_STARTS.items():
+                if key.startswith(prefix):
+                    record_start = start
+        self.record_start = record_start
+
+        self.paused = False
+        self.stopped = False
+        self.pending = deque()          # complete records we haven't written
+        self.record = []                # lines of the record in progress
+        self.done = None
+        self._first_line = True
+        self._reply_complete = False
+        self._transport_paused = False
+
+    def start(self, priority=PRIORITY_BULK):
+        """
+        Registers with the consumer and queues the GETINFO.
+
+        :return: a Deferred which callbacks (with None) once every
+            record has been written to the consumer.
+        """
+        self.done = defer.Deferred()
+        self.consumer.registerProducer(self, True)
+        d = self.protocol.queue_command('GETINFO %s' % self.key, self._line_received,
+                                        priority=priority)
+        d.addCallbacks(self._reply_done, self._reply_failed)
+        return self.done
+
+    def _line_received(self, line):
+        if self._first_line:
+            self._first_line = False
+            ## the data starts after "key=" on the first line
+            if line.startswith(self.key + '='):
+                line = line[len(self.key) + 1:]
+                if not line:
+                    return
+        if self.stopped or line.strip() == 'OK':
+            return
+
+        if self.record_start is None:
+            self._emit(line)
+        elif line.startswith(self.record_start) and self.record:
+            self._emit('\n'.join(self.record))
+            self.record = [line]
+        else:
+            self.record.append(line)
+
+    def _emit(self, record):
+        if self.paused or self.pending:
+            self.pending.append(record)
+        else:
+            self.consumer.write(record)
+
+    def _reply_done(self, arg):
+        if self.record and not self.stopped:
+            self._emit('\n'.join(self.record))
+        self.record = []
+        self._reply_complete = True
+        if not self.paused:
+            self._finish()
+
+    def _reply_failed(self, fail):
+        self._resume_transport()
+        self.consumer.unregisterProducer()
+        self.done.errback(fail)
+
+    def _finish(self):
+        self.consumer.unregisterProducer()
+        self.done.callback(None)
+
+    def _resume_transport(self):
+        if self._transport_paused:
+            self._transport_paused = False
+            self.protocol.transport.resumeProducing()
+
+    def pauseProducing(self):
+        "IPushProducer API"
+        self.paused = True
+        if not self._transport_paused and not self._reply_complete:
+            self._transport_paused = True
+            self.protocol.transport.pauseProducing()
+
+    def resumeProducing(self):
+        "IPushProducer API"
+        self.paused = False
+        while self.pending and not self.paused:
+            self.consumer.write(self.pending.popleft())
+        if self.paused:
+            return
+        if self._reply_complete:
+            self._finish()
+        else:
+            self._resume_transport()
+
+    def stopProducing(self):
+        """
+        IPushProducer API. The rest of the reply is read and thrown
+        away; the Deferred from start() still callbacks when it ends.
+        """
+        self.stopped = True
+        self.paused = False
+        self.pending.clear()
+        self.record = []
+        self._resume_transport()
+        if self._reply_complete and not self.done.called:
+            self._finish()
+
+
 class Event(object):
     """
     A class representing one of the valid EVENTs that Tor
@@ -90,38 +467,179 @@ class Event(object):
     This allows you to listen for such an event; see
     TorController.add_event The callbacks will be called every time
     the event in question is received.
+
+    Typed listeners get a record from :mod:`txtorcon.events` instead
+    of the raw text; it is parsed once per event no matter how many
+    typed listeners there are (and not at all if there are none).
+    Raw and typed listeners are all called in the order they were
+    added.
     """
     def __init__(self, name):
         self.name = name
-        self.callbacks = []
+        self.listeners = []             # (callback, typed) in order added
+        self.decoder = decoder_for(name)
+
+    @property
+    def callbacks(self):
+        "the raw (text) listeners"
+        return [cb for (cb, typed) in self.listeners if not typed]
+
+    @property
+    def typed_callbacks(self):
+        "the listeners which get records from txtorcon.events"
+        return [cb for (cb, typed) in self.listeners if typed]
 
-    def listen(self, cb):
-        self.callbacks.append(cb)
+    def listen(self, cb, typed=False):
+        self.listeners.append((cb, typed))
 
     def unlisten(self, cb):
-        self.callbacks.remove(cb)
+        for (i, (listener, typed)) in enumerate(self.listeners):
+            if listener == cb:
+                del self.listeners[i]
+                return
+        raise ValueError("%r isn't listening for %s" % (cb, self.name))
+
+    def has_listeners(self):
+        return len(self.listeners) > 0
 
     def got_update(self, data):
         #print self.name,"got_update:",data
-        for cb in self.callbacks:
-            cb(data)
+        record = None
+        for (cb, typed) in self.listeners:
+            if typed:
+                if record is None:
+                    record = self.decoder(data)
+                cb(record)
+            else:
+                cb(data)
+
+
+## control-spec QuotedString escapes (as Tor's unescape_string() does
+## them; a backslash and up to three octal digits is a byte)
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', '"': '"', "'": "'"}
+_OCTAL = '01234567'
+
+
+def _unescape_quoted(word):
+    """
+    word starts with a double-quote; returns what's inside it with
+    escapes processed, or None if word isn't exactly one QuotedString.
+    """
+
+    if '\\' not in word:
+        if word.find('"', 1) == len(word) - 1:
+            return word[1:-1]
+        return None
+
+    out = []
+    i = 1
+    end = len(word) - 1
+    while i < end:
+        c = word[i]
+        if c == '"':
+            return None
+        if c == '\\':
+            c = word[i + 1]
+            if c in _OCTAL:
+                digits = 1
+                while digits < 3 and i + 1 + digits < end and word[i + 1 + digits] in _OCTAL:
+                    digits += 1
+                out.append(chr(int(word[i + 1:i + 1 + digits], 8) & 0xff))
+                i += 1 + digits
+                continue
+            out.append(_ESCAPES.get(c, c))
+            i += 2
+            continue
+        out.append(c)
+        i += 1
+    if i != end:
+        ## the last quote was escaped
+        return None
+    return ''.join(out)
 
 
 def unquote(word):
-    if len(word) == 0:
+    """
+    If word is a QuotedString (see control-spec) this returns its
+    contents, with any escapes undone. Words in single quotes just
+    lose the quotes. Anything else is returned as-is.
+    """
+
+    if len(word) < 2:
         return word
     if word[0] == '"' and word[-1] == '"':
-        return word[1:-1]
+        unquoted = _unescape_quoted(word)
+        if unquoted is not None:
+            return unquoted
     elif word[0] == "'" and word[-1] == "'":
         return word[1:-1]
     return word
 
 
+def _keyword_spans(text, multiline_values=True):
+    """
+    The tokenizer behind parse_keywords and parse_keywords_lazy: one
+    pass over text (without splitting it up) yielding a ``(key,
+    spans)`` tuple for each key in order, where spans is a list of
+    ``[start, end]`` offsets into text which, joined with newlines,
+    are the (still quoted) value -- or None for a key with no value.
+    """
+
+    key = None
+    spans = None
+    pos = 0
+    size = len(text)
+    while pos <= size:
+        eol = text.find('\n', pos)
+        if eol == -1:
+            eol = size
+        equals = text.find('=', pos, eol)
+        if equals != -1 and text.find(' ', pos, equals) == -1:
+            if key is not None:
+                yield (key, spans)
+            key = text[pos:equals]
+            spans = [[equals + 1, eol]]
+
+        else:
+            line = text[pos:eol].strip()
+            if line == 'OK':
+                pass
+
+            elif key is None:
+                yield (line, None)
+
+            elif not multiline_values:
+                yield (key, spans)
+                yield (line, None)
+                key = None
+
+            elif spans[-1][1] == pos - 1:
+                ## continues right after the last line of the value
+                spans[-1][1] = eol
+
+            else:
+                spans.append([pos, eol])
+        pos = eol + 1
+
+    if key is not None:
+        yield (key, spans)
+
+
+def _span_value(text, spans):
+    if spans is None:
+        return DEFAULT_VALUE
+    if len(spans) == 1:
+        return unquote(text[spans[0][0]:spans[0][1]])
+    return unquote('\n'.join(text[start:end] for (start, end) in spans))
+
+
 def parse_keywords(lines, multiline_values=True):
     """
     Utility method to parse name=value pairs (GETINFO etc). Takes a
     string with newline-separated lines and expects at most one = sign
-    per line. Accumulates multi-line values.
+    per line. Accumulates multi-line values. A key which appears more
+    than once gets a list of values. Values which are QuotedStrings
+    are unquoted (see :func:`unquote`).
 
     :param multiline_values:
         The default is True which allows for multi-line values until a
@@ -132,42 +650,89 @@ def parse_keywords(lines, multiline_values=True):
     """
 
     rtn = {}
-    key = None
-    value = ''
-    ## FIXME could use some refactoring to reduce code duplication!
-    for line in lines.split('\n'):
-        if line.strip() == 'OK':
-            continue
+    for (key, spans) in _keyword_spans(lines, multiline_values):
+        value = _span_value(lines, spans)
+        if key in rtn:
+            if isinstance(rtn[key], types.ListType):
+                rtn[key].append(value)
+            else:
+                rtn[key] = [rtn[key], value]
+        else:
+            rtn[key] = value
+    return rtn
 
-        if '=' in line and ' ' not in line.split('=', 1)[0]:
-            if key:
-                if key in rtn:
-                    if isinstance(rtn[key], types.ListType):
-                        rtn[key].append(unquote(value))
-                    else:
-                        rtn[key] = [rtn[key], unquote(value)]
-                else:
-                    rtn[key] = unquote(value)
-            (key, value) = line.split('=', 1)
 
+class LazyKeywords(Mapping):
+    """
+    A read-only dict of the keys in a reply, as returned by
+    :func:`parse_keywords_lazy`. Only the positions of the values are
+    found up front; each value is cut out of the reply (and unquoted)
+    the first time it's asked for.
+    """
+
+    def __init__(self, text, multiline_values=True):
+        self._text = text
+        self._spans = {}
+        self._values = {}
+        for (key, spans) in _keyword_spans(text, multiline_values):
+            try:
+                self._spans[key].append(spans)
+            except KeyError:
+                self._spans[key] = [spans]
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        entries = self._spans[key]
+        if len(entries) == 1:
+            value = _span_value(self._text, entries[0])
         else:
-            if key is None:
-                rtn[line.strip()] = DEFAULT_VALUE
+            value = [_span_value(self._text, spans) for spans in entries]
+        self._values[key] = value
+        return value
 
-            elif multiline_values is False:
-                rtn[key] = value
-                rtn[line.strip()] = DEFAULT_VALUE
-                key = None
-                value = ''
+    def __iter__(self):
+        return iter(self._spans)
 
-            else:
-                value = value + '\n' + line
-    if key:
-        if key in rtn:
-            if isinstance(rtn[key], types.ListType):
-                rtn[key].append(unquote(value))
-            else:
-                rtn[key] = [rtn[key], unquote(value)]
+    def __len__(self):
+        return len(self._spans)
+
+    def __contains__(self, key):
+        return key in self._spans
+
+
+def parse_keywords_lazy(lines, multiline_values=True):
+    """
+    Like :func:`parse_keywords` but values aren't built until they're
+    used, so reading one key from a big multi-key reply doesn't copy
+    all the others.
+
+    :return: a :class:`LazyKeywords`
+    """
+
+    return LazyKeywords(lines, multiline_values)
+
+
+## KEY=VALUE where VALUE may be a QuotedString (with spaces in it),
+## or a bare word
+_KEYWORD_ARG = re.compile(r'([^\s=]+)=("(?:[^"\\]|\\.)*"|\S*)|(\S+)')
+
+
+def parse_keyword_args(line):
+    """
+    Parse a line of space-separated KEY=VALUE arguments (like the
+    AUTH line of PROTOCOLINFO, or the AUTHCHALLENGE reply) into a
+    dict. Values may be QuotedStrings, which can have spaces in
+    them. Words with no = get DEFAULT_VALUE.
+    """
+
+    rtn = {}
+    for match in _KEYWORD_ARG.finditer(line):
+        (key, value, word) = match.groups()
+        if word is not None:
+            rtn[word] = DEFAULT_VALUE
         else:
             rtn[key] = unquote(value)
     return rtn
@@ -194,19 +759,49 @@ class TorControlProtocol(LineOnlyReceiver):
 
     implements(ITorControlProtocol)
 
-    def __init__(self, password_function=None):
+    def __init__(self, password_function=None, pipeline_depth=1, reactor=None):
         """
         :param password_function:
             A zero-argument callable which returns a password (or
             Deferred). It is only called if the Tor doesn't have
             COOKIE authentication turned on. Tor's default is COOKIE.
+
+        :param pipeline_depth:
+            The maximum number of commands we will have written to Tor
+            without having received their replies yet. The default of
+            1 waits for each reply before issuing the next command;
+            larger values pipeline commands (Tor always answers in the
+            order it received them, so replies are simply matched to
+            Deferreds first-in, first-out).
+
+        :param reactor:
+            Used for command timeouts and latency measurements; the
+            global reactor by default.
         """
 
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
         self.password_function = password_function
         """If set, a callable to query for a password to use for
         authentication to Tor (default is to use COOKIE, however). May
         return Deferred."""
 
+        self.pipeline_depth = pipeline_depth
+        """How many commands may be on the wire awaiting a reply at
+        once. May be changed at any time; see __init__."""
+
+        self.command_timeout = None
+        """If not None, the default timeout (in seconds) for
+        queue_command (which errbacks the command's Deferred, but
+        doesn't free its place in the pipeline; see queue_command)"""
+
+        self.latency = {}
+        """Issue-to-reply latency of our commands, keyed by verb
+        (e.g. "GETINFO") with :class:`txtorcon.torcontrolprotocol.CommandLatency`
+        values."""
+
         self.version = None
         """Version of Tor we've connected to."""
 
@@ -250,15 +845,30 @@ class TorControlProtocol(LineOnlyReceiver):
 
         ## variables related to the state machine
         self.defer = None               # Deferred we returned for the current command
-        self.response = ''
+        self.response_lines = []        # lines of the reply so far
         self.code = None
         self.command = None             # currently processing this command
-        self.commands = []              # queued commands
+        self.commands = CommandQueue()  # queued commands, by priority
+        self.in_flight = deque()        # issued commands awaiting a reply, oldest first
+
+        self._parse_state = self._IDLE  # see _process_lines
+        self._line_callback = None      # incremental callback for the current reply
+        self._code_prefix = None        # status code of the current reply, as a string
+        self._info_coalescer = None     # see start_coalescing
+        self._conf_coalescer = None
+        self._aggregators = []          # BandwidthAggregators, see add_event_listener
+        self._deadlines = {}            # Deferred -> DelayedCall, see queue_command
+        self._issued_at = {}            # Deferred -> when we wrote the command
 
         ## Here we build up the state machine. Mostly it's pretty
         ## simply, confounded by the fact that 600's (notify) can come
         ## at any time AND can be multi-line itself. Luckily, these
         ## can't be nested, nor can the responses be interleaved.
+        ##
+        ## Note that this FSM is now only used for graphviz_data();
+        ## the actual parsing is done by _process_lines, which
+        ## implements the same machine without any per-transition
+        ## method calls.
 
         idle = State("IDLE")
         recv = State("RECV")
@@ -299,16 +909,67 @@ class TorControlProtocol(LineOnlyReceiver):
         self.fsm.state = idle
         self.stop_debug()
 
-    def start_debug(self):
-        self.debuglog = open('txtorcon-debug.log', 'w')
+    def start_debug(self, debuglog=None):
+        """
+        Start recording everything exchanged with Tor.
+
+        :param debuglog:
+            anything with ``line_received(line)`` and
+            ``command_sent(cmd)`` methods, for example
+            :class:`txtorcon.log.RingBufferLog` to keep the last few
+            lines in memory. By default, a
+            :class:`txtorcon.log.DebugLog` writing to
+            ``txtorcon-debug.log`` is used. A file-like object (with
+            ``write`` and ``flush``) is wrapped in a ``DebugLog``.
+
+        Received lines are recorded a chunk at a time, just before
+        they are parsed.
+        """
+        if debuglog is None:
+            debuglog = DebugLog(open('txtorcon-debug.log', 'w'))
+        elif not hasattr(debuglog, 'line_received'):
+            if not hasattr(debuglog, 'write'):
+                raise TypeError("start_debug() needs something with line_received() and command_sent() "
+                                "methods, or a file-like object; not %r" % (debuglog,))
+            debuglog = DebugLog(debuglog)
+        self.debuglog = debuglog
 
     def stop_debug(self):
-        def noop(*args, **kw):
-            pass
-        class NullLog(object):
-            write = noop
-            flush = noop
-        self.debuglog = NullLog()
+        """
+        Stop recording; see start_debug. While not debugging, the
+        only cost is one check per chunk received and command sent.
+        """
+        self.debuglog = None
+
+    def start_coalescing(self, reactor=None):
+        """
+        Start merging all the get_info (and get_info_raw) calls made
+        in the same reactor turn into a single GETINFO command, and
+        likewise for get_conf/get_conf_raw and GETCONF. Every caller
+        still gets a reply containing only the keys it asked for.
+
+        Note that this means those queries are only queued at the
+        end of the current reactor turn, so commands queued later in
+        the same turn may be issued before them.
+
+        :param reactor: provides callLater; by default, the one
+            given to __init__
+        """
+        if reactor is None:
+            reactor = self.reactor
+        self._info_coalescer = QueryCoalescer(self, 'GETINFO', reactor)
+        self._conf_coalescer = QueryCoalescer(self, 'GETCONF', reactor)
+
+    def stop_coalescing(self):
+        """
+        Issue any pending coalesced queries right away and stop
+        coalescing; see start_coalescing.
+        """
+        for coalescer in (self._info_coalescer, self._conf_coalescer):
+            if coalescer is not None:
+                coalescer.flush()
+        self._info_coalescer = None
+        self._conf_coalescer = None
 
     def graphviz_data(self):
         return self.fsm.dotty()
@@ -322,20 +983,51 @@ class TorControlProtocol(LineOnlyReceiver):
         the GETINFO command. See :meth:`getinfo <txtorcon.TorControlProtocol.get_info>`
         """
         info = ' '.join(map(lambda x: str(x), list(args)))
+        if self._info_coalescer is not None:
+            return self._info_coalescer.query(info.split())
         return self.queue_command('GETINFO %s' % info)
 
-    def get_info_incremental(self, key, line_cb):
+    def get_info_incremental(self, key, line_cb, priority=PRIORITY_BULK):
         """
         Mostly for internal use; calls GETINFO for a single key and
         calls line_cb with each line received, as it is received.
 
+        As this is meant for big replies (like ``ns/all``) the command
+        is queued with PRIORITY_BULK by default; see
+        :meth:`queue_command <txtorcon.TorControlProtocol.queue_command>`.
+
         See :meth:`getinfo <txtorcon.TorControlProtocol.get_info>`
         """
 
         def strip_ok_and_call(line):
             if line.strip() != 'OK':
                 line_cb(line)
-        return self.queue_command('GETINFO %s' % key, strip_ok_and_call)
+        return self.queue_command('GETINFO %s' % key, strip_ok_and_call,
+                                  priority=priority)
+
+    def get_info_stream(self, key, consumer, record_start=None, priority=PRIORITY_BULK):
+        """
+        Streams the reply to GETINFO for a single key (which may be
+        huge, like ``ns/all`` or ``md/all``) into an
+        :class:`twisted.internet.interfaces.IConsumer` without ever
+        holding the whole thing in memory. The consumer's ``write()``
+        is called with one record (a string of one or more lines) at a
+        time and it may call ``pauseProducing()`` on the producer it
+        is registered with to apply back-pressure; this pauses reading
+        from the control connection, so nothing else is received
+        until it resumes.
+
+        :param record_start: the prefix of the first line of each
+            record. By default this is looked up in
+            :data:`RECORD_STARTS` (e.g. ``"r "`` for ``ns/``
+            keys); for other keys every line is a record.
+
+        :return: a Deferred which callbacks once every record has been
+            written (and the consumer's ``unregisterProducer`` called).
+        """
+
+        producer = InfoRecordProducer(self, key, consumer, record_start)
+        return producer.start(priority)
 
     ## The following methods are the main TorController API and
     ## probably the most interesting for users.
@@ -383,13 +1075,15 @@ class TorControlProtocol(LineOnlyReceiver):
         otherwise.
         """
 
-        return self.queue_command('GETCONF %s' % ' '.join(args)).addCallback(parse_keywords).addErrback(log.err)
+        return self.get_conf_raw(*args).addCallback(parse_keywords).addErrback(log.err)
 
     def get_conf_raw(self, *args):
         """
         Same as get_conf, except that the results are not parsed into a dict
         """
 
+        if self._conf_coalescer is not None:
+            return self._conf_coalescer.query(' '.join(args).split())
         return self.queue_command('GETCONF %s' % ' '.join(args))
 
     def set_conf(self, *args):
@@ -432,7 +1126,7 @@ class TorControlProtocol(LineOnlyReceiver):
             raise RuntimeError("Invalid signal " + nm)
         return self.queue_command('SIGNAL %s' % nm)
 
-    def add_event_listener(self, evt, callback):
+    def add_event_listener(self, evt, callback, typed=False, window=None, reactor=None):
         """
         :param evt: event name, see also
         :var:`txtorcon.TorControlProtocol.events` .keys()
@@ -445,6 +1139,20 @@ class TorControlProtocol(LineOnlyReceiver):
         argument, that is the text collected for the event from the
         tor control protocol.
 
+        :param typed: if True, the callback instead gets a record
+            from :mod:`txtorcon.events` (e.g. a ``CircuitEvent`` for
+            CIRC) which is parsed once and shared by all typed
+            listeners.
+
+        :param window: for BW, CIRC_BW, STREAM_BW and CONN_BW events
+            only; if given, the callback is instead called at most once
+            every ``window`` seconds with a dict of the bytes ``(read,
+            written)`` per ID over that window. See
+            :class:`txtorcon.events.BandwidthAggregator`.
+
+        :param reactor: provides callLater for ``window``; the global
+            reactor by default.
+
         .. note::
             this is a low-level interface; if you want to follow
             circuit or stream creation etc. see TorState and methods
@@ -463,12 +1171,40 @@ class TorControlProtocol(LineOnlyReceiver):
             except:
                 raise RuntimeError("Unknown event type: " + evt)
 
+        if window is not None:
+            aggregator = BandwidthAggregator(evt.name, callback, window, reactor)
+            self._aggregators.append(aggregator)
+            callback = aggregator
+            typed = False
+
         if evt.name not in self.events:
             self.events[evt.name] = evt
             self.queue_command('SETEVENTS %s' % ' '.join(self.events.keys()))
-        evt.listen(callback)
+        evt.listen(callback, typed)
         return None
 
+    def copy_event_listeners(self, other):
+        """
+        Adds every event listener of ``other`` (another
+        TorControlProtocol, e.g. the one we had before reconnecting)
+        to this one, with a single SETEVENTS. Listeners for events
+        this Tor doesn't support are dropped.
+
+        :return: a Deferred which fires when SETEVENTS completes
+        """
+
+        for (name, evt) in other.events.items():
+            try:
+                mine = self.valid_events[name]
+            except KeyError:
+                txtorlog.msg("Event %s not supported; dropping its listeners." % name)
+                continue
+            for (cb, typed) in evt.listeners:
+                mine.listen(cb, typed)
+            self.events[name] = mine
+        self._aggregators.extend(other._aggregators)
+        return self.queue_command('SETEVENTS %s' % ' '.join(self.events.keys()))
+
     def remove_event_listener(self, evt, cb):
         if evt not in self.valid_events.values():
             # this lets us pass a string or a real event-object
@@ -477,8 +1213,14 @@ class TorControlProtocol(LineOnlyReceiver):
             except:
                 raise RuntimeError("Unknown event type: " + evt)
 
+        for aggregator in self._aggregators:
+            if aggregator.name == evt.name and aggregator.callback == cb:
+                self._aggregators.remove(aggregator)
+                aggregator.stop()
+                cb = aggregator
+                break
         evt.unlisten(cb)
-        if len(evt.callbacks) == 0:
+        if not evt.has_listeners():
             # note there's a slight window here for an event of this
             # type to come in before the SETEVENTS succeeds; see
             # _handle_notify which explicitly ignore this case.
@@ -507,32 +1249,208 @@ class TorControlProtocol(LineOnlyReceiver):
         """
         return self.queue_command('QUIT')
 
-    def queue_command(self, cmd, arg=None):
+    def queue_command(self, cmd, arg=None, priority=PRIORITY_INTERACTIVE, timeout=None):
         """
         returns a Deferred which will fire with the response data when
         we get it
 
         Note that basically every request is ultimately funelled
         through this command.
+
+        :param priority:
+            one of PRIORITY_URGENT, PRIORITY_INTERACTIVE (the default)
+            or PRIORITY_BULK. Queued commands are issued most-urgent
+            first, and in order within the same priority. This only
+            re-orders commands which haven't been written to Tor yet;
+            replies always come back in the order commands were
+            issued.
+
+        :param timeout:
+            If the reply hasn't arrived this many seconds after the
+            command was queued, the Deferred errbacks with
+            :class:`twisted.internet.error.TimeoutError`. Defaults to
+            :attr:`command_timeout` (no timeout).
+
+        Cancelling the Deferred (or a timeout) before the command is
+        written to Tor removes it from the queue. Once it has been
+        written, Tor will still answer it (and everything queued
+        behind it has to wait for that) but the reply is thrown
+        away.
+
+        So a timeout does *not* free up the pipeline: Tor's replies
+        come back in order, so a command that's been written keeps
+        its place (as ``.command`` and in ``in_flight``) until Tor
+        answers it. If Tor never does, nothing queued behind it will
+        be answered either; the only way out of that is to drop the
+        connection (e.g. ``transport.loseConnection()``).
         """
 
-        d = defer.Deferred()
-        self.commands.append((d, cmd, arg))
+        d = defer.Deferred(self._cancel_command)
+        command = (d, cmd, arg)
+        self.commands.append(command, priority)
+        if timeout is None:
+            timeout = self.command_timeout
+        if timeout is not None:
+            self._deadlines[d] = self.reactor.callLater(timeout, self._command_timed_out,
+                                                        command, timeout)
         self._maybe_issue_command()
         return d
 
+    def _forget_command(self, command):
+        """
+        Internal helper for cancelled and timed-out commands: removes
+        the command if it's still queued, and cancels its timeout.
+        """
+
+        try:
+            self.commands.remove(command)
+        except ValueError:
+            pass                        # already issued
+        timer = self._deadlines.pop(command[0], None)
+        if timer is not None and timer.active():
+            timer.cancel()
+
+    def _cancel_command(self, d):
+        "canceller for the Deferreds from queue_command"
+        for command in self.commands:
+            if command[0] is d:
+                self._forget_command(command)
+                return
+        timer = self._deadlines.pop(d, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+
+    def _command_timed_out(self, command, timeout):
+        del self._deadlines[command[0]]
+        self._forget_command(command)
+        command[0].errback(TimeoutError("'%s' got no reply in %s seconds" % (command[1], timeout)))
+
     ## the remaining methods are internal API implementations,
     ## callbacks and state-tracking methods -- you shouldn't have any
     ## need to call them.
 
+    def dataReceived(self, data):
+        """
+        :api:`twisted.internet.interfaces.IProtocol` API
+
+        We split the whole chunk into lines and parse them in one go
+        (see _process_lines) rather than having LineOnlyReceiver call
+        lineReceived for each one.
+        """
+
+        lines = (self._buffer + data).split(self.delimiter)
+        self._buffer = lines.pop()
+        self._process_lines(lines)
+        if len(self._buffer) > self.MAX_LENGTH:
+            return self.lineLengthExceeded(self._buffer)
+
     def lineReceived(self, line):
         """
         :api:`twisted.protocols.basic.LineOnlyReceiver` API
         """
 
-        self.debuglog.write(line + '\n')
-        self.debuglog.flush()
-        self.fsm.process(line)
+        self._process_lines([line])
+
+    ## states for _process_lines; these correspond to the IDLE, RECV
+    ## and RECV_PLUS states of the FSM built in __init__
+    _IDLE = 0
+    _RECV = 1
+    _RECV_PLUS = 2
+
+    def _process_lines(self, lines):
+        """
+        Internal method which parses complete lines from Tor. Every
+        line is dispatched on its status code and separator
+        character (' ' for the last line of a reply, '-' for a
+        continuation and '+' for the start of a data section ended by
+        a lone '.') in a single pass.
+        """
+
+        transport = self.transport
+        max_length = self.MAX_LENGTH
+        if self.debuglog is not None:
+            for line in lines:
+                self.debuglog.line_received(line)
+
+        state = self._parse_state
+        for line in lines:
+            if transport.disconnecting:
+                ## see LineOnlyReceiver.dataReceived
+                break
+            if len(line) > max_length:
+                self._parse_state = state
+                return self.lineLengthExceeded(line)
+
+            if state == self._RECV_PLUS:
+                ## inside a data section, the lines are passed as-is
+                if line[:1] == '.' and line.strip() == '.':
+                    state = self._RECV
+                elif self._line_callback is None:
+                    self.response_lines.append(line)
+                else:
+                    self._line_callback(line)
+                continue
+
+            sep = line[3:4]
+            if state == self._IDLE:
+                try:
+                    code = int(line[:3])
+                except ValueError:
+                    self._parse_state = state
+                    raise RuntimeError('Expected a status line, not "%s"' % line)
+                if sep == ' ' and 600 <= code < 700:
+                    ## single-line async event, by far the most
+                    ## common thing on a busy connection
+                    self._handle_notify(code, line[4:])
+                    continue
+                self.code = code
+                if sep == ' ':
+                    self._parse_state = state
+                    self._broadcast_response(line)
+                    ## in case a callback fed us more data
+                    state = self._parse_state
+                    continue
+                self._code_prefix = line[:3]
+                if sep == '-':
+                    state = self._RECV
+                elif sep == '+':
+                    state = self._RECV_PLUS
+                else:
+                    self._parse_state = state
+                    raise RuntimeError('Unknown separator in "%s"' % line)
+
+                if self.command is not None and code < 600 and not self.defer.called:
+                    ## (the Deferred is already called if the command
+                    ## was cancelled or timed out after we issued it)
+                    self._line_callback = self.command[2]
+                else:
+                    self._line_callback = None
+                if self._line_callback is None:
+                    self.response_lines = [line[4:]]
+                else:
+                    self._line_callback(line[4:])
+                continue
+
+            ## state == self._RECV
+            if line[:3] != self._code_prefix:
+                self._parse_state = state
+                raise RuntimeError('Unexpected code "%s", wanted %d' % (line[:3], self.code))
+            if sep == ' ':
+                self._line_callback = None
+                self._parse_state = self._IDLE
+                self._broadcast_response(line)
+                state = self._parse_state
+                continue
+            if sep == '+':
+                state = self._RECV_PLUS
+            elif sep != '-':
+                self._parse_state = state
+                raise RuntimeError('Unknown separator in "%s"' % line)
+            if self._line_callback is None:
+                self.response_lines.append(line[4:])
+            else:
+                self._line_callback(line[4:])
+        self._parse_state = state
 
     def connectionMade(self):
         "Protocol API"
@@ -555,10 +1473,19 @@ class TorControlProtocol(LineOnlyReceiver):
         Internal method to deal with 600-level responses.
         """
 
-        firstline = rest[:rest.find('\n')]
-        args = firstline.split()
-        if args[0] in self.events:
-            self.events[args[0]].got_update(rest[len(args[0]) + 1:])
+        ## the event name ends at the first space (or newline, for
+        ## multi-line events like NS)
+        end = rest.find(' ')
+        newline = rest.find('\n')
+        if end == -1 or (newline != -1 and newline < end):
+            end = newline
+        if end == -1:
+            name = rest
+        else:
+            name = rest[:end]
+        evt = self.events.get(name)
+        if evt is not None:
+            evt.got_update(rest[len(name) + 1:])
             return
         # not considering this an error, as there's a slight window
         # after remove_event_listener is called (so the handler is
@@ -566,23 +1493,48 @@ class TorControlProtocol(LineOnlyReceiver):
 
     def _maybe_issue_command(self):
         """
-        If there's at least one command queued and we're not currently
-        processing a command, this will issue the next one on the
-        wire.
-        """
-        if self.command:
-            return
+        If there's at least one command queued and we have fewer than
+        pipeline_depth commands awaiting a reply, this will issue
+        queued commands on the wire until the pipeline is full.
 
-        if len(self.commands):
-            self.command = self.commands.pop(0)
-            (d, cmd, cmd_arg) = self.command
-            self.defer = d
+        Replies always belong to the oldest command in flight, so
+        that one becomes the current .command (and .defer).
+        """
 
-            self.debuglog.write(cmd + '\n')
-            self.debuglog.flush()
+        depth = max(1, self.pipeline_depth)
+        while len(self.commands) and len(self.in_flight) < depth:
+            command = self.commands.popleft()
+            self.in_flight.append(command)
+            self._issued_at[command[0]] = self.reactor.seconds()
+            cmd = command[1]
 
+            if self.debuglog is not None:
+                self.debuglog.command_sent(cmd)
             self.transport.write(cmd + '\r\n')
 
+        if self.command is None and len(self.in_flight):
+            self.command = self.in_flight[0]
+            self.defer = self.command[0]
+
+    def _command_answered(self):
+        """
+        Internal helper. Tor has answered self.command, so this
+        records its latency and cancels any timeout.
+        """
+
+        d = self.defer
+        timer = self._deadlines.pop(d, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        issued = self._issued_at.pop(d, None)
+        if issued is not None:
+            verb = self.command[1].split(None, 1)[0]
+            try:
+                stats = self.latency[verb]
+            except KeyError:
+                stats = self.latency[verb] = CommandLatency()
+            stats.record(self.reactor.seconds() - issued)
+
     def _auth_failed(self, fail):
         """
         Errback if authentication fails.
@@ -596,7 +1548,7 @@ class TorControlProtocol(LineOnlyReceiver):
         Callback on AUTHCHALLENGE SAFECOOKIE
         """
 
-        kw = parse_keywords(reply.replace(' ', '\n'))
+        kw = parse_keyword_args(reply)
 
         server_hash = base64.b16decode(kw['SERVERHASH'])
         server_nonce = base64.b16decode(kw['SERVERNONCE'])
@@ -613,6 +1565,26 @@ class TorControlProtocol(LineOnlyReceiver):
         client_hash_hex = base64.b16encode(client_hash)
         return self.queue_command('AUTHENTICATE %s' % client_hash_hex)
 
+    def _read_cookie(self, cookie):
+        """
+        Reads the cookie file in a thread (from our reactor's pool), so
+        as not to block the reactor (there may be many connections
+        authenticating at once).
+
+        :return: a Deferred which callbacks with the cookie data
+        """
+
+        return threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                                         _read_cookie_file, cookie)
+
+    def _start_safecookie_authentication(self, cookie_data, cookie):
+        "Callback once _read_cookie has the data for SAFECOOKIE"
+        self.cookie_data = cookie_data
+        txtorlog.msg("Using SAFECOOKIE authentication", cookie,
+                     len(self.cookie_data), "bytes")
+        self.client_nonce = os.urandom(32)
+        return self.queue_command('AUTHCHALLENGE SAFECOOKIE %s' % base64.b16encode(self.client_nonce))
+
     def _do_authenticate(self, protoinfo):
         """
         Callback on PROTOCOLINFO to actually authenticate once we know
@@ -622,33 +1594,26 @@ class TorControlProtocol(LineOnlyReceiver):
         methods = None
         for line in protoinfo.split('\n'):
             if line[:5] == 'AUTH ':
-                kw = parse_keywords(line[5:].replace(' ', '\n'))
+                kw = parse_keyword_args(line[5:])
                 methods = kw['METHODS'].split(',')
+                cookie = kw.get('COOKIEFILE')
         if not methods:
             raise RuntimeError("Didn't find AUTH line in PROTOCOLINFO response.")
 
         if 'SAFECOOKIE' in methods:
-            cookie = re.search('COOKIEFILE="(.*)"', protoinfo).group(1)
-            self.cookie_data = open(cookie, 'r').read()
-            if len(self.cookie_data) != 32:
-                raise RuntimeError("Expected authentication cookie to be 32 bytes, got %d" % len(self.cookie_data))
-            txtorlog.msg("Using SAFECOOKIE authentication", cookie,
-                         len(self.cookie_data), "bytes")
-            self.client_nonce = os.urandom(32)
-
-            d = self.queue_command('AUTHCHALLENGE SAFECOOKIE %s' % base64.b16encode(self.client_nonce))
+            d = self._read_cookie(cookie)
+            d.addCallback(self._start_safecookie_authentication, cookie)
             d.addCallback(self._safecookie_authchallenge).addCallback(self._bootstrap).addErrback(self._auth_failed)
-            return
+            return d
 
         elif 'COOKIE' in methods:
-            cookie = re.search('COOKIEFILE="(.*)"', protoinfo).group(1)
-            with open(cookie, 'r') as cookiefile:
-                data = cookiefile.read()
-            if len(data) != 32:
-                raise RuntimeError("Expected authentication cookie to be 32 bytes, got %d" % len(data))
-            txtorlog.msg("Using COOKIE authentication", cookie, len(data), "bytes")
-            self.authenticate(data).addCallback(self._bootstrap).addErrback(self._auth_failed)
-            return
+            d = self._read_cookie(cookie)
+
+            def authenticate(data):
+                txtorlog.msg("Using COOKIE authentication", cookie, len(data), "bytes")
+                return self.authenticate(data)
+            d.addCallback(authenticate).addCallback(self._bootstrap).addErrback(self._auth_failed)
+            return d
 
         if self.password_function:
             passwd = defer.maybeDeferred(self.password_function)
@@ -684,14 +1649,24 @@ class TorControlProtocol(LineOnlyReceiver):
         ## any signal name and just wait for the reply?
         self.valid_signals = ["RELOAD", "DUMP", "DEBUG", "NEWNYM", "CLEARDNSCACHE"]
 
-        self.version = yield self.get_info('version')
-        self.version = self.version['version']
+        ## none of these depend on each other, so they go out together
+        ## whatever pipeline_depth is (it only limits what's written
+        ## while these are queued; anything after waits for them)
+        depth = self.pipeline_depth
+        self.pipeline_depth = max(depth, 3)
+        try:
+            version = self.get_info('version')
+            eventnames = self.get_info('events/names')
+            features = self.queue_command('USEFEATURE EXTENDED_EVENTS')
+        finally:
+            self.pipeline_depth = depth
+
+        version = yield version
+        self.version = version['version']
         txtorlog.msg("Connected to a Tor with VERSION", self.version)
-        eventnames = yield self.get_info('events/names')
-        eventnames = eventnames['events/names']
-        self._set_valid_events(eventnames)
-
-        yield self.queue_command('USEFEATURE EXTENDED_EVENTS')
+        eventnames = yield eventnames
+        self._set_valid_events(eventnames['events/names'])
+        yield features
 
         self.post_bootstrap.callback(self)
         defer.returnValue(self)
@@ -731,7 +1706,7 @@ class TorControlProtocol(LineOnlyReceiver):
         if self.command and self.command[2] is not None:
             self.command[2](line[4:])
         else:
-            self.response = line[4:] + '\n'
+            self.response_lines = [line[4:]]
         return None
 
     def _is_continuation_line(self, line):
@@ -758,7 +1733,7 @@ class TorControlProtocol(LineOnlyReceiver):
             self.command[2](line)
 
         else:
-            self.response += (line + '\n')
+            self.response_lines.append(line)
         return None
 
     def _accumulate_response(self, line):
@@ -767,7 +1742,7 @@ class TorControlProtocol(LineOnlyReceiver):
             self.command[2](line[4:])
 
         else:
-            self.response += (line[4:] + '\n')
+            self.response_lines.append(line[4:])
         return None
 
     def _is_finish_line(self, line):
@@ -784,25 +1759,37 @@ class TorControlProtocol(LineOnlyReceiver):
     def _broadcast_response(self, line):
         "for FSM"
         # print "BCAST",line
+        ## we collect the lines in a list and join them just once
+        ## here, as big replies (ns/all, md/all) can be megabytes
+        lines = self.response_lines
+        self.response_lines = []
         if len(line) > 3:
             if self.code >= 200 and self.code < 300 and self.command and self.command[2] is not None:
-                self.command[2](line[4:])
+                if not self.defer.called:
+                    self.command[2](line[4:])
                 resp = ''
 
             else:
-                resp = self.response + line[4:]
+                lines.append(line[4:])
+                ## strip the trailing "OK" off successful replies
+                if len(lines) > 1 and lines[-1] == 'OK' and self.code >= 200 and self.code < 300:
+                    lines.pop()
+                resp = '\n'.join(lines)
+        elif lines:
+            resp = '\n'.join(lines) + '\n'
         else:
-            resp = self.response
-        self.response = ''
+            resp = ''
         if self.code >= 200 and self.code < 300:
             if self.defer is None:
                 raise RuntimeError('Got a response, but didn\'t issue a command: "%s"' % resp)
-            if resp.endswith('\nOK'):
-                resp = resp[:-3]
-            self.defer.callback(resp)
+            self._command_answered()
+            if not self.defer.called:
+                self.defer.callback(resp)
         elif self.code >= 500 and self.code < 600:
+            self._command_answered()
             err = TorProtocolError(self.code, resp)
-            self.defer.errback(err)
+            if not self.defer.called:
+                self.defer.errback(err)
         elif self.code >= 600 and self.code < 700:
             self._handle_notify(self.code, resp)
             self.code = None
@@ -813,6 +1800,8 @@ class TorControlProtocol(LineOnlyReceiver):
             raise RuntimeError("Unknown code in broadcast response %d." % self.code)
 
         ## note: we don't do this for 600-level responses
+        if len(self.in_flight) and self.in_flight[0] is self.command:
+            self.in_flight.popleft()
         self.command = None
         self.code = None
         self.defer = None
@@ -1,4 +1,3 @@
-import datetime
 import os
 import stat
 import types
@@ -13,15 +12,33 @@ from zope.interface import implements
 from txtorcon import TorProtocolFactory
 from txtorcon.stream import Stream
 from txtorcon.circuit import Circuit
-from txtorcon.router import Router, hashFromHexId
+from txtorcon.router import Router, hashFromHexId, hexIdFromHash, flag_mask
 from txtorcon.addrmap import AddrMap
 from txtorcon.torcontrolprotocol import parse_keywords
 from txtorcon.log import txtorlog
-from txtorcon.torcontrolprotocol import TorProtocolError
+from txtorcon.torcontrolprotocol import TorProtocolError, PRIORITY_URGENT
+from txtorcon.pool import connect_pool
+from txtorcon.consensus import ConsensusParser, ConsensusDiff, parse_published
+from txtorcon.routerindex import RouterIndex
+from txtorcon.pathselect import PathSelector
+from txtorcon.microdesc import MicrodescriptorParser
 
 from txtorcon.interface import ITorControlProtocol, IRouterContainer, ICircuitListener
-from txtorcon.interface import ICircuitContainer, IStreamListener, IStreamAttacher
-from spaghetti import FSM, State, Transition
+from txtorcon.interface import ICircuitContainer, IStreamListener, IStreamAttacher, IRouterListener
+
+
+def _status_ids(data):
+    """
+    The IDs (first word of each line) from a circuit-status or
+    stream-status reply.
+    """
+
+    ids = set()
+    for line in data[data.find('=') + 1:].split('\n'):
+        words = line.split()
+        if words and words[0].isdigit():
+            ids.add(int(words[0]))
+    return ids
 
 
 def _build_state(proto):
@@ -34,7 +51,8 @@ def _wait_for_proto(proto):
 
 
 def build_tor_connection(connection, build_state=True, wait_for_proto=True,
-                         password_function=lambda: None):
+                         password_function=lambda: None, pipeline_depth=1,
+                         connections=1):
     """
     This is used to build a valid TorState (which has .protocol for
     the TorControlProtocol). For example::
@@ -56,6 +74,15 @@ def build_tor_connection(connection, build_state=True, wait_for_proto=True,
     :param password_function:
         See :class:`txtorcon.TorControlProtocol`
 
+    :param pipeline_depth:
+        See :class:`txtorcon.TorControlProtocol`
+
+    :param connections:
+        If more than 1, this many control connections are opened and
+        a :class:`txtorcon.TorControlPool` is used in place of a
+        TorControlProtocol (so bulk reads like ``ns/all`` don't hold
+        up stream attachment and other commands).
+
     :param build_state:
         If True (the default) a TorState object will be
         built as well. If False, just a TorControlProtocol will be
@@ -93,10 +120,16 @@ def build_tor_connection(connection, build_state=True, wait_for_proto=True,
                         'Endpoint for argument "connection", got %s' %
                         (connection, ))
 
-    d = endpoint.connect(TorProtocolFactory(password_function=password_function))
+    factory = TorProtocolFactory(password_function=password_function,
+                                 pipeline_depth=pipeline_depth)
+    if connections > 1:
+        ## the pool is already bootstrapped, so no wait_for_proto
+        d = connect_pool(endpoint, factory, connections)
+    else:
+        d = endpoint.connect(factory)
     if build_state:
         d.addCallback(build_state if callable(build_state) else _build_state)
-    elif wait_for_proto:
+    elif wait_for_proto and connections <= 1:
         d.addCallback(wait_for_proto if callable(wait_for_proto) else
                       _wait_for_proto)
     return d
@@ -145,6 +178,10 @@ def flags_from_dict(kw):
     return flags
 
 
+_GUARD = flag_mask('guard')
+_AUTHORITY = flag_mask('authority')
+
+
 class TorState(object):
     """
     This tracks the current state of Tor using a TorControlProtocol.
@@ -165,14 +202,20 @@ class TorState(object):
     This is also a good example of the various listeners, and acts as
     an :class:`txtorcon.interface.ICircuitContainer` and
     :class:`txtorcon.interface.IRouterContainer`.
+
+    With ``microdescriptors=True`` the routers are loaded from the
+    microdescriptor consensus and ``md/all`` (what a Tor client
+    already has cached) rather than ``ns/all``; see
+    :meth:`load_microdescriptors`.
     """
 
     implements(ICircuitListener, ICircuitContainer, IRouterContainer,
                IStreamListener)
 
-    def __init__(self, protocol, bootstrap=True, write_state_diagram=False):
+    def __init__(self, protocol, bootstrap=True, write_state_diagram=False, microdescriptors=False):
         self.protocol = ITorControlProtocol(protocol)
-        ## fixme could use protocol.on_disconnect to re-connect; see issue #3
+        ## see txtorcon.reconnect.TorReconnector (and resync) to
+        ## survive losing the control connection
 
         ## could override these to get your own Circuit/Stream subclasses
         ## to track these things
@@ -202,52 +245,38 @@ class TorState(object):
         self.unusable_entry_guards = []  # list of entry guards we didn't parse out
         self.authorities = {}            # keys by name
 
-        self.cleanup = None              # see set_attacher
-
-        class die(object):
-            __name__ = 'die'             # FIXME? just to ease spagetti.py:82's pain
-
-            def __init__(self, msg):
-                self.msg = msg
-
-            def __call__(self, *args):
-                raise RuntimeError(self.msg % tuple(args))
-
-        def nothing(*args):
-            pass
+        self.consensus_valid_after = None
+        """valid-after time of the consensus our routers came from, as
+        a string, if known; it's asked for when bootstrapping and
+        after each NEWCONSENSUS (see get_consensus_valid_after and
+        resync)"""
 
-        waiting_r = State("waiting_r")
-        waiting_w = State("waiting_w")
-        waiting_p = State("waiting_p")
-        waiting_s = State("waiting_s")
-
-        def ignorable_line(x):
-            return x.strip() == '.' or x.strip() == 'OK' or x[:3] == 'ns/' or x.strip() == ''
-
-        waiting_r.add_transition(Transition(waiting_r, ignorable_line, nothing))
-        waiting_r.add_transition(Transition(waiting_s, lambda x: x[:2] == 'r ', self._router_begin))
-        ## FIXME use better method/func than die!!
-        waiting_r.add_transition(Transition(waiting_r, lambda x: x[:2] != 'r ', die('Expected "r " while parsing routers not "%s"')))
-
-        waiting_s.add_transition(Transition(waiting_w, lambda x: x[:2] == 's ', self._router_flags))
-        waiting_s.add_transition(Transition(waiting_s, lambda x: x[:2] == 'a ', self._router_address))
-        waiting_s.add_transition(Transition(waiting_r, ignorable_line, nothing))
-        waiting_s.add_transition(Transition(waiting_r, lambda x: x[:2] != 's ' and x[:2] != 'a ', die('Expected "s " while parsing routers not "%s"')))
-        waiting_s.add_transition(Transition(waiting_r, lambda x: x.strip() == '.', nothing))
-
-        waiting_w.add_transition(Transition(waiting_p, lambda x: x[:2] == 'w ', self._router_bandwidth))
-        waiting_w.add_transition(Transition(waiting_r, ignorable_line, nothing))
-        waiting_w.add_transition(Transition(waiting_s, lambda x: x[:2] == 'r ', self._router_begin))  # "w" lines are optional
-        waiting_w.add_transition(Transition(waiting_r, lambda x: x[:2] != 'w ', die('Expected "w " while parsing routers not "%s"')))
-        waiting_w.add_transition(Transition(waiting_r, lambda x: x.strip() == '.', nothing))
-
-        waiting_p.add_transition(Transition(waiting_r, lambda x: x[:2] == 'p ', self._router_policy))
-        waiting_p.add_transition(Transition(waiting_r, ignorable_line, nothing))
-        waiting_p.add_transition(Transition(waiting_s, lambda x: x[:2] == 'r ', self._router_begin))  # "p" lines are optional
-        waiting_p.add_transition(Transition(waiting_r, lambda x: x[:2] != 'p ', die('Expected "p " while parsing routers not "%s"')))
-        waiting_p.add_transition(Transition(waiting_r, lambda x: x.strip() == '.', nothing))
+        self.cleanup = None              # see set_attacher
 
-        self._network_status_parser = FSM([waiting_r, waiting_s, waiting_w, waiting_p])
+        self.router_listeners = []
+        self.router_index = RouterIndex()
+        """indexes of the routers by flag, country etc.; see routers_where"""
+        self.path_selector = PathSelector(self, family=self.router_family)
+        """chooses routers weighted by bandwidth; see random_path"""
+        self.consensus_generation = 0
+        """how many complete consensuses we've had; each Router's
+        ``generation`` is the last one it was in (see evict_routers)"""
+        self._placeholder_routers = {}   # by hexid, made up by router_from_id
+        ## held while a consensus (or NS event) is being applied:
+        ## they all share the parsers and _consensus_diff, so an NS
+        ## event arriving while ns/all streams in on another
+        ## connection (see TorControlPool) has to wait its turn
+        self._router_lock = defer.DeferredLock()
+        self._consensus_diff = ConsensusDiff()
+        self._router = None
+        self._router_changes = None
+        self._router_ip_v6 = None
+
+        self.use_microdescriptors = microdescriptors
+        """if True, routers come from the microdescriptor consensus and
+        ``md/all`` rather than ``ns/all``"""
+        self._network_status_parser = ConsensusParser(self)
+        self._microdesc_consensus_parser = ConsensusParser(self, flavor='microdesc')
         if write_state_diagram:
             with open('routerfsm.dot', 'w') as fsmfile:
                 fsmfile.write(self._network_status_parser.dotty())
@@ -257,72 +286,267 @@ class TorState(object):
             self.protocol.post_bootstrap.addCallback(self._bootstrap).addErrback(self.post_bootstrap.errback)
 
     def _router_begin(self, data):
+        self._router_end()
         args = data.split()
-        self._router = Router(self.protocol)
-        self._router.from_consensus = True
-        self._router.update(args[1],         # nickname
-                            args[2],         # idhash
-                            args[3],         # orhash
-                            datetime.datetime.strptime(args[4] + args[5], '%Y-%m-%f%H:%M:%S'),
-                            args[6],         # ip address
-                            args[7],         # ORPort
-                            args[8])         # DirPort
-
-        if self._router.id_hex in self.routers:
-            ## FIXME should I do an update() on this one??
-            self._router = self.routers[self._router.id_hex]
-            return
-
-        if self._router.name in self.routers_by_name:
-            self.routers_by_name[self._router.name].append(self._router)
+        if len(args) == 8:
+            ## a microdescriptor consensus has no descriptor digest
+            args.insert(3, None)
+        id_hex = hexIdFromHash(args[2])
+        self._consensus_diff.seen.add(id_hex)
+        router = self.routers_by_hash.get(id_hex)
+
+        if router is None:
+            ## might be one router_from_id made up (e.g. for a
+            ## circuit) before we saw it in the consensus
+            router = self._placeholder_routers.pop(id_hex, None)
+            if router is None:
+                router = Router(self.protocol)
+            router.from_consensus = True
+            router.update(args[1],         # nickname
+                          args[2],         # idhash
+                          args[3],         # orhash
+                          parse_published(args[4], args[5]),
+                          args[6],         # ip address
+                          args[7],         # ORPort
+                          args[8])         # DirPort
+            self._add_router(router)
+            self._consensus_diff.added.append(router)
+            self._router_changes = None
 
         else:
-            self.routers_by_name[self._router.name] = [self._router]
-
-        if self._router.name in self.routers:
-            self.routers[self._router.name] = None
+            ## only touch what changed, remembering the old values
+            changes = {}
+            for (attr, value) in (('name', args[1]),
+                                  ('or_hash', args[3]),
+                                  ('modified', parse_published(args[4], args[5])),
+                                  ('ip', args[6]),
+                                  ('or_port', int(args[7])),
+                                  ('dir_port', int(args[8]))):
+                old = getattr(router, attr)
+                if old != value:
+                    changes[attr] = old
+                    setattr(router, attr, value)
+            if 'name' in changes:
+                self._unindex_router_name(router, changes['name'])
+                self._index_router_name(router)
+                if self.authorities.get(changes['name']) is router:
+                    del self.authorities[changes['name']]
+                    self.authorities[router.name] = router
+            if 'ip' in changes:
+                router._location = None
+            self._router_changes = changes
+            self._router_ip_v6 = router.ip_v6
+            router.ip_v6 = ()
+        self._router = router
+
+    def _router_end(self):
+        """
+        Called when we're done with a router entry (at the next "r"
+        line or the end of the update) to record what changed.
+        """
 
-        else:
-            self.routers[self._router.name] = self._router
-        self.routers[self._router.id_hex] = self._router
-        self.routers_by_hash[self._router.id_hex] = self._router
-        self.all_routers.add(self._router)
+        router = self._router
+        if router is None:
+            return
+        self._router = None
+        changes = self._router_changes
+        if changes is None:
+            return
+        if router.ip_v6 != self._router_ip_v6:
+            changes['ip_v6'] = self._router_ip_v6
+        if changes:
+            ## a router listed twice keeps its oldest values
+            previous = self._consensus_diff.updated.setdefault(router, {})
+            for (attr, old) in changes.items():
+                previous.setdefault(attr, old)
 
     def _router_flags(self, data):
-        args = data.split()
-        self._router.flags = args[1:]
-        if 'guard' in self._router.flags:
-            self.guards[self._router.id_hex] = self._router
-        if 'authority' in self._router.flags:
-            self.authorities[self._router.name] = self._router
+        router = self._router
+        mask = flag_mask(data[2:])
+        if mask != router.flag_mask:
+            if self._router_changes is not None:
+                self._router_changes['flags'] = router.flags
+            router.flag_mask = mask
+        if mask & _GUARD:
+            self.guards[router.id_hex] = router
+        else:
+            self.guards.pop(router.id_hex, None)
+        if mask & _AUTHORITY:
+            self.authorities[router.name] = router
+        elif self.authorities.get(router.name) is router:
+            del self.authorities[router.name]
 
     def _router_address(self, data):
         """only for IPv6 addresses"""
-        self._router.ip_v6.append(data.split()[1].strip())
+        self._router.ip_v6 += (data.split()[1].strip(),)
 
     def _router_bandwidth(self, data):
         args = data.split()
-        self._router.bandwidth = int(args[1].split('=')[1])
+        bandwidth = int(args[1].split('=')[1])
+        if bandwidth != self._router.bandwidth:
+            if self._router_changes is not None:
+                self._router_changes['bandwidth'] = self._router.bandwidth
+            self._router.bandwidth = bandwidth
 
     def _router_policy(self, data):
         args = data.split()
-        self._router.policy = args[1:]
-        self._router = None
+        ## re-parsing the port list is the expensive part, so only if
+        ## it's different
+        policy = ' '.join(args[1:])
+        if self._router_changes is None:
+            self._router.policy = args[1:]
+        elif policy != self._router.policy:
+            self._router_changes['policy'] = self._router.policy
+            self._router.policy = args[1:]
+
+    def _router_microdesc(self, data):
+        digest = data.split()[1]
+        router = self._router
+        if digest != router.md_digest:
+            if self._router_changes is not None:
+                self._router_changes['md_digest'] = router.md_digest
+            router.md_digest = digest
+
+    def _add_router(self, router):
+        self.routers[router.id_hex] = router
+        self.routers_by_hash[router.id_hex] = router
+        self.all_routers.add(router)
+        self._index_router_name(router)
+
+    def _remove_router(self, router):
+        del self.routers_by_hash[router.id_hex]
+        if self.routers.get(router.id_hex) is router:
+            del self.routers[router.id_hex]
+        self.all_routers.discard(router)
+        self._unindex_router_name(router, router.name)
+        self.guards.pop(router.id_hex, None)
+        if self.authorities.get(router.name) is router:
+            del self.authorities[router.name]
+
+    def _index_router_name(self, router):
+        ## routers[name] is only there for names that are unique
+        named = self.routers_by_name.setdefault(router.name, [])
+        named.append(router)
+        if len(named) == 1:
+            self.routers[router.name] = router
+        else:
+            self.routers.pop(router.name, None)
+
+    def _unindex_router_name(self, router, name):
+        named = self.routers_by_name[name]
+        named.remove(router)
+        if not named:
+            del self.routers_by_name[name]
+            self.routers.pop(name, None)
+        elif len(named) == 1:
+            self.routers[name] = named[0]
+
+    def _load_routers(self):
+        return self._router_lock.run(self._read_routers)
+
+    @defer.inlineCallbacks
+    def _read_routers(self):
+        ## note that we're feeding each line incrementally to the
+        ## parser. "ns" should be the empty string, but we call
+        ## _update_network_status to finish the update (and tell
+        ## router listeners)
+        self._begin_network_status()
+        if self.use_microdescriptors:
+            parser = self._microdesc_consensus_parser
+            key = 'dir/status-vote/current/consensus-microdesc'
+        else:
+            parser = self._network_status_parser
+            key = 'ns/all'
+        ns = yield self.protocol.get_info_incremental(key, parser.process)
+        self._update_network_status(ns, parser=parser)
+        if self.use_microdescriptors:
+            yield self.load_microdescriptors()
+
+    @defer.inlineCallbacks
+    def load_microdescriptors(self):
+        """
+        Reads ``md/all`` from Tor and gives each router we have the
+        microdescriptor the consensus says is its own (by the digest
+        on its "m" line, so this only helps for routers which came
+        from a microdescriptor consensus; see the ``microdescriptors``
+        option). Their exit policies are set from the
+        microdescriptors' summaries, and router listeners are told.
+        This happens when bootstrapping with ``microdescriptors=True``
+        and after each NEWCONSENSUS event. Routers whose new
+        microdescriptor Tor hasn't downloaded yet keep their old one
+        until the next time.
+
+        :return: a Deferred which callbacks with how many routers got
+            a microdescriptor
+        """
+
+        parser = MicrodescriptorParser()
+        yield self.protocol.get_info_incremental('md/all', parser.process)
+        defer.returnValue(self._add_microdescriptors(parser.finish()))
+
+    def _add_microdescriptors(self, microdescriptors):
+        by_digest = {}
+        for router in self.routers_by_hash.values():
+            if router.md_digest is not None:
+                by_digest[router.md_digest] = router
+        updated = []                    # (router, changes), in md/all order
+        found = 0
+        for md in microdescriptors:
+            router = by_digest.get(md.digest)
+            if router is None:
+                continue
+            found += 1
+            router._microdescriptor = md
+            ## the policy summary is only parsed if it's different
+            if md.policy != router.policy:
+                updated.append((router, {'policy': router.policy}))
+                router.policy = md.policy
+        txtorlog.msg(len(microdescriptors), "microdescriptors;", len(updated), "policies changed")
+
+        for listener in [self.router_index, self.path_selector] + self.router_listeners:
+            for (router, changes) in updated:
+                listener.router_updated(router, changes)
+        return found
+
+    def router_family(self, router):
+        """
+        :return: a list of the Routers in ``router``'s family: those
+            its microdescriptor lists which list it in theirs too (as
+            Tor requires). Without microdescriptors (see
+            :meth:`load_microdescriptors`) we don't know, so this is
+            empty.
+        """
+
+        md = router.microdescriptor
+        if md is None:
+            return []
+        family = []
+        for entry in md.family:
+            other = self._family_member(entry)
+            if other is None or other is router or other.microdescriptor is None:
+                continue
+            for back in other.microdescriptor.family:
+                if self._family_member(back) is router:
+                    family.append(other)
+                    break
+        return family
+
+    def _family_member(self, entry):
+        if entry.startswith('$'):
+            return self.routers_by_hash.get(entry[:41].upper())
+        return self.routers.get(entry)
 
     @defer.inlineCallbacks
     def _bootstrap(self, arg=None):
         "This takes an arg so we can use it as a callback (see __init__)."
 
-        # update list of routers (must be before we do the
-        # circuit-status) note that we're feeding each line
-        # incrementally to a state-machine called
-        # _network_status_parser, set up in constructor. "ns" should
-        # be the empty string, but we call _update_network_status for
-        # the de-duplication of named routers
+        # which consensus the routers are from (asked first, so if
+        # it changes while we're loading them resync reloads them)
+        yield self.get_consensus_valid_after()
 
-        ns = yield self.protocol.get_info_incremental('ns/all',
-                                                      self._network_status_parser.process)
-        self._update_network_status(ns)
+        # update list of routers (must be before we do the
+        # circuit-status)
+        yield self._load_routers()
 
         # update list of existing circuits
         cs = yield self.protocol.get_info_raw('circuit-status')
@@ -333,14 +557,8 @@ class TorState(object):
         self._stream_status(ss)
 
         # update list of existing address-maps
-        key = 'address-mappings/all'
-        am = yield self.protocol.get_info_raw(key)
-        # strip addressmappsings/all= and OK\n from raw data
-        am = am[len(key) + 1:]
-        for line in am.split('\n'):
-            if len(line.strip()) == 0:
-                continue            # FIXME
-            self.addrmap.update(line)
+        am = yield self.protocol.get_info_raw('address-mappings/all')
+        self._address_mappings(am)
 
         self._add_events()
 
@@ -386,6 +604,91 @@ class TorState(object):
         self.post_bootstrap.callback(self)
         self.post_boostrap = None
 
+    def _address_mappings(self, data):
+        "Used internally to update the AddrMap from address-mappings/all"
+        key = 'address-mappings/all'
+        # strip addressmappsings/all= and OK\n from raw data
+        data = data[len(key) + 1:]
+        for line in data.split('\n'):
+            if len(line.strip()) == 0:
+                continue            # FIXME
+            self.addrmap.update(line)
+
+    @defer.inlineCallbacks
+    def get_consensus_valid_after(self):
+        """
+        Asks Tor for the valid-after time of its current consensus and
+        remembers it as ``consensus_valid_after`` (None if this Tor
+        doesn't support GETINFO consensus/valid-after).
+
+        :return: a Deferred which callbacks with the valid-after time
+            (a string) or None
+        """
+
+        try:
+            raw = yield self.protocol.get_info_raw('consensus/valid-after')
+            valid_after = parse_keywords(raw).get('consensus/valid-after')
+        except TorProtocolError:
+            valid_after = None
+        self.consensus_valid_after = valid_after
+        defer.returnValue(valid_after)
+
+    @defer.inlineCallbacks
+    def resync(self, protocol):
+        """
+        Switches to a new (bootstrapped) control connection, for
+        example after the old one was lost or Tor restarted, and
+        catches up with what changed in the meantime: all event
+        listeners are moved over, and circuits, streams and address
+        mappings are re-read from Tor. Circuits and streams Tor no
+        longer knows about are closed (so listeners hear about it).
+
+        The (expensive) router list is only re-read if Tor's consensus
+        is different from the one we got it from, according to
+        ``consensus_valid_after``.
+
+        :return: a Deferred which callbacks with this TorState once
+            it's up to date
+        """
+
+        old = self.protocol
+        self.protocol = ITorControlProtocol(protocol)
+        yield self.protocol.copy_event_listeners(old)
+        if self.attacher is not None:
+            yield self.protocol.set_conf("__LeaveStreamsUnattached", "1")
+
+        ## a new consensus only replaces the routers that changed, so
+        ## every Router we're keeping needs the new connection too
+        for router in self.all_routers:
+            router.controller = self.protocol
+        for router in self._placeholder_routers.values():
+            router.controller = self.protocol
+
+        old_valid_after = self.consensus_valid_after
+        valid_after = yield self.get_consensus_valid_after()
+        if valid_after is None or valid_after != old_valid_after:
+            yield self._load_routers()
+
+        cs = yield self.protocol.get_info_raw('circuit-status')
+        ss = yield self.protocol.get_info_raw('stream-status')
+        circuit_ids = _status_ids(cs)
+        stream_ids = _status_ids(ss)
+        ## streams first, so the circuits don't complain about
+        ## closing with streams still attached
+        for stream_id in self.streams.keys():
+            if stream_id not in stream_ids:
+                self._update_stream([str(stream_id), 'CLOSED', '0', 'unknown:0', 'REASON=END'])
+        for circ_id in self.circuits.keys():
+            if circ_id not in circuit_ids:
+                self._update_circuit([str(circ_id), 'CLOSED', 'REASON=DESTROYED'])
+        self._circuit_status(cs)
+        self._stream_status(ss)
+
+        am = yield self.protocol.get_info_raw('address-mappings/all')
+        self._address_mappings(am)
+
+        defer.returnValue(self)
+
     def undo_attacher(self):
         """
         Shouldn't Tor handle this by turning this back to 0 if the
@@ -461,7 +764,7 @@ class TorState(object):
 
         # stream is now an ID no matter what we passed in
         cmd = 'CLOSESTREAM %d %d%s' % (stream, reason, flags)
-        return self.protocol.queue_command(cmd)
+        return self.protocol.queue_command(cmd, priority=PRIORITY_URGENT)
 
     def close_circuit(self, circid, **kwargs):
         """
@@ -484,7 +787,8 @@ class TorState(object):
             ## assume it's a Circuit instance
             circid = circid.id
         flags = flags_from_dict(kwargs)
-        return self.protocol.queue_command('CLOSECIRCUIT %s%s' % (circid, flags))
+        return self.protocol.queue_command('CLOSECIRCUIT %s%s' % (circid, flags),
+                                           priority=PRIORITY_URGENT)
 
     def add_circuit_listener(self, icircuitlistener):
         listen = ICircuitListener(icircuitlistener)
@@ -498,6 +802,54 @@ class TorState(object):
             stream.listen(listen)
         self.stream_listeners.append(listen)
 
+    def add_router_listener(self, irouterlistener):
+        """
+        Adds an :class:`txtorcon.interface.IRouterListener` to be told
+        which routers are added, removed or changed by each new
+        consensus (or NS event). It isn't told about the routers we
+        already have; see ``all_routers``.
+        """
+
+        self.router_listeners.append(IRouterListener(irouterlistener))
+
+    def routers_where(self, flags=None, country=None, asn=None, port=None, min_bandwidth=None):
+        """
+        Find routers in the consensus by any combination of flags,
+        country code, ASN, a port their exit policy accepts and
+        least bandwidth, e.g.
+        ``state.routers_where(flags=('exit', 'fast', 'stable'), country='DE', port=443)``.
+        This uses indexes kept up to date as the consensus changes
+        (see :class:`txtorcon.routerindex.RouterIndex`) so it doesn't
+        look at every router.
+
+        :return: a set of Routers (which you may change)
+        """
+
+        return self.router_index.where(flags=flags, country=country, asn=asn,
+                                       port=port, min_bandwidth=min_bandwidth)
+
+    def random_path(self, length=3, exit_port=None, using_guards=True):
+        """
+        Choose a path for :meth:`build_circuit` the way Tor would: a
+        guard, middle routers and an exit, each picked at random
+        weighted by bandwidth, no two in the same /16. For example
+        ``state.build_circuit(state.random_path(exit_port=443))``.
+        See :class:`txtorcon.pathselect.PathSelector` (which is
+        ``path_selector``) for the details.
+
+        :param length: how many routers (at least 2)
+
+        :param exit_port: a port the exit's policy must accept
+
+        :param using_guards: if True, start with one of our
+            ``entry_guards`` when we know them
+
+        :return: a list of Routers
+        """
+
+        return self.path_selector.random_path(length=length, exit_port=exit_port,
+                                              using_guards=using_guards)
+
     def _find_circuit_after_extend(self, x):
         ex, circ_id = x.split()
         if ex != 'EXTENDED':
@@ -578,7 +930,8 @@ class TorState(object):
                 return
 
             if circ is None:
-                self.protocol.queue_command("ATTACHSTREAM %d 0" % stream.id)
+                self.protocol.queue_command("ATTACHSTREAM %d 0" % stream.id,
+                                            priority=PRIORITY_URGENT)
 
             else:
                 if isinstance(circ, defer.Deferred):
@@ -589,7 +942,8 @@ class TorState(object):
 
                         def __call__(self, arg):
                             circid = arg.id
-                            self.state.protocol.queue_command("ATTACHSTREAM %d %d" % (self.stream_id, circid))
+                            self.state.protocol.queue_command("ATTACHSTREAM %d %d" % (self.stream_id, circid),
+                                                              priority=PRIORITY_URGENT)
 
                     circ.addCallback(IssueStreamAttach(self, stream.id)).addErrback(log.err)
 
@@ -598,7 +952,8 @@ class TorState(object):
                         raise RuntimeError("Attacher returned a circuit unknown to me.")
                     if circ.state != 'BUILT':
                         raise RuntimeError("Can only attach to BUILT circuits; %d is in %s." % (circ.id, circ.state))
-                    self.protocol.queue_command("ATTACHSTREAM %d %d" % (stream.id, circ.id))
+                    self.protocol.queue_command("ATTACHSTREAM %d %d" % (stream.id, circ.id),
+                                                priority=PRIORITY_URGENT)
 
     def _circuit_status(self, data):
         """Used internally as a callback for updating Circuit information"""
@@ -630,24 +985,134 @@ class TorState(object):
         else:
             [self._stream_update(line) for line in lines[1:]]
 
-    def _update_network_status(self, data):
+    def _update_network_status(self, data, complete=True, parser=None):
         """
         Used internally as a callback for updating Router information
-        from NS and NEWCONSENSUS events.
+        from NEWCONSENSUS events (and, with ``complete=False``, NS
+        events, which only list the routers they're about). Only what
+        changed is applied, and router listeners are told about it;
+        after a complete consensus, routers not in it are evicted (see
+        :meth:`evict_routers`).
+        Any lines already fed to the parser (e.g. by
+        ``get_info_incremental``) count as part of this update.
+
+        :param parser: the :class:`txtorcon.consensus.ConsensusParser`
+            to use; by default the one for ``ns/all`` (rather than a
+            microdescriptor consensus)
+
+        :return: a :class:`txtorcon.consensus.ConsensusDiff`
         """
 
-        self.all_routers = set()
-        for line in data.split('\n'):
-            self._network_status_parser.process(line)
+        if parser is None:
+            parser = self._network_status_parser
+        try:
+            for line in data.split('\n'):
+                parser.process(line)
+            self._router_end()
+        except Exception:
+            self._begin_network_status()
+            raise
+
+        diff = self._consensus_diff
+        self._begin_network_status()
+        if complete:
+            self.consensus_generation += 1
+        for id_hex in diff.seen:
+            self.routers_by_hash[id_hex].generation = self.consensus_generation
+        if complete:
+            evicted = self._evict_routers()
+            diff.evicted = len(evicted)
+            diff.removed = [router for router in evicted if router.from_consensus]
+
+        txtorlog.msg(len(self.routers_by_name), "named routers found.", diff)
+        txtorlog.msg(len(self.guards), "GUARDs")
 
-        txtorlog.msg(len(self.routers_by_name), "named routers found.")
-        # remove any names we added that turned out to have dups
-        for (k, v) in self.routers.items():
-            if v is None:
-                txtorlog.msg(len(self.routers_by_name[k]), "dups:", k)
-                del self.routers[k]
+        for listener in [self.router_index, self.path_selector] + self.router_listeners:
+            for router in diff.added:
+                listener.router_added(router)
+            for router in diff.removed:
+                listener.router_removed(router)
+            for (router, changes) in diff.updated.items():
+                listener.router_updated(router, changes)
+        return diff
 
-        txtorlog.msg(len(self.guards), "GUARDs")
+    def evict_routers(self):
+        """
+        Drops every Router which isn't in the newest consensus (and
+        every one :meth:`router_from_id` made up for a router we
+        hadn't heard of, once a newer consensus has arrived) unless a
+        circuit we know about goes through it. This happens after
+        each new consensus anyway; call it if you want routers kept
+        for circuits gone sooner.
+
+        :return: the number of routers evicted
+        """
+
+        evicted = self._evict_routers()
+        for listener in [self.router_index, self.path_selector] + self.router_listeners:
+            for router in evicted:
+                if router.from_consensus:
+                    listener.router_removed(router)
+        return len(evicted)
+
+    def _evict_routers(self):
+        in_use = set()
+        for circuit in self.circuits.values():
+            in_use.update(circuit.path)
+        evicted = []
+        for router in self.routers_by_hash.values():
+            if router.generation < self.consensus_generation and router not in in_use:
+                self._remove_router(router)
+                evicted.append(router)
+        for router in self._placeholder_routers.values():
+            if router.generation < self.consensus_generation and router not in in_use:
+                del self._placeholder_routers[router.id_hex]
+                if self.routers.get(router.id_hex) is router:
+                    del self.routers[router.id_hex]
+                evicted.append(router)
+        if evicted:
+            txtorlog.msg("evicted", len(evicted), "routers")
+        return evicted
+
+    def _network_status_event(self, data):
+        "Used internally as a callback for NS events"
+        d = self._router_lock.run(self._update_network_status, data, complete=False)
+        d.addErrback(log.err)
+
+    def _new_consensus_event(self, data):
+        """
+        Used internally as a callback for NEWCONSENSUS events. With
+        ``use_microdescriptors`` the routers have to keep following
+        the microdescriptor consensus: if the event has its "m" lines
+        it's parsed as one (and the microdescriptors re-read if any
+        router is new or has a different one), otherwise (Tor sends
+        these in the "ns" format) the whole microdescriptor consensus
+        is re-read, as when bootstrapping.
+
+        Like NS events, this waits for any consensus we're already
+        reading.
+        """
+
+        self.get_consensus_valid_after().addErrback(log.err)
+        self._router_lock.run(self._new_consensus, data).addErrback(log.err)
+
+    def _new_consensus(self, data):
+        if not self.use_microdescriptors:
+            self._update_network_status(data)
+        elif '\nm ' in '\n' + data:
+            diff = self._update_network_status(data, parser=self._microdesc_consensus_parser)
+            if diff.added or any('md_digest' in changes for changes in diff.updated.values()):
+                self.load_microdescriptors().addErrback(log.err)
+        else:
+            ## we've already got the lock
+            return self._read_routers()
+
+    def _begin_network_status(self):
+        self._consensus_diff = ConsensusDiff()
+        self._router = None
+        self._router_changes = None
+        self._network_status_parser.reset()
+        self._microdesc_consensus_parser.reset()
 
     def _maybe_create_circuit(self, circ_id):
         if circ_id not in self.circuits:
@@ -666,7 +1131,17 @@ class TorState(object):
         """
 
         #print "circuit_update",line
-        args = line.split()
+        self._update_circuit(line.split())
+
+    def _circuit_event(self, record):
+        """
+        Used internally as a typed listener for CIRC events; see
+        :class:`txtorcon.events.CircuitEvent`
+        """
+
+        self._update_circuit(record.args)
+
+    def _update_circuit(self, args):
         circ_id = int(args[0])
 
         c = self._maybe_create_circuit(circ_id)
@@ -683,7 +1158,17 @@ class TorState(object):
             ## this happens if there are no active streams
             return
 
-        args = line.split()
+        self._update_stream(line.split())
+
+    def _stream_event(self, record):
+        """
+        Used internally as a typed listener for STREAM events; see
+        :class:`txtorcon.events.StreamEvent`
+        """
+
+        self._update_stream(record.args)
+
+    def _update_stream(self, args):
         assert len(args) >= 3
 
         stream_id = int(args[0])
@@ -707,12 +1192,17 @@ class TorState(object):
         txtorlog.msg(" --> addr_map", addr)
         self.addrmap.update(addr)
 
-    event_map = {'STREAM': _stream_update,
-                 'CIRC': _circuit_update,
-                 'NS': _update_network_status,
-                 'NEWCONSENSUS': _update_network_status,
+    event_map = {'STREAM': _stream_event,
+                 'CIRC': _circuit_event,
+                 'NS': _network_status_event,
+                 'NEWCONSENSUS': _new_consensus_event,
                  'ADDRMAP': _addr_map}
     """event_map used by add_events to map event_name -> unbound method"""
+
+    typed_events = ('STREAM', 'CIRC')
+    """the events in event_map whose methods take a record from
+    txtorcon.events instead of a string"""
+
     @defer.inlineCallbacks
     def _add_events(self):
         """
@@ -722,7 +1212,8 @@ class TorState(object):
         for (event, func) in self.event_map.items():
             ## the map contains unbound methods, so we bind them
             ## to self so they call the right thing
-            yield self.protocol.add_event_listener(event, types.MethodType(func, self, TorState))
+            yield self.protocol.add_event_listener(event, types.MethodType(func, self, TorState),
+                                                   typed=event in self.typed_events)
 
     ## ICircuitContainer
 
@@ -752,7 +1243,9 @@ class TorState(object):
             router.update(nick, hashFromHexId(idhash), '0' * 27, 'unknown',
                           'unknown', '0', '0')
             router.name_is_unique = is_named
+            router.generation = self.consensus_generation
             self.routers[router.id_hex] = router
+            self._placeholder_routers[router.id_hex] = router
             return router
 
     ## implement IStreamListener
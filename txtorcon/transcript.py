@@ -0,0 +1,299 @@
+"""
+Record a control-port session as a timestamped transcript, and replay
+one into a :class:`txtorcon.TorControlProtocol` (and so into a
+:class:`txtorcon.TorState` or anything else using it) with no Tor and
+no network, as fast as it can be parsed.
+
+A transcript is a text file with one entry per line::
+
+    1419010734.123456 > GETINFO version
+    1419010734.124001 < 250-version=0.2.5.10 (git-43a5f3d91e726291)
+    1419010734.124010 < 250 OK
+    1419010735.500210 < 650 CIRC 12 LAUNCHED PURPOSE=GENERAL
+
+That is, a timestamp, a direction (``>`` for commands we sent, ``<``
+for lines from Tor -- replies and asynchronous events alike, in the
+order they arrived) and the line itself. Lines with the direction
+``#`` describe the protocol the transcript was recorded from (see
+:func:`record_transcript`). This is the same format
+:meth:`txtorcon.log.RingBufferLog.dump` writes.
+
+For example, to record::
+
+    record_transcript(protocol, open('session.transcript', 'w'))
+
+...and to replay::
+
+    replay = TranscriptReplay(read_transcript(open('session.transcript')))
+    protocol = TorControlProtocol()
+    replay.connect(protocol)
+    state = TorState(protocol)
+    replay.run()
+"""
+
+import time
+
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+
+__all__ = ['TranscriptLog', 'record_transcript', 'read_transcript', 'TranscriptReplay']
+
+
+AUTHENTICATION_VERBS = ('PROTOCOLINFO', 'AUTHCHALLENGE', 'AUTHENTICATE')
+"""Commands which :meth:`TranscriptReplay.connect` skips"""
+
+
+class TranscriptLog(object):
+    """
+    A debug log (see :meth:`txtorcon.TorControlProtocol.start_debug`)
+    which writes a transcript to the file-like object ``f``.
+
+    Arguments to AUTHENTICATE are never written (so passwords and
+    cookies don't end up on disk) and nothing is flushed until you do
+    so; a transcript is for replaying, not for post-mortems after a
+    crash (use :class:`txtorcon.log.DebugLog` for that).
+    """
+
+    def __init__(self, f, clock=time.time):
+        self.file = f
+        self._clock = clock
+
+    def line_received(self, line):
+        self.file.write('%.6f < %s\n' % (self._clock(), line))
+
+    def command_sent(self, cmd):
+        if cmd.startswith('AUTHENTICATE'):
+            cmd = 'AUTHENTICATE'
+        ## commands with data (e.g. LOADCONF) have newlines in them
+        self.file.write('%.6f > %s\n' % (self._clock(), cmd.encode('string_escape')))
+
+    def header(self, key, value):
+        """
+        Record something about the protocol we're attached to.
+        """
+
+        self.file.write('%.6f # %s %s\n' % (self._clock(), key, value))
+
+
+def record_transcript(protocol, f, clock=time.time):
+    """
+    Start recording everything ``protocol`` exchanges with Tor to
+    ``f``. If ``protocol`` has already bootstrapped, its version and
+    the events and signals it knows about are written first, so that
+    :meth:`TranscriptReplay.connect` can set up the same protocol
+    without replaying a bootstrap.
+
+    :return: the :class:`TranscriptLog`
+    """
+
+    transcript = TranscriptLog(f, clock)
+    if protocol.version is not None:
+        transcript.header('version', protocol.version)
+        transcript.header('events', ' '.join(sorted(protocol.valid_events.keys())))
+        transcript.header('signals', ' '.join(protocol.valid_signals))
+    protocol.start_debug(transcript)
+    return transcript
+
+
+def read_transcript(f):
+    """
+    :return: a list of ``(timestamp, direction, line)`` tuples from the
+        transcript in the file-like object ``f``.
+    """
+
+    entries = []
+    for line in f:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        (timestamp, direction, rest) = (line.split(' ', 2) + [''])[:3]
+        if direction == '>':
+            rest = rest.decode('string_escape')
+        entries.append((float(timestamp), direction, rest))
+    return entries
+
+
+def _is_final(line):
+    "True if line is the last line of a reply (not an event)"
+    return len(line) > 3 and line[3] == ' ' and line[:3] != '650'
+
+
+class TranscriptReplay(object):
+    """
+    A transport which answers the commands a TorControlProtocol sends
+    with the replies recorded in a transcript (along with any events
+    recorded in between), without waiting for anything: the
+    protocol's commands must match the transcript's.
+
+    The authentication exchange is skipped (so it doesn't matter
+    what cookie file or password Tor asked for at recording time).
+
+    :ivar mismatch: None, or an ``(expected, sent)`` tuple if the
+        protocol sent a command other than the one recorded; replay
+        stops at that point.
+
+    :ivar lines_fed: how many lines from Tor we've delivered so far.
+    """
+
+    def __init__(self, entries, strict=True, chunk_lines=1000):
+        """
+        :param entries: as from :func:`read_transcript`
+
+        :param strict: if False, any command the protocol sends is
+            taken to be the next one in the transcript.
+
+        :param chunk_lines: how many lines to hand to
+            ``dataReceived`` at once (pausing only takes effect between
+            chunks)
+        """
+
+        self.entries = entries
+        self.strict = strict
+        self.chunk_lines = chunk_lines
+        self.protocol = None
+        self.headers = {}
+        self.mismatch = None
+        self.lines_fed = 0
+        self.paused = False
+        self.disconnecting = False
+        self._next = 0
+        self._pending = []
+        self._running = False
+
+    def connect(self, protocol):
+        """
+        Attach to ``protocol`` (a TorControlProtocol which hasn't been
+        connected) as if it had just authenticated. If the transcript
+        includes the protocol's bootstrap that is replayed too;
+        otherwise the protocol's post_bootstrap fires straight away
+        with whatever :func:`record_transcript` recorded about it.
+
+        Nothing is actually delivered until :meth:`run`.
+        """
+
+        self.protocol = protocol
+        protocol.transport = self
+        protocol.connected = 1
+
+        self._skip_authentication()
+        for (timestamp, direction, line) in self.entries:
+            if direction == '#':
+                (key, value) = (line.split(' ', 1) + [''])[:2]
+                self.headers[key] = value
+        self._advance()
+
+        if self._next_command() == 'GETINFO version':
+            protocol._bootstrap()
+        else:
+            if 'version' in self.headers:
+                protocol.version = self.headers['version']
+            protocol._set_valid_events(self.headers.get('events', ''))
+            protocol.valid_signals = self.headers.get('signals', '').split()
+            protocol.post_bootstrap.callback(protocol)
+        return protocol
+
+    def run(self):
+        """
+        Feed Tor's side of the transcript to the protocol until it's
+        used up, the protocol sends a command we don't expect, or
+        we're paused.
+
+        :return: the number of lines delivered
+        """
+
+        if self._running:
+            return 0
+        self._running = True
+        fed = self.lines_fed
+        try:
+            while self._pending and not self.paused:
+                lines = self._pending[:self.chunk_lines]
+                del self._pending[:self.chunk_lines]
+                self.lines_fed += len(lines)
+                self.protocol.dataReceived('\r\n'.join(lines) + '\r\n')
+        finally:
+            self._running = False
+        return self.lines_fed - fed
+
+    def finished(self):
+        """
+        :return: True if everything in the transcript has been
+            delivered (or a mismatch stopped us)
+        """
+
+        return not self._pending and self._next >= len(self.entries)
+
+    def _skip_authentication(self):
+        index = 0
+        while True:
+            command = self._next_command(index)
+            if command is None or command.split(' ', 1)[0] not in AUTHENTICATION_VERBS:
+                break
+            while self.entries[index][1] != '>':
+                index += 1
+            index += 1
+            while index < len(self.entries) and self.entries[index][1] != '>':
+                index += 1
+                if self.entries[index - 1][1] == '<' and _is_final(self.entries[index - 1][2]):
+                    break
+        self._next = index
+
+    def _next_command(self, index=None):
+        if index is None:
+            index = self._next
+        for (timestamp, direction, line) in self.entries[index:]:
+            if direction == '>':
+                return line
+        return None
+
+    def _advance(self):
+        ## queue up everything Tor said before our next command
+        entries = self.entries
+        while self._next < len(entries) and entries[self._next][1] != '>':
+            if entries[self._next][1] == '<':
+                self._pending.append(entries[self._next][2])
+            self._next += 1
+
+    ## enough of ITransport and IPushProducer for TorControlProtocol
+
+    def write(self, data):
+        if data.endswith('\r\n'):
+            data = data[:-2]
+        if self._next < len(self.entries):
+            expected = self.entries[self._next][2]
+            self._next += 1
+        else:
+            expected = None
+        if expected is None or (self.strict and data != expected):
+            self.mismatch = (expected, data)
+            self._pending = []
+            self._next = len(self.entries)
+            return
+        self._advance()
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        self._pending = []
+        self._next = len(self.entries)
+        self.protocol.connectionLost(failure.Failure(ConnectionDone()))
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.run()
+
+    def stopProducing(self):
+        self.loseConnection()